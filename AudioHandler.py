@@ -17,18 +17,32 @@
 import gc
 import logging
 import os
+import shutil
+import threading
 import time
 import wave
 from datetime import datetime
 
+import cv2
 import librosa
 import numpy as np
-import pyaudiowpatch as pyaudio
+
+from CaptureBackends import RingBuffer, create_capture_backend
+from RecordingManifest import RecordingManifest
+from SlideContainer import SlideContainerWriter
 
 PCM_MAX = 32767
 
 WAVE_FILE_EXTENSION = '.wav'
 
+AUDIO_STORAGE_MODE_WAV = 'wav'
+AUDIO_STORAGE_MODE_CONTAINER = 'container'
+
+SCREENSHOT_EXTENSION = '.png'
+
+SCREENSHOT_STORAGE_MODE_IMAGE = 'image'
+SCREENSHOT_STORAGE_MODE_CONTAINER = 'container'
+
 NOT_RECORDING_STYLE_SHEET = '''background-color: transparent;
 color: #454544;
 font-weight: bold;
@@ -50,7 +64,7 @@ def s_mag_to_dbfs(data_s_mag):
     :return:
     """
     # Prevent zero values
-    min_value = np.finfo(np.float).eps
+    min_value = np.finfo(np.float64).eps
     if data_s_mag < min_value:
         data_s_mag = min_value
 
@@ -69,17 +83,50 @@ def dbfs_to_s_mag(data_dbfs):
     return np.power(10., np.divide(data_dbfs, 20.))
 
 
+def samples_levels_dbfs(samples):
+    """
+    Calculates peak and RMS levels of float samples
+    :param samples: numpy 1D array of floats
+    :return: (peak_dbfs, rms_dbfs)
+    """
+    if len(samples) == 0:
+        return s_mag_to_dbfs(0), s_mag_to_dbfs(0)
+    peak = np.max(np.abs(samples))
+    rms = np.sqrt(np.mean(np.square(samples)))
+    return s_mag_to_dbfs(peak), s_mag_to_dbfs(rms)
+
+
 class AudioHandler:
     def __init__(self, settings, progress_bar_audio_signal, label_rec_set_stylesheet_signal):
         self.settings = settings
         self.progress_bar_audio_signal = progress_bar_audio_signal
         self.label_rec_set_stylesheet_signal = label_rec_set_stylesheet_signal
 
-        self.py_audio = None
-        self.recording_stream = None
+        self.capture_backend = None
+        self.ring_buffer = None
+        self.consumer_thread = None
+        self.consumer_thread_running = False
         self.is_recording = False
         self.wave_file = None
-
+        self.wave_file_name = ''
+        self.fragment_active = False
+        self.container_file = None
+        self.container_file_name = ''
+        self.slide_container = None
+        self.slide_container_file_name = ''
+        self.manifest = None
+        self.background_transcriber = None
+
+        # Optional thread pools shared between concurrent sessions (see SessionManager)
+        self.screenshot_pool = None
+        self.writer_pool = None
+        self.write_future = None
+        self.screenshot_future = None
+
+        # Added to generated recording names to separate concurrent sessions
+        self.recording_name_suffix = ''
+
+        self.recording_dir = ''
         self.screenshots_dir = ''
         self.audio_dir = ''
         self.recording_started_time = 0
@@ -91,49 +138,58 @@ class AudioHandler:
         self.audio_samples_temp = np.empty(0, dtype=np.int16)
 
     def open_stream(self):
-        # Initialize PyAudio
-        if self.py_audio is None:
-            self.py_audio = pyaudio.PyAudio()
-
-        # Get default WASAPI info
-        wasapi_info = self.py_audio.get_host_api_info_by_type(pyaudio.paWASAPI)
-
-        # Get default WASAPI speakers
-        default_speakers = self.py_audio.get_device_info_by_index(wasapi_info['defaultOutputDevice'])
-        if not default_speakers['isLoopbackDevice']:
-            for loopback in self.py_audio.get_loopback_device_info_generator():
-                if default_speakers['name'] in loopback['name']:
-                    default_speakers = loopback
-                    break
-
-        # Open recording stream
-        logging.info('Opening audio loopback...')
-        logging.info(str(default_speakers))
-        self.recording_channels = default_speakers['maxInputChannels']
-        self.sampling_rate = int(default_speakers['defaultSampleRate'])
-        self.recording_stream = self.py_audio.open(input_device_index=default_speakers['index'],
-                                                   format=pyaudio.paFloat32,
-                                                   channels=self.recording_channels,
-                                                   frames_per_buffer=int(self.settings['audio_chunk_size']),
-                                                   rate=self.sampling_rate,
-                                                   input=True,
-                                                   stream_callback=self.callback)
+        """
+        Opens capture backend selected in settings and starts ring buffer consumer thread
+        :return:
+        """
+        self.capture_backend = create_capture_backend(self.settings, self.callback)
+        self.capture_backend.open()
+        self.recording_channels = self.capture_backend.channels
+        self.sampling_rate = self.capture_backend.sampling_rate
+        logging.info('Capturing ' + str(self.recording_channels) + ' channels at ' + str(self.sampling_rate) + ' Hz')
+
+        # Initialize ring buffer between capture callback and processing
+        self.ring_buffer = RingBuffer(float(self.settings['audio_ring_buffer_seconds']) * self.sampling_rate)
+
+        # Start consumer thread
+        self.consumer_thread_running = True
+        self.consumer_thread = threading.Thread(target=self.consumer_loop)
+        self.consumer_thread.start()
+        logging.info('Audio consumer thread: ' + self.consumer_thread.name)
 
         # Reset label background
         self.label_rec_set_stylesheet_signal.emit(NOT_RECORDING_STYLE_SHEET)
 
     def close_stream(self):
         """
-        Closes recording stream
+        Closes recording stream and stops recording
         :return:
         """
-        self.recording_stop()
-        if self.recording_stream is not None:
+        if self.capture_backend is not None:
             try:
-                self.recording_stream.stop_stream()
-                self.recording_stream.close()
+                self.capture_backend.close()
             except Exception as e:
                 logging.warning(e)
+            self.capture_backend = None
+
+        # Stop consumer thread (it processes the rest of ring buffer before exiting)
+        self.consumer_thread_running = False
+        if self.consumer_thread is not None and self.consumer_thread != threading.current_thread():
+            self.consumer_thread.join()
+        self.consumer_thread = None
+
+        self.recording_stop()
+
+        # Log capture headroom
+        if self.ring_buffer is not None:
+            logging.info('Audio ring buffer overruns: ' + str(self.ring_buffer.overruns)
+                         + ', samples dropped: ' + str(self.ring_buffer.samples_dropped))
+
+    def get_overruns(self):
+        """
+        :return: number of capture callbacks dropped because ring buffer was full
+        """
+        return self.ring_buffer.overruns if self.ring_buffer is not None else 0
 
     def recording_start(self, record_from=RECORD_FROM_DEVICE, recording_name=None):
         """
@@ -144,12 +200,18 @@ class AudioHandler:
         """
         # Generate filenames
         if recording_name is None:
-            recording_name = datetime.now().strftime(self.settings['timestamp_format'])
+            recording_name = datetime.now().strftime(self.settings['timestamp_format']) + self.recording_name_suffix
         logging.info('Recording into: ' + recording_name)
 
         # Create recording directory
-        if not os.path.exists(str(self.settings['recordings_directory_name']) + '/' + recording_name + '/'):
-            os.makedirs(str(self.settings['recordings_directory_name']) + '/' + recording_name + '/')
+        self.recording_dir = str(self.settings['recordings_directory_name']) + '/' + recording_name + '/'
+
+        # Decoding is repeated from the beginning, so previous fragments, slides and manifest would be duplicated
+        if record_from == RECORD_FROM_FRAMES and os.path.exists(self.recording_dir):
+            logging.warning('Recording ' + recording_name + ' already exists. Decoding it again from scratch')
+            shutil.rmtree(self.recording_dir, ignore_errors=True)
+        if not os.path.exists(self.recording_dir):
+            os.makedirs(self.recording_dir)
 
         # Create screenshots directory
         self.screenshots_dir = str(self.settings['recordings_directory_name']) + '/' + recording_name + '/' \
@@ -163,6 +225,29 @@ class AudioHandler:
         if not os.path.exists(self.audio_dir):
             os.makedirs(self.audio_dir)
 
+        # Open manifest (append-only, so restarted device recordings keep previous entries)
+        self.manifest = RecordingManifest(os.path.join(self.recording_dir, str(self.settings['manifest_file_name'])))
+        self.manifest.add_start(recording_name, record_from)
+
+        # Open single audio container (raw PCM16 mono) for appending all fragments
+        if str(self.settings['audio_storage_mode']) == AUDIO_STORAGE_MODE_CONTAINER:
+            self.container_file_name = str(self.settings['audio_container_file_name'])
+            container_file_path = os.path.join(self.audio_dir, self.container_file_name)
+            logging.info('Storing audio fragments into: ' + container_file_path)
+            self.container_file = open(container_file_path, 'ab')
+        self.fragment_active = False
+
+        # Open slides container (new file for each start, because video file can't be appended)
+        if str(self.settings['screenshot_storage_mode']) == SCREENSHOT_STORAGE_MODE_CONTAINER:
+            file_name, file_extension = os.path.splitext(str(self.settings['screenshot_container_file_name']))
+            self.slide_container_file_name = file_name + file_extension
+            index = 1
+            while os.path.exists(os.path.join(self.screenshots_dir, self.slide_container_file_name)):
+                self.slide_container_file_name = file_name + '_' + str(index) + file_extension
+                index += 1
+            self.slide_container = SlideContainerWriter(self.settings, os.path.join(self.screenshots_dir,
+                                                                                    self.slide_container_file_name))
+
         if record_from == RECORD_FROM_DEVICE:
             # Save start time
             self.recording_started_time = int(time.time() * 1000)
@@ -186,34 +271,161 @@ class AudioHandler:
             # Clear recording flag
             self.is_recording = False
 
+            # Wait for fragments being written by the writer pool
+            if self.write_future is not None:
+                try:
+                    self.write_future.result()
+                except Exception as e:
+                    logging.warning(e)
+                self.write_future = None
+
             # Close WAV file
             if self.wave_file is not None:
                 self.wave_file.close()
                 self.wave_file = None
 
+            # Close audio container
+            if self.container_file is not None:
+                self.container_file.close()
+                self.container_file = None
+            self.fragment_active = False
+
+            # Wait for slide frames and close slides container
+            if self.screenshot_future is not None:
+                try:
+                    self.screenshot_future.result()
+                except Exception as e:
+                    logging.warning(e)
+                self.screenshot_future = None
+            if self.slide_container is not None:
+                self.slide_container.close()
+                self.slide_container = None
+
             # Reset audio volume progress bar
             self.progress_bar_audio_signal.emit(-60)
 
             # Reset label background
             self.label_rec_set_stylesheet_signal.emit(NOT_RECORDING_STYLE_SHEET)
 
-    def callback(self, in_data, frame_count, time_info, status):
-        # Just skip all if not recording
-        if self.is_recording:
-            # Decode data
-            audio_data = np.fromstring(in_data, dtype=np.float32)
+    def save_screenshot(self, opencv_image, screenshot_time: int):
+        """
+        Saves screenshot into screenshots directory and appends it to the manifest
+        :param opencv_image: BGR image
+        :param screenshot_time: milliseconds from the start of recording
+        :return:
+        """
+        # Append to slides container
+        if self.slide_container is not None:
+            logging.info('Saving current screenshot into ' + self.slide_container_file_name + '...')
+
+            # Encode in shared pool (one after another to keep frames order)
+            if self.screenshot_pool is not None:
+                self.screenshot_future = self.screenshot_pool.submit(self.write_slide_frame, opencv_image,
+                                                                     self.slide_container,
+                                                                     self.slide_container_file_name, screenshot_time,
+                                                                     self.manifest, self.screenshot_future)
+            else:
+                self.write_slide_frame(opencv_image, self.slide_container, self.slide_container_file_name,
+                                       screenshot_time, self.manifest)
+            return
+
+        screenshot_name = str(screenshot_time) + SCREENSHOT_EXTENSION
+        logging.info('Saving current screenshot as ' + screenshot_name + '...')
+
+        # Encode in shared pool
+        if self.screenshot_pool is not None:
+            self.screenshot_pool.submit(self.write_screenshot, opencv_image, self.screenshots_dir, screenshot_name,
+                                        screenshot_time, self.manifest)
+        else:
+            self.write_screenshot(opencv_image, self.screenshots_dir, screenshot_name, screenshot_time, self.manifest)
 
+    def write_screenshot(self, opencv_image, screenshots_dir: str, screenshot_name: str, screenshot_time: int,
+                         manifest):
+        """
+        Encodes screenshot into file and appends it to the manifest
+        :param opencv_image: BGR image
+        :param screenshots_dir: screenshots directory of the recording
+        :param screenshot_name: name of file
+        :param screenshot_time: milliseconds from the start of recording
+        :param manifest: RecordingManifest or None
+        :return:
+        """
+        try:
+            cv2.imwrite(screenshots_dir + screenshot_name, opencv_image)
+            if manifest is not None:
+                manifest.add_screenshot(screenshot_time,
+                                        str(self.settings['screenshots_directory_name']) + '/' + screenshot_name)
+        except Exception as e:
+            logging.error('Error saving screenshot ' + screenshot_name + '! ' + str(e))
+
+    def write_slide_frame(self, opencv_image, slide_container, slide_container_file_name: str, screenshot_time: int,
+                          manifest, previous_write=None):
+        """
+        Encodes screenshot into slides container and appends it to the manifest
+        :param opencv_image: BGR image
+        :param slide_container: SlideContainerWriter of the recording
+        :param slide_container_file_name: name of slides container inside screenshots directory
+        :param screenshot_time: milliseconds from the start of recording
+        :param manifest: RecordingManifest or None
+        :param previous_write: future of previous frame of this handler (to wait for it)
+        :return:
+        """
+        if previous_write is not None:
+            try:
+                previous_write.result()
+            except Exception as e:
+                logging.warning(e)
+
+        try:
+            frame_index = slide_container.write(opencv_image, screenshot_time)
+            if frame_index >= 0 and manifest is not None:
+                manifest.add_screenshot(screenshot_time, str(self.settings['screenshots_directory_name']) + '/'
+                                        + slide_container_file_name, frame_index)
+        except Exception as e:
+            logging.error('Error saving screenshot into slides container! ' + str(e))
+
+    def callback(self, audio_data):
+        """
+        Capture backend callback. Makes mono and pushes data into ring buffer (must be as fast as possible)
+        :param audio_data: interleaved float32 samples
+        :return:
+        """
+        # Just skip all if not recording (or if backend delivers data before open_stream() created ring buffer)
+        if self.is_recording and self.ring_buffer is not None:
             # Split into channels and make mono
-            audio_data = audio_data.reshape((len(audio_data) // self.recording_channels, self.recording_channels))
-            data_per_channels = np.split(audio_data, self.recording_channels, axis=1)
-            input_data_mono = data_per_channels[0].flatten()
-            for channel_n in range(1, self.recording_channels):
-                input_data_mono = np.add(input_data_mono, data_per_channels[channel_n].flatten())
-            input_data_mono = np.divide(input_data_mono, self.recording_channels)
-            self.process_mono_data(input_data_mono)
+            if self.recording_channels > 1:
+                audio_data = audio_data.reshape((len(audio_data) // self.recording_channels,
+                                                 self.recording_channels)).mean(axis=1, dtype=np.float32)
+            self.ring_buffer.write(audio_data)
+
+    def consumer_loop(self):
+        """
+        Drains ring buffer by chunks of audio_chunk_size and processes them
+        :return:
+        """
+        chunk_size = int(self.settings['audio_chunk_size'])
+        chunk_duration = chunk_size / self.sampling_rate if self.sampling_rate > 0 else 0.01
+        while self.consumer_thread_running:
+            input_data_mono = self.ring_buffer.read(chunk_size)
+            if input_data_mono is None:
+                time.sleep(chunk_duration / 4)
+                continue
+
+            # Audio buffered before recording_stop() must not start new fragment
+            if not self.is_recording:
+                continue
+            try:
+                self.process_mono_data(input_data_mono)
+            except Exception as e:
+                logging.error(e, exc_info=True)
 
-        # Continue capturing audio
-        return in_data, pyaudio.paContinue
+        # Process last partial chunk
+        samples_left = self.ring_buffer.available()
+        if samples_left > 0 and self.is_recording:
+            try:
+                self.process_mono_data(self.ring_buffer.read(samples_left))
+            except Exception as e:
+                logging.error(e, exc_info=True)
 
     def process_mono_data(self, input_data_mono, wave_name=None):
         """
@@ -239,16 +451,21 @@ class AudioHandler:
 
         # Recording
         if self.chunks_recorded_counter < int(self.settings['audio_recording_chunks_min']):
-            if self.wave_file is None:
+            if not self.fragment_active:
                 # Start WAV file
                 if wave_name is None:
                     wave_name = str(int(time.time() * 1000) - self.recording_started_time) + WAVE_FILE_EXTENSION
-                wave_file_path = os.path.join(self.audio_dir, wave_name)
                 logging.info('Starting audio recording with name: ' + wave_name)
-                self.wave_file = wave.open(wave_file_path, 'wb')
-                self.wave_file.setnchannels(1)  # Mono
-                self.wave_file.setsampwidth(2)  # PCM16
-                self.wave_file.setframerate(int(self.settings['audio_wav_sampling_rate']))
+                self.wave_file_name = wave_name
+                self.fragment_active = True
+
+                # Fragment will be appended to the container on closing
+                if self.container_file is None:
+                    wave_file_path = os.path.join(self.audio_dir, wave_name)
+                    self.wave_file = wave.open(wave_file_path, 'wb')
+                    self.wave_file.setnchannels(1)  # Mono
+                    self.wave_file.setsampwidth(2)  # PCM16
+                    self.wave_file.setframerate(int(self.settings['audio_wav_sampling_rate']))
 
                 # Initialize temp buffer
                 self.audio_samples_temp = np.empty(0, dtype=np.int16)
@@ -264,31 +481,94 @@ class AudioHandler:
 
         # Stop recording
         else:
-            if self.wave_file is not None:
-                logging.info('Writing audio buffer to file...')
+            if self.fragment_active:
+                samples = self.audio_samples_temp
+                wave_file = self.wave_file
+                self.audio_samples_temp = np.empty(0, dtype=np.int16)
+                self.wave_file = None
+                self.fragment_active = False
 
-                # Resample buffered data
-                self.audio_samples_temp = librosa.resample(self.audio_samples_temp, orig_sr=self.sampling_rate,
-                                                           target_sr=int(self.settings['audio_wav_sampling_rate']),
-                                                           res_type=str(self.settings['audio_wav_resampling_type']))
+                # Files of current recording (they may be changed by the next recording before fragment is written)
+                destination = (self.container_file, self.container_file_name, self.manifest,
+                               self.recording_dir, self.audio_dir)
 
-                # Covert to PCM
-                self.audio_samples_temp = np.multiply(self.audio_samples_temp[: -1], PCM_MAX).astype(np.int16)
+                # Resample and write in shared pool (one after another to keep order inside the container)
+                if self.writer_pool is not None:
+                    self.write_future = self.writer_pool.submit(self.write_fragment, samples, wave_file,
+                                                                self.wave_file_name, self.sampling_rate, destination,
+                                                                self.write_future)
+                else:
+                    self.write_fragment(samples, wave_file, self.wave_file_name, self.sampling_rate, destination)
 
-                # Write to file
-                if self.wave_file is not None:
-                    self.wave_file.writeframesraw(self.audio_samples_temp.tobytes())
+                # Set label background
+                self.label_rec_set_stylesheet_signal.emit(NOT_RECORDING_STYLE_SHEET)
 
-                # Clear buffer
-                self.audio_samples_temp = np.empty(0, dtype=np.int16)
+    def write_fragment(self, samples, wave_file, wave_file_name: str, sampling_rate: int, destination: tuple,
+                       previous_write=None):
+        """
+        Resamples fragment, writes it into WAV file or container and appends it to the manifest
+        :param samples: numpy 1D array of floats
+        :param wave_file: opened wave file or None if writing into container
+        :param wave_file_name: name of fragment (time in milliseconds + extension)
+        :param sampling_rate: sampling rate of samples
+        :param destination: (container file or None, container file name, manifest, recording dir, audio dir)
+        :param previous_write: future of previous write of this handler (to wait for it)
+        :return:
+        """
+        container_file, container_file_name, manifest, recording_dir, audio_dir = destination
+        if previous_write is not None:
+            try:
+                previous_write.result()
+            except Exception as e:
+                logging.warning(e)
 
-                # Close file
-                logging.info('Closing file')
-                self.wave_file.close()
-                self.wave_file = None
+        logging.info('Writing audio buffer to file...')
 
-                # Collect garbage
-                gc.collect()
+        # Resample buffered data (tab capture is already at target rate)
+        if sampling_rate != int(self.settings['audio_wav_sampling_rate']):
+            samples = librosa.resample(samples, orig_sr=sampling_rate,
+                                       target_sr=int(self.settings['audio_wav_sampling_rate']),
+                                       res_type=str(self.settings['audio_wav_resampling_type']))
 
-                # Set label background
-                self.label_rec_set_stylesheet_signal.emit(NOT_RECORDING_STYLE_SHEET)
+        # Covert to PCM
+        samples = samples[: -1]
+        peak_dbfs, rms_dbfs = samples_levels_dbfs(samples)
+        samples = np.multiply(samples, PCM_MAX).astype(np.int16)
+
+        # Write to container
+        fragment_offset = -1
+        if container_file is not None:
+            fragment_offset = container_file.tell() // 2
+            container_file.write(samples.tobytes())
+            container_file.flush()
+            fragment_file = container_file_name
+
+        # Write to file
+        else:
+            if wave_file is not None:
+                wave_file.writeframesraw(samples.tobytes())
+            fragment_file = wave_file_name
+
+        # Append fragment to the manifest (it's also the index of the container)
+        if manifest is not None:
+            manifest.add_audio(int(os.path.splitext(wave_file_name)[0]),
+                               str(self.settings['audio_directory_name']) + '/' + fragment_file,
+                               int(self.settings['audio_wav_sampling_rate']),
+                               len(samples), peak_dbfs, rms_dbfs,
+                               offset=fragment_offset)
+
+        # Close file
+        logging.info('Closing file')
+        if wave_file is not None:
+            wave_file.close()
+
+        # Transcribe closed fragment in background (silent fragments are skipped by LectureBuilder too)
+        if self.background_transcriber is not None and len(samples) > 0 \
+                and rms_dbfs >= float(self.settings['manifest_silence_threshold_dbfs']):
+            self.background_transcriber.submit(recording_dir,
+                                               [int(os.path.splitext(wave_file_name)[0]),
+                                                os.path.join(audio_dir, fragment_file),
+                                                len(samples) * 2, fragment_offset, len(samples)])
+
+        # Collect garbage
+        gc.collect()
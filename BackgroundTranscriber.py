@@ -0,0 +1,123 @@
+"""
+ Copyright (C) 2022 Fern Lane, Webinar-hacker
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+import logging
+import os
+import queue
+import threading
+
+from CallbackSignal import CallbackSignal
+from LectureBuilder import LectureBuilder, transcript_cache_file, load_cached_transcript, save_cached_transcript
+
+
+def lower_thread_priority(nice: int):
+    """
+    Lowers priority of current thread, so transcription doesn't disturb recording
+    :param nice: niceness to add (0 - don't change priority)
+    :return:
+    """
+    if nice <= 0:
+        return
+    try:
+        # Linux (thread id is also the process id for setpriority)
+        if hasattr(os, 'setpriority'):
+            thread_id = threading.get_native_id()
+            os.setpriority(os.PRIO_PROCESS, thread_id, os.getpriority(os.PRIO_PROCESS, thread_id) + nice)
+
+        # Windows
+        elif os.name == 'nt':
+            import ctypes
+            kernel32 = ctypes.windll.kernel32
+            kernel32.SetThreadPriority(kernel32.GetCurrentThread(), -2 if nice >= 10 else -1)
+    except Exception as e:
+        logging.warning('Error lowering transcriber thread priority! ' + str(e))
+
+
+class BackgroundTranscriber:
+    def __init__(self, settings):
+        """
+        Transcribes audio fragments while recording, as soon as they are closed
+        Results are stored in transcripts directory of the recording and reused by LectureBuilder
+        :param settings: settings dictionary
+        """
+        self.settings = settings
+        self.lecture_builder = LectureBuilder(settings, CallbackSignal(), CallbackSignal(), CallbackSignal(),
+                                              CallbackSignal(), CallbackSignal(), CallbackSignal())
+        self.fragments_queue = queue.Queue()
+        self.thread = None
+        self.thread_running = False
+
+    def start(self):
+        """
+        Starts transcriber thread
+        :return:
+        """
+        if self.thread is None:
+            self.thread_running = True
+            self.thread = threading.Thread(target=self.transcriber_loop)
+            self.thread.start()
+            logging.info('Background transcriber thread: ' + self.thread.name)
+
+    def stop(self):
+        """
+        Stops transcriber thread (fragments left in queue will be transcribed during build)
+        :return:
+        """
+        self.thread_running = False
+        self.fragments_queue.put(None)
+        if self.thread is not None:
+            try:
+                self.thread.join()
+                self.thread = None
+            except Exception as e:
+                logging.warning('Error joining background transcriber thread ' + str(e))
+
+    def submit(self, lecture_directory: str, audio_file_: list):
+        """
+        Queues closed audio fragment
+        :param lecture_directory: example recordings/DD_MM_YYYY__HH_MM_SS
+        :param audio_file_: [time, path, size, offset, samples]
+        :return:
+        """
+        if self.thread_running:
+            self.fragments_queue.put((lecture_directory, audio_file_))
+
+    def transcriber_loop(self):
+        """
+        Transcribes queued fragments with reduced priority
+        :return:
+        """
+        lower_thread_priority(int(self.settings['background_transcription_nice']))
+
+        while self.thread_running:
+            fragment = self.fragments_queue.get()
+            if fragment is None:
+                break
+            lecture_directory, audio_file_ = fragment
+            cache_file = transcript_cache_file(self.settings, lecture_directory, audio_file_)
+            if load_cached_transcript(cache_file) is not None:
+                continue
+            try:
+                logging.info('Background transcribing ' + str(audio_file_[1]) + ' at ' + str(audio_file_[0]) + 'ms')
+                save_cached_transcript(cache_file, self.lecture_builder.transcribe(audio_file_))
+            except Exception as e:
+                logging.error('Error transcribing ' + str(audio_file_[1]) + ' in background! ' + str(e))
+
+            # Let model manager unload models when there is nothing to transcribe
+            if self.fragments_queue.empty():
+                self.lecture_builder.release_models()
+
+        logging.info('Background transcriber thread finished')
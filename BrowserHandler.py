@@ -16,21 +16,23 @@
 """
 
 import base64
+import json
 import logging
+import os
 import threading
 import time
 
 import cv2
 import numpy as np
 from PyQt5 import QtCore
-from PyQt5.QtGui import QPixmap, QImage
-from qt_thread_updater import get_updater
 from selenium import webdriver
 from selenium.webdriver import Keys
 from selenium.webdriver.common.alert import Alert
 from selenium.webdriver.common.by import By
 from webdriver_manager.chrome import ChromeDriverManager
 
+from ScreenshotProcessor import ScreenshotProcessor, show_preview
+
 HANDLER_STAGE_LOGIN = 0
 HANDLER_STAGE_SEND_HELLO_MESSAGE = 1
 HANDLER_STAGE_IDLE = 2
@@ -38,26 +40,403 @@ HANDLER_STAGE_IDLE = 2
 LINK_TYPE_WEBINAR = 0
 LINK_TYPE_ZOOM = 1
 
-SCREENSHOT_EXTENSION = '.png'
-
 DISCONNECTED_MSG_LOWER = 'disconnected: not connected to devtools'
 DISCONNECTED_EXCEPTION_LOWER = 'already closed'
 
-SAVING_TEXT_COLOR = (85, 85, 217)
-
-
-def resize_keep_ratio(source_image, target_width, target_height, interpolation=cv2.INTER_AREA):
+# Names of persistent chrome profiles for each link type
+PROFILE_NAMES = {LINK_TYPE_WEBINAR: 'webinar', LINK_TYPE_ZOOM: 'zoom'}
+
+# Chromedriver path resolved once per process
+chrome_driver_path = None
+chrome_driver_lock = threading.Lock()
+
+# Profile directories used by running browsers (chrome can't share one profile between instances)
+profiles_in_use = set()
+profiles_lock = threading.Lock()
+
+# CSS selectors counted by the state probe on each loop cycle
+PROBE_SELECTORS = {
+    # Webinar
+    'prepare_buttons': '#prepare-vcs .btn',
+    'popover_buttons': '.popover .btn-link',
+    'stream_main': '.stream-main',
+    'before_event_page': '.BeforeEventPage-module__main___xpKQX',
+    'form_buttons': '.modal-footer',
+    'page_connect_buttons': '.event-btns .btn',
+    'name_inputs': '.input-field input',
+    'chat_inputs': '.editable-input div[data-placeholder]',
+    'attention_buttons': '.layer_over .btn',
+    'attention_close_buttons': '.layer_over .btn-link',
+
+    # Zoom
+    'zoom_feedback_or_errors': '.feedback-wrap.hideme.row, .error-message',
+    'zoom_join_audio_buttons': '.zm-btn.join-audio-by-voip__join-btn',
+    'zoom_modal_buttons': '.zm-modal button',
+    'zoom_leave_buttons': '.footer__leave-btn-container',
+    'zoom_name_inputs': '#inputname',
+    'zoom_join_buttons': '#joinBtn',
+    'zoom_preview_audio_buttons': '#preview-audio-control-button',
+    'zoom_preview_join_buttons': '.preview-join-button',
+    'zoom_chat_text_areas': '.chat-box__chat-textarea',
+    'zoom_chat_buttons': '.footer-chat-button',
+    'zoom_more_buttons': '#moreButton'
+}
+
+# Returns compact state of the page in one WebDriver round trip
+# arguments[0] - PROBE_SELECTORS, arguments[1] - link type
+STATE_PROBE_SCRIPT = '''
+var selectors = arguments[0];
+var linkType = arguments[1];
+var state = {counts: {}, finished: false, screenshot_rect: null};
+for (var name in selectors) {
+    state.counts[name] = document.querySelectorAll(selectors[name]).length;
+}
+
+function modalFinished(selector) {
+    var title = document.querySelector(selector);
+    if (!title) return false;
+    var html = title.innerHTML.toLowerCase();
+    return html.indexOf('ended') >= 0 || html.indexOf('finished') >= 0 || html.indexOf('завершен') >= 0;
+}
+
+function textFinished(selector, text) {
+    var elements = document.querySelectorAll(selector);
+    for (var i = 0; i < elements.length; i++) {
+        if (elements[i].textContent.indexOf(text) >= 0) return true;
+    }
+    return false;
+}
+
+var screenshotElement = null;
+if (linkType === %d) {
+    // Check only elements that can contain finish screen instead of serializing the whole page
+    state.finished = document.querySelector('[class*="AfterMeetingScreenContent"]') !== null
+        || document.querySelector('[class*="event_stopped"], [id*="event_stopped"]') !== null
+        || location.href.indexOf('event_stopped') >= 0
+        || textFinished('h1, h2, h3, [class*="title"], [class*="Title"]', 'Встреча завершена')
+        // Finish screens with other markup (textContent doesn't need layout, unlike innerText)
+        || (document.body !== null && document.body.textContent.indexOf('Встреча завершена') >= 0);
+    screenshotElement = document.querySelector('.stream-screensharing video');
+} else if (linkType === %d) {
+    state.finished = modalFinished('.zm-modal-body-title') || modalFinished('.zm-modal2-body-title')
+        || state.counts['zoom_feedback_or_errors'] > 0;
+    state.chat_menu_items = 0;
+    var items = document.getElementsByTagName('li');
+    for (var i = 0; i < items.length; i++) {
+        if (items[i].innerHTML.toLowerCase().indexOf('chat') >= 0) state.chat_menu_items++;
+    }
+    screenshotElement = document.getElementById('sharee-container-canvas');
+}
+
+if (screenshotElement) {
+    var rect = screenshotElement.getBoundingClientRect();
+    if (rect.width > 0 && rect.height > 0) {
+        state.screenshot_rect = {x: rect.left + window.scrollX, y: rect.top + window.scrollY,
+                                 width: rect.width, height: rect.height, scale: window.devicePixelRatio || 1};
+    }
+}
+return state;
+''' % (LINK_TYPE_WEBINAR, LINK_TYPE_ZOOM)
+
+# Elements that must wake up handler loop as soon as they appear
+DOM_EVENT_SELECTORS = {
+    'attention_overlay': '.layer_over',
+    'popover': '.popover',
+    'prepare_form': '#prepare-vcs',
+    'login_form': '.modal-footer',
+    'stream': '.stream-main, .footer__leave-btn-container',
+    'screen_sharing': '.stream-screensharing, #sharee-container-canvas',
+    'modal': '.zm-modal, .zm-modal2-body-title',
+    'event_finished': '[class*="AfterMeetingScreenContent"], .feedback-wrap, .error-message'
+}
+
+# Installs MutationObserver that queues names of DOM_EVENT_SELECTORS which appeared on the page
+DOM_EVENTS_OBSERVER_SCRIPT = '''
+(function () {
+    if (window.__webinarHackerEvents !== undefined) return;
+    var selectors = %s;
+    window.__webinarHackerEvents = [];
+    window.__webinarHackerWaiter = null;
+    window.__webinarHackerDrain = function () {
+        var events = window.__webinarHackerEvents;
+        window.__webinarHackerEvents = [];
+        return events;
+    };
+
+    // Calls callback with events as soon as any event is queued or with empty list after timeout
+    window.__webinarHackerWait = function (timeout, callback) {
+        if (window.__webinarHackerEvents.length > 0) {
+            callback(window.__webinarHackerDrain());
+            return;
+        }
+        var timer = setTimeout(function () {
+            window.__webinarHackerWaiter = null;
+            callback([]);
+        }, timeout);
+        window.__webinarHackerWaiter = function () {
+            clearTimeout(timer);
+            window.__webinarHackerWaiter = null;
+            callback(window.__webinarHackerDrain());
+        };
+    };
+    function queue(name) {
+        if (window.__webinarHackerEvents.indexOf(name) < 0) window.__webinarHackerEvents.push(name);
+        if (window.__webinarHackerWaiter) window.__webinarHackerWaiter();
+    }
+    function observe() {
+        new MutationObserver(function (mutations) {
+            for (var i = 0; i < mutations.length; i++) {
+                var nodes = mutations[i].addedNodes;
+                for (var j = 0; j < nodes.length; j++) {
+                    if (nodes[j].nodeType !== 1) continue;
+                    for (var name in selectors) {
+                        if (nodes[j].matches(selectors[name]) || nodes[j].querySelector(selectors[name])) queue(name);
+                    }
+                }
+            }
+        }).observe(document.documentElement, {childList: true, subtree: true});
+    }
+    if (document.documentElement) observe();
+    else document.addEventListener('DOMContentLoaded', observe);
+})();
+''' % json.dumps(DOM_EVENT_SELECTORS)
+
+# Captures sound of all media elements of the tab at 16kHz and posts PCM16 chunks to TabAudioBackend
+# If Content-Security-Policy of the page blocks requests to the backend, chunks are queued as base64 strings
+# and pulled by handler loop (TAB_AUDIO_DRAIN_SCRIPT)
+# %s - backend url, %d - chunk size in samples, %d - maximum number of queued chunks
+TAB_AUDIO_CAPTURE_SCRIPT = '''
+(function () {
+    if (window.__webinarHackerAudio !== undefined) return;
+    window.__webinarHackerAudio = true;
+    window.__webinarHackerAudioBlocked = false;
+    window.__webinarHackerAudioQueue = [];
+    var url = '%s';
+    var queueMax = %d;
+    var context = null;
+    var processor = null;
+    var sending = Promise.resolve();
+
+    document.addEventListener('securitypolicyviolation', function (event) {
+        if (event.blockedURI && url.indexOf(event.blockedURI) === 0 && !window.__webinarHackerAudioBlocked) {
+            window.__webinarHackerAudioBlocked = true;
+            console.warn('Tab audio requests are blocked by ' + event.violatedDirective);
+        }
+    });
+
+    function start() {
+        // Browser resamples everything to the context rate, so no resampling is needed in Python
+        context = new AudioContext({sampleRate: 16000});
+        processor = context.createScriptProcessor(%d, 1, 1);
+        processor.onaudioprocess = function (event) {
+            var input = event.inputBuffer.getChannelData(0);
+            var pcm = new Int16Array(input.length);
+            for (var i = 0; i < input.length; i++) {
+                var sample = Math.max(-1, Math.min(1, input[i]));
+                pcm[i] = sample < 0 ? sample * 32768 : sample * 32767;
+            }
+
+            // Requests are blocked. Keep chunks for handler loop
+            if (window.__webinarHackerAudioBlocked) {
+                if (window.__webinarHackerAudioQueue.length < queueMax) {
+                    window.__webinarHackerAudioQueue.push(
+                        btoa(String.fromCharCode.apply(null, new Uint8Array(pcm.buffer))));
+                }
+                return;
+            }
+
+            // Send chunks one after another to keep their order
+            sending = sending.then(function () {
+                return fetch(url, {method: 'POST', body: pcm.buffer,
+                                   headers: {'Content-Type': 'application/octet-stream'}});
+            }).catch(function () {});
+        };
+        processor.connect(context.destination);
+    }
+
+    function attach(element) {
+        var stream = element.srcObject;
+        if (element.__webinarHackerSource !== undefined && element.__webinarHackerStream === stream) return;
+        try {
+            var source;
+            // WebRTC streams
+            if (stream && stream.getAudioTracks && stream.getAudioTracks().length > 0) {
+                source = context.createMediaStreamSource(stream);
+            }
+            // Regular media (reroutes playback into context, so connect it to the speakers too)
+            else if (!stream && element.__webinarHackerSource === undefined) {
+                source = context.createMediaElementSource(element);
+                source.connect(context.destination);
+            }
+            else return;
+            source.connect(processor);
+            element.__webinarHackerSource = source;
+            element.__webinarHackerStream = stream;
+        } catch (e) {}
+    }
+
+    setInterval(function () {
+        if (context === null) start();
+        if (context.state === 'suspended') context.resume();
+        document.querySelectorAll('audio, video').forEach(attach);
+    }, 1000);
+})();
+'''
+
+# Videos that must keep rendering in low-resource mode
+LITE_MODE_KEEP_VIDEOS_SELECTOR = '.stream-screensharing video'
+
+# Throttles animations and stops rendering of participant videos without touching audio
+LITE_MODE_SCRIPT = '''
+(function () {
+    if (window.__webinarHackerLite !== undefined) return;
+    window.__webinarHackerLite = true;
+    var keepSelector = %s;
+    var frameInterval = 1000 / %d;
+
+    // Limit animation frame rate. Ids of deferred frames change, so page gets stable ids of its own
+    var requestAnimationFrame = window.requestAnimationFrame.bind(window);
+    var cancelAnimationFrame = window.cancelAnimationFrame.bind(window);
+    var lastFrame = 0;
+    var nextFrameId = 1;
+    var frameIds = {};
+    window.requestAnimationFrame = function (callback) {
+        var frameId = nextFrameId++;
+        frameIds[frameId] = requestAnimationFrame(function wait(timestamp) {
+            // All callbacks of the allowed frame run in it
+            if (timestamp !== lastFrame && timestamp - lastFrame < frameInterval) {
+                frameIds[frameId] = requestAnimationFrame(wait);
+                return;
+            }
+            delete frameIds[frameId];
+            lastFrame = timestamp;
+            callback(timestamp);
+        });
+        return frameId;
+    };
+    window.cancelAnimationFrame = function (frameId) {
+        if (frameIds[frameId] !== undefined) {
+            cancelAnimationFrame(frameIds[frameId]);
+            delete frameIds[frameId];
+        }
+    };
+
+    // Hide participant videos
+    var style = document.createElement('style');
+    style.textContent = 'video:not(' + keepSelector + ') {visibility: hidden !important;}';
+
+    // Video tracks disabled by this script (enabled again if they become screen sharing)
+    var disabledTracks = new Set();
+
+    function videoTracks(element) {
+        var stream = element.srcObject;
+        return stream && stream.getVideoTracks ? stream.getVideoTracks() : null;
+    }
+
+    setInterval(function () {
+        if (!style.isConnected && document.head) document.head.appendChild(style);
+        var videos = document.querySelectorAll('video');
+
+        // Tracks of kept videos must stay enabled
+        var keptTracks = new Set();
+        videos.forEach(function (element) {
+            if (element.matches(keepSelector)) (videoTracks(element) || []).forEach(function (track) {
+                keptTracks.add(track);
+                if (disabledTracks.delete(track)) track.enabled = true;
+            });
+        });
+
+        videos.forEach(function (element) {
+            if (element.matches(keepSelector)) return;
+            var tracks = videoTracks(element);
+            // WebRTC streams: disable only video tracks, audio keeps playing
+            if (tracks) {
+                tracks.forEach(function (track) {
+                    if (track.enabled && !keptTracks.has(track)) {
+                        track.enabled = false;
+                        disabledTracks.add(track);
+                    }
+                });
+            }
+            // Regular media without sound can be paused
+            else if (!element.srcObject && (element.muted || element.volume === 0) && !element.paused) {
+                element.pause();
+            }
+        });
+    }, 1000);
+})();
+'''
+
+# Returns chunks queued by TAB_AUDIO_CAPTURE_SCRIPT or null if requests to the backend are not blocked
+TAB_AUDIO_DRAIN_SCRIPT = '''
+if (!window.__webinarHackerAudioBlocked) return null;
+var chunks = window.__webinarHackerAudioQueue;
+window.__webinarHackerAudioQueue = [];
+return chunks;
+'''
+
+# Blocks (asynchronously) until first DOM event or timeout. Returns null if observer is not installed
+# arguments[0] - timeout in milliseconds
+DOM_EVENTS_WAIT_SCRIPT = '''
+var callback = arguments[arguments.length - 1];
+if (!window.__webinarHackerWait) callback(null);
+else window.__webinarHackerWait(arguments[0], callback);
+'''
+
+
+def get_chrome_driver_path(settings):
+    """
+    Returns chromedriver path from settings or resolves it with ChromeDriverManager only once per process
+    :param settings: settings dictionary
+    :return: path to chromedriver executable
+    """
+    global chrome_driver_path
+    with chrome_driver_lock:
+        if chrome_driver_path is None:
+            # Pinned driver (don't download another one if it is missing, setup can be offline)
+            pinned_path = str(settings['chrome_driver_path']).strip()
+            if len(pinned_path) > 0:
+                if not os.path.exists(pinned_path):
+                    logging.error('Pinned chromedriver ' + pinned_path + ' not exists!')
+                    raise FileNotFoundError('Pinned chromedriver ' + pinned_path + ' not exists')
+                chrome_driver_path = pinned_path
+
+            # Download or find cached driver
+            else:
+                time_started = time.time()
+                chrome_driver_path = ChromeDriverManager().install()
+                logging.info('Chromedriver resolved in ' + str(int((time.time() - time_started) * 1000)) + ' ms')
+            logging.info('Chromedriver: ' + chrome_driver_path)
+        return chrome_driver_path
+
+
+def acquire_profile_dir(settings, link_type: int):
+    """
+    Reserves persistent profile directory for specified link type
+    :param settings: settings dictionary
+    :param link_type: LINK_TYPE_WEBINAR or LINK_TYPE_ZOOM
+    :return: absolute path to profile directory (suffixed if main one is already used by another browser)
     """
-    Resize image and keeps aspect ratio (background fills with black)
+    profile_dir = os.path.abspath(os.path.join(str(settings['browser_profiles_dir']),
+                                               PROFILE_NAMES.get(link_type, 'default')))
+    with profiles_lock:
+        profile_dir_ = profile_dir
+        index = 1
+        while profile_dir_ in profiles_in_use:
+            profile_dir_ = profile_dir + '_' + str(index)
+            index += 1
+        profiles_in_use.add(profile_dir_)
+    return profile_dir_
+
+
+def release_profile_dir(profile_dir: str):
     """
-    border_v = 0
-    border_h = 0
-    if (target_height / target_width) >= (source_image.shape[0] / source_image.shape[1]):
-        border_v = int((((target_height / target_width) * source_image.shape[1]) - source_image.shape[0]) / 2)
-    else:
-        border_h = int((((target_width / target_height) * source_image.shape[0]) - source_image.shape[1]) / 2)
-    output_image = cv2.copyMakeBorder(source_image, border_v, border_v, border_h, border_h, cv2.BORDER_CONSTANT, 0)
-    return cv2.resize(output_image, (target_width, target_height), interpolation)
+    Releases profile directory reserved by acquire_profile_dir()
+    :param profile_dir: path returned by acquire_profile_dir()
+    :return:
+    """
+    with profiles_lock:
+        profiles_in_use.discard(profile_dir)
 
 
 class BrowserHandler:
@@ -73,11 +452,20 @@ class BrowserHandler:
         self.label_current_link_time_signal = label_current_link_time_signal
 
         self.browser = None  # webdriver.Chrome()
+        self.scripts_identifiers = []
+        self.link_origin = ''
+        self.script_timeout = 0.
+        self.tab_audio_blocked = False
+        self.profile_dir = ''
+        self.profile_link_type = -1
         self.handler_loop_running = False
+        self.handler_thread = None
+        self.time_link_opened = 0
+        self.first_screenshot_latency_ms = -1
 
         self.link_type = -1
         self.user_name = ''
-        self.opencv_image_prev = None
+        self.screenshot_processor = ScreenshotProcessor(settings)
 
     def start_browser(self, link: str):
         """
@@ -110,8 +498,14 @@ class BrowserHandler:
             self.stop_browser_and_recording.emit(False)
             return
 
+        # Warm browser was started with profile of another platform
+        if self.browser is not None and self.settings['browser_profiles_enabled'] \
+                and self.profile_link_type != self.link_type:
+            self.stop_browser()
+
         if self.browser is None:
             logging.info('Starting browser... Please wait')
+            time_started = time.time()
             chrome_options = webdriver.ChromeOptions()
             proxy = str(self.settings['gui_proxy']).strip()
             if len(proxy) > 0:
@@ -123,6 +517,35 @@ class BrowserHandler:
             chrome_options.add_argument('--disable-default-apps')
             chrome_options.add_argument('--disable-notifications')
             chrome_options.add_argument('--disable-popup-window')
+
+            # Allow audio context to start without user gesture (for tab audio capture)
+            chrome_options.add_argument('--autoplay-policy=no-user-gesture-required')
+
+            # Low-resource mode: fixed size off-screen (or headless) window with reduced rendering
+            if self.settings['browser_lite_mode_enabled']:
+                chrome_options.add_argument('--window-size=' + str(int(self.settings['browser_lite_window_width']))
+                                            + ',' + str(int(self.settings['browser_lite_window_height'])))
+                if self.settings['browser_lite_headless']:
+                    chrome_options.add_argument('--headless=new')
+                else:
+                    chrome_options.add_argument('--window-position=-32000,-32000')
+                chrome_options.add_argument('--disable-smooth-scrolling')
+                chrome_options.add_argument('--disable-threaded-animation')
+                chrome_options.add_argument('--force-prefers-reduced-motion')
+                chrome_options.add_argument('--force-device-scale-factor=1')
+
+                # Off-screen window must not be throttled, otherwise screenshots and tab audio stall
+                chrome_options.add_argument('--disable-backgrounding-occluded-windows')
+                chrome_options.add_argument('--disable-renderer-backgrounding')
+                chrome_options.add_argument('--disable-features=CalculateNativeWinOcclusion')
+
+            # Persistent profile to keep platform assets in HTTP cache
+            if self.settings['browser_profiles_enabled']:
+                self.profile_dir = acquire_profile_dir(self.settings, self.link_type)
+                self.profile_link_type = self.link_type
+                logging.info('Using profile: ' + self.profile_dir)
+                chrome_options.add_argument('--user-data-dir=' + self.profile_dir)
+
             # Pass the argument 1 to allow and 2 to block
             chrome_options.add_experimental_option("prefs", {
                 "profile.default_content_setting_values.media_stream_mic": 2,
@@ -132,21 +555,133 @@ class BrowserHandler:
             })
 
             # Start browser
-            self.browser = webdriver.Chrome(ChromeDriverManager().install(), chrome_options=chrome_options)
-            self.browser.get(link)
+            try:
+                self.browser = webdriver.Chrome(get_chrome_driver_path(self.settings), chrome_options=chrome_options)
+                self.script_timeout = 0.
+            except Exception:
+                self.release_profile()
+                raise
+            self.scripts_identifiers = []
+            logging.info('Browser started in ' + str(int((time.time() - time_started) * 1000)) + ' ms')
+
+            # Keep only HTTP cache of the profile
+            if len(self.profile_dir) > 0:
+                try:
+                    self.browser.execute_cdp_cmd('Network.clearBrowserCookies', {})
+                except Exception as e:
+                    logging.warning(e)
+
+        # Reuse warm browser
+        else:
+            logging.info('Reusing running browser')
+
+        # (Re)install scripts, because audio capture url changes with every audio stream
+        self.install_scripts()
+
+        self.time_link_opened = time.time()
+        self.first_screenshot_latency_ms = -1
+        self.browser.get(link)
+        self.link_origin = '/'.join(link.split('/')[: 3])
+
+    def install_scripts(self):
+        """
+        Removes previously installed scripts and installs DOM observer, low-resource mode and tab audio capture
+        into every new document
+        :return:
+        """
+        for script_identifier in self.scripts_identifiers:
+            try:
+                self.browser.execute_cdp_cmd('Page.removeScriptToEvaluateOnNewDocument',
+                                             {'identifier': script_identifier})
+            except Exception as e:
+                logging.warning(e)
+        self.scripts_identifiers = []
+
+        scripts = []
 
-    def stop_browser(self):
+        # DOM observer
+        if self.settings['dom_events_enabled']:
+            scripts.append(DOM_EVENTS_OBSERVER_SCRIPT)
+
+        # Low-resource mode
+        if self.settings['browser_lite_mode_enabled']:
+            scripts.append(LITE_MODE_SCRIPT % (json.dumps(LITE_MODE_KEEP_VIDEOS_SELECTOR),
+                                               max(int(self.settings['browser_lite_animation_fps']), 1)))
+
+        # Capture tab audio into this session's audio handler
+        tab_audio_url = getattr(self.audio_handler.capture_backend, 'url', None)
+        if tab_audio_url:
+            scripts.append(TAB_AUDIO_CAPTURE_SCRIPT % (tab_audio_url, int(self.settings['audio_chunk_size']),
+                                                       int(self.settings['audio_tab_capture_queue_max_chunks'])))
+
+        for script in scripts:
+            try:
+                self.scripts_identifiers.append(self.browser.execute_cdp_cmd('Page.addScriptToEvaluateOnNewDocument',
+                                                                             {'source': script})['identifier'])
+            except Exception as e:
+                logging.warning('Error installing script! ' + str(e))
+
+    def reset_browser(self):
+        """
+        Resets state of the browser without restarting it (closes extra tabs and clears storage of the last link)
+        :return: True if reset or False if browser must be restarted
+        """
+        try:
+            logging.info('Resetting browser...')
+            # Close extra tabs
+            window_handles = self.browser.window_handles
+            for window_handle in window_handles[1:]:
+                self.browser.switch_to.window(window_handle)
+                self.browser.close()
+            self.browser.switch_to.window(window_handles[0])
+
+            # Leave meeting page
+            self.browser.get('about:blank')
+
+            # Clear cookies and storage (but keep HTTP cache)
+            self.browser.execute_cdp_cmd('Network.clearBrowserCookies', {})
+            if len(self.link_origin) > 0:
+                self.browser.execute_cdp_cmd('Storage.clearDataForOrigin', {
+                    'origin': self.link_origin,
+                    'storageTypes': 'local_storage,session_storage,indexeddb,websql,service_workers,cache_storage'
+                })
+            return True
+        except Exception as e:
+            logging.warning('Error resetting browser! ' + str(e))
+            return False
+
+    def stop_browser(self, keep_warm=False):
         """
         Closes browser
+        :param keep_warm: True to keep browser running for the next link (only resets it)
         :return:
         """
+        # Wait for handler to exit before touching browser
+        if self.handler_thread is not None and self.handler_thread != threading.current_thread():
+            self.handler_thread.join(timeout=float(self.settings['loop_interval_seconds']) * 2)
+        self.handler_thread = None
+
+        if keep_warm and self.browser is not None and self.reset_browser():
+            return
+
         try:
             if self.browser is not None:
                 logging.info('Closing browser... Please wait')
                 self.browser.quit()
-                self.browser = None
         except Exception as e:
             logging.warning(e)
+        self.browser = None
+        self.release_profile()
+
+    def release_profile(self):
+        """
+        Releases persistent profile directory so other browsers can use it
+        :return:
+        """
+        if len(self.profile_dir) > 0:
+            release_profile_dir(self.profile_dir)
+            self.profile_dir = ''
+            self.profile_link_type = -1
 
     def start_handler(self, user_name: str):
         """
@@ -158,13 +693,13 @@ class BrowserHandler:
         self.user_name = user_name
 
         # Clear previous image
-        self.opencv_image_prev = None
+        self.screenshot_processor.reset()
 
         # Start webinar handler
         self.handler_loop_running = True
-        thread = threading.Thread(target=self.handler_loop)
-        thread.start()
-        logging.info('Webinar handler thread: ' + thread.name)
+        self.handler_thread = threading.Thread(target=self.handler_loop)
+        self.handler_thread.start()
+        logging.info('Webinar handler thread: ' + self.handler_thread.name)
 
         # Restart current time label
         self.label_current_link_time_signal.emit('Current link time: 00:00:00')
@@ -179,6 +714,133 @@ class BrowserHandler:
         # Restart current time label
         self.label_current_link_time_signal.emit('Current link time: 00:00:00')
 
+    def wait_for_dom_events(self, timeout_seconds: float):
+        """
+        Waits for next loop cycle and returns earlier if any of DOM_EVENT_SELECTORS appeared on the page
+        :param timeout_seconds: maximum time to wait
+        :return: list of event names or empty list if timed out
+        """
+        time_end = time.time() + timeout_seconds
+        if not self.settings['dom_events_enabled']:
+            time.sleep(timeout_seconds)
+            return []
+
+        # Long waits are split, so stop_handler() doesn't wait for the whole timeout
+        wait_max = float(self.settings['dom_events_wait_max_seconds'])
+        while self.handler_loop_running and time.time() < time_end:
+            wait_seconds = max(min(wait_max, time_end - time.time()), 0)
+            try:
+                # Script timeout must be longer than waiting inside the page
+                script_timeout = wait_max + 5.
+                if self.script_timeout != script_timeout:
+                    self.browser.set_script_timeout(script_timeout)
+                    self.script_timeout = script_timeout
+
+                events = self.browser.execute_async_script(DOM_EVENTS_WAIT_SCRIPT, int(wait_seconds * 1000))
+
+                # Observer is not installed in this document (for example, page was opened before)
+                if events is None:
+                    self.browser.execute_script(DOM_EVENTS_OBSERVER_SCRIPT)
+
+                elif len(events) > 0:
+                    logging.info('DOM events: ' + ', '.join(events))
+                    return events
+
+            # Page is reloading
+            except:
+                time.sleep(wait_seconds)
+        return []
+
+    def drain_tab_audio(self):
+        """
+        Pulls tab audio chunks queued by TAB_AUDIO_CAPTURE_SCRIPT when Content-Security-Policy blocks requests
+        :return:
+        """
+        capture_backend = self.audio_handler.capture_backend
+        if not hasattr(capture_backend, 'push_pcm16'):
+            return
+        try:
+            chunks = self.browser.execute_script(TAB_AUDIO_DRAIN_SCRIPT)
+            if chunks is None:
+                return
+            if not self.tab_audio_blocked:
+                self.tab_audio_blocked = True
+                logging.warning('Page blocks requests to tab audio server. Pulling audio by WebDriver instead')
+            for chunk in chunks:
+                capture_backend.push_pcm16(base64.b64decode(chunk))
+        except Exception as e:
+            logging.warning('Error pulling tab audio! ' + str(e))
+
+    def probe_state(self):
+        """
+        Collects state of the page (existing elements, finished flag, screenshot element rect) in one JS call
+        :return: dictionary from STATE_PROBE_SCRIPT
+        """
+        return self.browser.execute_script(STATE_PROBE_SCRIPT, PROBE_SELECTORS, self.link_type)
+
+    def click_elements(self, selector_name: str, first_only=False):
+        """
+        Clicks on elements found by selector from PROBE_SELECTORS
+        :param selector_name: key of PROBE_SELECTORS
+        :param first_only: True to click only on the first element
+        :return:
+        """
+        elements = self.browser.find_elements(By.CSS_SELECTOR, PROBE_SELECTORS[selector_name])
+        if first_only:
+            elements = elements[: 1]
+        for element in elements:
+            element.click()
+
+    def type_user_name(self, name_field):
+        """
+        Replaces text in name field with self.user_name and presses enter
+        :param name_field: input element
+        :return:
+        """
+        logging.info('Typing ' + self.user_name + ' into name field...')
+        name_field.click()
+        for _ in range(len(self.user_name)):
+            name_field.send_keys(Keys.BACKSPACE)
+        name_field.send_keys(self.user_name, Keys.ENTER)
+
+    def capture_screenshot(self, rect: dict):
+        """
+        Captures part of the page using DevTools protocol (without searching for element)
+        :param rect: dictionary with x, y, width and height keys (CSS pixels) and scale (device pixel ratio)
+        :return: opencv BGR image
+        """
+        # Capture in device pixels, like element screenshots on HiDPI screens
+        screenshot = self.browser.execute_cdp_cmd('Page.captureScreenshot', {
+            'format': 'png',
+            'clip': {'x': rect['x'], 'y': rect['y'], 'width': rect['width'], 'height': rect['height'],
+                     'scale': rect.get('scale', 1)}
+        })
+        image_bytes = base64.b64decode(screenshot['data'])
+        image_array = np.frombuffer(image_bytes, dtype=np.uint8)
+        return cv2.imdecode(image_array, flags=cv2.IMREAD_COLOR).astype('uint8')
+
+    def process_screenshot(self, opencv_image):
+        """
+        Compares screenshot with previous one and saves it if difference is above threshold
+        :param opencv_image: BGR image
+        :return: True if screenshot was saved
+        """
+        # Save screenshot
+        if self.screenshot_processor.process(opencv_image):
+            self.audio_handler.save_screenshot(opencv_image, int(time.time() * 1000)
+                                               - self.audio_handler.recording_started_time)
+            return True
+        return False
+
+    def show_preview(self, opencv_image, saving=False):
+        """
+        Shows image in preview label (does nothing if session has no preview)
+        :param opencv_image: BGR image or None to clear preview
+        :param saving: True to put Saving... text on top of the image
+        :return:
+        """
+        show_preview(self.preview_label, opencv_image, saving)
+
     def handler_loop(self):
         """
         Handles logging, popup blocking, attention checking etc...
@@ -187,7 +849,10 @@ class BrowserHandler:
         # Set initial stage and time
         handler_stage = HANDLER_STAGE_LOGIN
         time_started = int(time.time() * 1000)
+        before_event_wait = 0.
         while self.handler_loop_running and len(self.user_name) > 0:
+            waiting_for_event = False
+            sampling_screenshots = False
             try:
                 # Calculate current time
                 time_passed = int(time.time() * 1000) - time_started
@@ -200,14 +865,21 @@ class BrowserHandler:
                                                          + ':' + '{:02d}'.format(time_passed_minutes)
                                                          + ':' + '{:02d}'.format(time_passed_seconds))
 
-                # Check if browser is closed
+                # Probe page state in one round trip
+                state = None
                 browser_closed = False
                 try:
-                    _ = self.browser.window_handles
+                    state = self.probe_state()
                 except Exception as e:
                     logging.warning(e)
-                    browser_closed = True
-                    logging.warning('Browser was closed')
+
+                    # Check if browser is closed
+                    try:
+                        _ = self.browser.window_handles
+                    except Exception as e:
+                        logging.warning(e)
+                        browser_closed = True
+                        logging.warning('Browser was closed')
 
                 # Check if timed out
                 timed_out = False
@@ -223,68 +895,48 @@ class BrowserHandler:
                         self.stop_browser_and_recording.emit(self.link_type == LINK_TYPE_ZOOM)
                     break
 
+                # Page is not available now (reloading, etc.)
+                if state is None:
+                    raise Exception('No page state')
+                counts = state['counts']
+
+                # Pull tab audio if page doesn't allow sending it
+                self.drain_tab_audio()
+
                 # Webinar handlers
                 if self.link_type == LINK_TYPE_WEBINAR:
                     # Finished
-                    if 'AfterMeetingScreenContent' in self.browser.page_source or \
-                            'event_stopped' in self.browser.page_source or \
-                            'Встреча завершена' in self.browser.page_source:
+                    if state['finished']:
                         logging.warning('Event finished! Closing browser...')
                         if self.browser is not None:
                             self.stop_browser_and_recording.emit(False)
                         break
 
                     # Close camera / mic form
-                    prepare_containers = self.browser.find_elements(By.ID, 'prepare-vcs')
-                    for prepare_container in prepare_containers:
-                        prepare_accept_buttons = prepare_container.find_elements(By.CLASS_NAME, 'btn')
-                        for prepare_accept_button in prepare_accept_buttons:
-                            prepare_accept_button.click()
+                    if counts['prepare_buttons'] > 0:
+                        self.click_elements('prepare_buttons')
 
                     # Close popup
-                    popover_containers = self.browser.find_elements(By.CLASS_NAME, 'popover')
-                    for popover_container in popover_containers:
-                        popover_container_buttons = popover_container.find_elements(By.CLASS_NAME, 'btn-link')
-                        for popover_container_button in popover_container_buttons:
-                            popover_container_button.click()
+                    if counts['popover_buttons'] > 0:
+                        self.click_elements('popover_buttons')
 
                 # Zoom handlers
                 elif self.link_type == LINK_TYPE_ZOOM:
                     # Finished?
-                    is_finished = False
-                    zm_modal_body_titles = self.browser.find_elements(By.CLASS_NAME, 'zm-modal-body-title')
-                    zm_modal2_body_titles = self.browser.find_elements(By.CLASS_NAME, 'zm-modal2-body-title')
-                    feedback_wrap_hideme_rows = self.browser.find_elements(By.CLASS_NAME, 'feedback-wrap hideme row')
-                    error_messages = self.browser.find_elements(By.CLASS_NAME, 'error-message')
-                    if len(zm_modal_body_titles) > 0:
-                        html_ = str(zm_modal_body_titles[0].get_attribute('innerHTML')).lower()
-                        if 'ended' in html_ or 'finished' in html_ or 'завершен' in html_:
-                            is_finished = True
-                    if len(zm_modal2_body_titles) > 0:
-                        html_ = str(zm_modal2_body_titles[0].get_attribute('innerHTML')).lower()
-                        if 'ended' in html_ or 'finished' in html_ or 'завершен' in html_:
-                            is_finished = True
-                    if len(feedback_wrap_hideme_rows) > 0 or len(error_messages) > 0:
-                        is_finished = True
-                    if is_finished:
+                    if state['finished']:
                         logging.warning('Event finished! Closing browser...')
                         if self.browser is not None:
                             self.stop_browser_and_recording.emit(True)
                         break
 
                     # Click on join audio
-                    join_audio_by_voip_buttons = self.browser.find_elements(By.CLASS_NAME,
-                                                                            'zm-btn join-audio-by-voip__join-btn')
-                    if len(join_audio_by_voip_buttons) > 0:
-                        join_audio_by_voip_buttons[0].click()
+                    if counts['zoom_join_audio_buttons'] > 0:
+                        self.click_elements('zoom_join_audio_buttons', first_only=True)
 
                     # Click OK on all zm modals
-                    zm_modals = self.browser.find_elements(By.CLASS_NAME, 'zm-modal')
-                    for zm_modal in zm_modals:
-                        zm_modal_buttons = zm_modal.find_elements(By.TAG_NAME, 'button')
-                        for zm_modal_button in zm_modal_buttons:
-                            logging.info('Clicking on modal window button')
-                            zm_modal_button.click()
+                    if counts['zoom_modal_buttons'] > 0:
+                        logging.info('Clicking on modal window buttons')
+                        self.click_elements('zoom_modal_buttons')
 
                 ###############
                 # Login stage #
@@ -293,82 +945,66 @@ class BrowserHandler:
                     # Webinar login
                     if self.link_type == LINK_TYPE_WEBINAR:
                         # If page has stream container
-                        stream_container = self.browser.find_elements(By.CLASS_NAME, 'stream-main')
-                        if len(stream_container) > 0:
+                        if counts['stream_main'] > 0:
                             logging.info('Logged in successfully!')
                             # Switch to next stage
                             handler_stage = HANDLER_STAGE_SEND_HELLO_MESSAGE
 
                         # "Please wait, the event will start soon" message
-                        before_event_pages = self.browser.find_elements(By.CLASS_NAME,
-                                                                        'BeforeEventPage-module__main___xpKQX')
-                        if len(before_event_pages) <= 0:
-                            # Connect button on form window
-                            form_buttons = self.browser.find_elements(By.CLASS_NAME, 'modal-footer')
-
-                            # Connect button before form window
-                            page_buttons = self.browser.find_elements(By.CLASS_NAME, 'event-btns')
-
+                        if counts['before_event_page'] <= 0:
                             # Form exists
-                            if len(form_buttons) > 0:
+                            if counts['form_buttons'] > 0:
                                 # Set connect name and press connect button
-                                name_forms = self.browser.find_elements(By.CLASS_NAME, 'input-field')
-                                if len(name_forms) > 0:
-                                    name_fields = name_forms[0].find_elements(By.TAG_NAME, 'input')
-                                    if len(name_fields) > 0:
-                                        logging.info('Typing ' + self.user_name + ' into name field...')
-                                        name_fields[0].click()
-                                        for _ in range(len(self.user_name)):
-                                            name_fields[0].send_keys(Keys.BACKSPACE)
-                                        name_fields[0].send_keys(self.user_name, Keys.ENTER)
-
-                                        # Switch to next stage
-                                        handler_stage = HANDLER_STAGE_SEND_HELLO_MESSAGE
+                                name_fields = self.browser.find_elements(By.CSS_SELECTOR,
+                                                                         PROBE_SELECTORS['name_inputs'])
+                                if len(name_fields) > 0:
+                                    self.type_user_name(name_fields[0])
+
+                                    # Switch to next stage
+                                    handler_stage = HANDLER_STAGE_SEND_HELLO_MESSAGE
 
                             # No form -> click on connect button to show form
-                            elif len(page_buttons) > 0:
-                                page_connect_buttons = page_buttons[0].find_elements(By.CLASS_NAME, 'btn')
-                                if len(page_connect_buttons) > 0:
-                                    logging.info('No form found. Clicking the Connect button...')
-                                    page_connect_buttons[0].click()
+                            elif counts['page_connect_buttons'] > 0:
+                                logging.info('No form found. Clicking the Connect button...')
+                                self.click_elements('page_connect_buttons', first_only=True)
 
                         # Page has one
                         else:
                             logging.info('Waiting for event starting up...')
 
+                            # Poll waiting page less often (DOM events still wake up the loop)
+                            waiting_for_event = True
+                            before_event_wait = min(max(before_event_wait
+                                                        * float(self.settings['before_event_poll_backoff']),
+                                                        float(self.settings['loop_interval_seconds'])),
+                                                    float(self.settings['before_event_poll_max_seconds']))
+
                     # Zoom login
                     elif self.link_type == LINK_TYPE_ZOOM:
                         # Login accepted if there is leave button
-                        footer__leave_buttons = self.browser.find_elements(By.CLASS_NAME, 'footer__leave-btn-container')
-                        if len(footer__leave_buttons) > 0:
+                        if counts['zoom_leave_buttons'] > 0:
                             # Switch to next stage
                             handler_stage = HANDLER_STAGE_SEND_HELLO_MESSAGE
 
                         # Not yet logged in
                         else:
                             # Login
-                            name_fields = self.browser.find_elements(By.ID, 'inputname')
-                            join_buttons = self.browser.find_elements(By.ID, 'joinBtn')
-                            if len(name_fields) > 0 and len(join_buttons) > 0:
-                                logging.info('Typing ' + self.user_name + ' into name field...')
-                                name_fields[0].click()
-                                for _ in range(len(self.user_name)):
-                                    name_fields[0].send_keys(Keys.BACKSPACE)
-                                name_fields[0].send_keys(self.user_name, Keys.ENTER)
-
-                                # Click on join button
-                                join_buttons[0].click()
+                            if counts['zoom_name_inputs'] > 0 and counts['zoom_join_buttons'] > 0:
+                                name_fields = self.browser.find_elements(By.CSS_SELECTOR,
+                                                                         PROBE_SELECTORS['zoom_name_inputs'])
+                                if len(name_fields) > 0:
+                                    self.type_user_name(name_fields[0])
+
+                                    # Click on join button
+                                    self.click_elements('zoom_join_buttons', first_only=True)
 
                             # Click on join audio
-                            preview_audio_control_buttons = self.browser.find_elements(By.ID,
-                                                                                       'preview-audio-control-button')
-                            if len(preview_audio_control_buttons) > 0:
-                                preview_audio_control_buttons[0].click()
+                            if counts['zoom_preview_audio_buttons'] > 0:
+                                self.click_elements('zoom_preview_audio_buttons', first_only=True)
 
                             # Click on join button
-                            preview_join_buttons = self.browser.find_elements(By.CLASS_NAME, 'preview-join-button')
-                            if len(preview_join_buttons) > 0:
-                                preview_join_buttons[0].click()
+                            if counts['zoom_preview_join_buttons'] > 0:
+                                self.click_elements('zoom_preview_join_buttons', first_only=True)
 
                 ############################
                 # Send hello message stage #
@@ -380,22 +1016,15 @@ class BrowserHandler:
                     if len(hello_message) > 0:
                         # Webinar
                         if self.link_type == LINK_TYPE_WEBINAR:
-                            # Chat class
-                            chat_inputs = self.browser.find_elements(By.CLASS_NAME, 'editable-input')
-                            for chat_input in chat_inputs:
-                                # Find chat input field
-                                chat_input_divs = chat_input.find_elements(By.TAG_NAME, 'div')
-                                chat_input_div = None
-                                for chat_input_div_test in chat_input_divs:
-                                    if chat_input_div_test.get_attribute('data-placeholder') is not None:
-                                        chat_input_div = chat_input_div_test
-                                        break
-
-                                # Send hello message
-                                if chat_input_div is not None:
+                            # Find chat input field (send message only once)
+                            if counts['chat_inputs'] > 0:
+                                chat_input_divs = self.browser.find_elements(By.CSS_SELECTOR,
+                                                                             PROBE_SELECTORS['chat_inputs'])
+                                if len(chat_input_divs) > 0:
+                                    # Send hello message
                                     logging.info('Sending ' + hello_message + ' to the chat...')
-                                    chat_input_div.click()
-                                    chat_input_div.send_keys(hello_message, Keys.ENTER)
+                                    chat_input_divs[0].click()
+                                    chat_input_divs[0].send_keys(hello_message, Keys.ENTER)
 
                                     # Switch to IDLE
                                     handler_stage = HANDLER_STAGE_IDLE
@@ -407,38 +1036,39 @@ class BrowserHandler:
                         # Zoom
                         elif self.link_type == LINK_TYPE_ZOOM:
                             # Type into chat
-                            text_areas = self.browser.find_elements(By.CLASS_NAME, 'chat-box__chat-textarea')
-                            if len(text_areas) > 0:
-                                logging.info('Sending ' + hello_message + ' to the chat...')
-                                text_areas[0].click()
-                                text_areas[0].send_keys(hello_message, Keys.ENTER)
+                            if counts['zoom_chat_text_areas'] > 0:
+                                text_areas = self.browser.find_elements(By.CSS_SELECTOR,
+                                                                        PROBE_SELECTORS['zoom_chat_text_areas'])
+                                if len(text_areas) > 0:
+                                    logging.info('Sending ' + hello_message + ' to the chat...')
+                                    text_areas[0].click()
+                                    text_areas[0].send_keys(hello_message, Keys.ENTER)
 
-                                # Switch to IDLE
-                                handler_stage = HANDLER_STAGE_IDLE
+                                    # Switch to IDLE
+                                    handler_stage = HANDLER_STAGE_IDLE
 
-                                # Start recording
-                                if recording_enabled:
-                                    self.audio_handler.recording_start()
+                                    # Start recording
+                                    if recording_enabled:
+                                        self.audio_handler.recording_start()
 
                             # No chat
                             else:
                                 # Click open chat
-                                footer_chat_buttons = self.browser.find_elements(By.CLASS_NAME, 'footer-chat-button')
-                                if len(footer_chat_buttons) > 0:
-                                    footer_chat_buttons[0].click()
+                                if counts['zoom_chat_buttons'] > 0:
+                                    self.click_elements('zoom_chat_buttons', first_only=True)
 
                                 # No chat button, consider it is hidden in "more" section
                                 else:
                                     # Click on more button to expand popup menu with chat
-                                    more_buttons = self.browser.find_elements(By.ID, 'moreButton')
-                                    if len(more_buttons) > 0:
-                                        more_buttons[0].click()
+                                    if counts['zoom_more_buttons'] > 0:
+                                        self.click_elements('zoom_more_buttons', first_only=True)
 
                                     # Click on chat button in popup
-                                    li_elements = self.browser.find_elements(By.TAG_NAME, 'li')
-                                    for li_element in li_elements:
-                                        if 'chat' in str(li_element.get_attribute('innerHTML')).lower():
-                                            li_element.click()
+                                    if state['chat_menu_items'] > 0:
+                                        li_elements = self.browser.find_elements(By.TAG_NAME, 'li')
+                                        for li_element in li_elements:
+                                            if 'chat' in str(li_element.get_attribute('innerHTML')).lower():
+                                                li_element.click()
 
                     # No hello message -> switch to IDLE stage and start recording
                     else:
@@ -452,132 +1082,61 @@ class BrowserHandler:
                 # IDLE stage (recording, attention handling, etc...) #
                 ######################################################
                 elif handler_stage == HANDLER_STAGE_IDLE:
-                    screenshot_element = None
-
                     # Webinar
                     if self.link_type == LINK_TYPE_WEBINAR:
                         # Try to click into message field to simulate activity
-                        try:
-                            chat_inputs = self.browser.find_elements(By.CLASS_NAME, 'editable-input')
-                            for chat_input in chat_inputs:
-                                # Find chat input field
-                                chat_input_divs = chat_input.find_elements(By.TAG_NAME, 'div')
-                                chat_input_div = None
-                                for chat_input_div_test in chat_input_divs:
-                                    if chat_input_div_test.get_attribute('data-placeholder') is not None:
-                                        chat_input_div = chat_input_div_test
-                                        break
-
-                                # Click into message field
-                                if chat_input_div is not None:
-                                    chat_input_div.click()
-                        except:
-                            pass
-
-                        # Find attention checkers overlays
-                        attention_overlays = self.browser.find_elements(By.CLASS_NAME, 'layer_over')
-                        for attention_overlay in attention_overlays:
-                            # Click on attention control button
-                            attention_control_buttons = attention_overlay.find_elements(By.CLASS_NAME, 'btn')
-                            for attention_control_button in attention_control_buttons:
-                                logging.info('Clicking on attention overlay...')
-                                attention_control_button.click()
-
-                            # Click on close button
-                            attention_close_buttons = attention_overlay.find_elements(By.CLASS_NAME, 'btn-link')
-                            for attention_close_button in attention_close_buttons:
-                                logging.info('Closing attention overlay...')
-                                attention_close_button.click()
-
-                        # If screen sharing enabled
-                        stream_screensharings = self.browser.find_elements(By.CLASS_NAME, 'stream-screensharing')
-                        if len(stream_screensharings) > 0:
-                            stream_screensharing_videos = stream_screensharings[0].find_elements(By.TAG_NAME, 'video')
-                            if len(stream_screensharing_videos) > 0:
-                                screenshot_element = stream_screensharing_videos[0]
-
-                    # Zoom
-                    elif self.link_type == LINK_TYPE_ZOOM:
-                        # If screen sharing enabled
-                        share_container_canvases = self.browser.find_elements(By.ID, 'sharee-container-canvas')
-                        if len(share_container_canvases) > 0:
-                            size = share_container_canvases[0].size
-                            if size['width'] > 0 and size['height'] > 0:
-                                screenshot_element = share_container_canvases[0]
+                        if counts['chat_inputs'] > 0:
+                            try:
+                                self.click_elements('chat_inputs')
+                            except:
+                                pass
+
+                        # Click on attention control buttons
+                        if counts['attention_buttons'] > 0:
+                            logging.info('Clicking on attention overlay...')
+                            self.click_elements('attention_buttons')
+
+                        # Click on close buttons
+                        if counts['attention_close_buttons'] > 0:
+                            logging.info('Closing attention overlay...')
+                            self.click_elements('attention_close_buttons')
 
                     # If screen sharing enabled
-                    if screenshot_element is not None:
+                    if state['screenshot_rect'] is not None:
                         # Take screenshot and convert to opencv image
-                        base64_screenshot = screenshot_element.screenshot_as_base64
-                        image_bytes = base64.b64decode(base64_screenshot)
-                        image_array = np.frombuffer(image_bytes, dtype=np.uint8)
-                        opencv_image = cv2.imdecode(image_array, flags=cv2.IMREAD_COLOR).astype('uint8')
+                        opencv_image = self.capture_screenshot(state['screenshot_rect'])
 
-                        if self.settings['gui_recording_enabled']:
-                            # First start -> initialize self.opencv_image_prev
-                            if self.opencv_image_prev is None:
-                                self.opencv_image_prev = np.zeros(opencv_image.shape, dtype=opencv_image.dtype)
-
-                            # Resize prev image
-                            self.opencv_image_prev = cv2.resize(self.opencv_image_prev,
-                                                                (opencv_image.shape[1], opencv_image.shape[0]))
-
-                            # Find difference
-                            diff = cv2.absdiff(opencv_image, self.opencv_image_prev).astype('uint8')
-
-                            # Convert to grayscale
-                            diff = cv2.cvtColor(diff, cv2.COLOR_BGR2GRAY)
-
-                            # Store current image for next cycle
-                            self.opencv_image_prev = opencv_image
-
-                            # Apply threshold
-                            _, thresh = cv2.threshold(diff, int(self.settings['opencv_threshold']),
-                                                      255, cv2.THRESH_BINARY)
-
-                            # Calculate difference in percents
-                            diff_percents = (cv2.countNonZero(thresh) /
-                                             (opencv_image.shape[1] * opencv_image.shape[0])) * 100
-                            logging.info('Difference: ' + str(int(diff_percents)) + '%')
+                        # Measure join-to-first-screenshot latency
+                        if self.first_screenshot_latency_ms < 0:
+                            self.first_screenshot_latency_ms = int((time.time() - self.time_link_opened) * 1000)
+                            logging.info('Join-to-first-screenshot latency: '
+                                         + str(self.first_screenshot_latency_ms) + ' ms')
 
-                            # Save screenshot
-                            if diff_percents >= int(self.settings['screenshot_diff_threshold_percents']):
-                                screenshot_name = str(int(time.time() * 1000) - self.audio_handler
-                                                      .recording_started_time) + SCREENSHOT_EXTENSION
-                                logging.info('Saving current screenshot as ' + screenshot_name + '...')
-                                cv2.imwrite(self.audio_handler.screenshots_dir + screenshot_name, opencv_image)
-
-                            # Resize preview
-                            preview_resized = resize_keep_ratio(opencv_image, self.preview_label.size().width(),
-                                                                self.preview_label.size().height())
-
-                            # Put Saving... text on top of the image
-                            if diff_percents >= int(self.settings['screenshot_diff_threshold_percents']):
-                                cv2.putText(preview_resized, 'Saving...', (10, preview_resized.shape[0] // 2),
-                                            cv2.FONT_HERSHEY_SIMPLEX, 2, SAVING_TEXT_COLOR, 2, cv2.LINE_AA)
-
-                        # Recording disabled
-                        else:
-                            preview_resized = resize_keep_ratio(opencv_image, self.preview_label.size().width(),
-                                                                self.preview_label.size().height())
-
-                        # Convert to pixmap
-                        pixmap = QPixmap.fromImage(
-                            QImage(preview_resized.data, preview_resized.shape[1], preview_resized.shape[0],
-                                   3 * preview_resized.shape[1], QImage.Format_BGR888))
+                        # Compare with previous screenshot and save it if changed
+                        saving = False
+                        if self.settings['gui_recording_enabled']:
+                            saving = self.process_screenshot(opencv_image)
+                            sampling_screenshots = True
 
                         # Push to preview
-                        get_updater().call_latest(self.preview_label.setPixmap, pixmap)
+                        self.show_preview(opencv_image, saving)
 
                     # No streams
                     else:
-                        # Clear preview image
-                        get_updater().call_latest(self.preview_label.clear)
-                        get_updater().call_latest(self.preview_label.setText, 'No image')
+                        self.show_preview(None)
 
             # Error
             except Exception as e:
                 logging.warning(e)
 
             # Wait for next loop cycle
-            time.sleep(float(self.settings['loop_interval_seconds']))
+            if waiting_for_event:
+                self.wait_for_dom_events(before_event_wait)
+            else:
+                before_event_wait = 0.
+
+                # Adaptive screenshot interval
+                if sampling_screenshots:
+                    self.wait_for_dom_events(self.screenshot_processor.sampler.get_interval())
+                else:
+                    self.wait_for_dom_events(float(self.settings['loop_interval_seconds']))
@@ -0,0 +1,34 @@
+"""
+ Copyright (C) 2022 Fern Lane, Webinar-hacker
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+
+class CallbackSignal:
+    def __init__(self, callback=None):
+        """
+        Replacement for QtCore.pyqtSignal where there is no GUI (sessions without preview, command line)
+        :param callback: function called with emitted arguments or None to ignore them
+        """
+        self.callback = callback
+
+    def emit(self, *args):
+        """
+        Calls callback with arguments
+        :param args: emitted arguments
+        :return:
+        """
+        if self.callback is not None:
+            self.callback(*args)
@@ -0,0 +1,433 @@
+"""
+ Copyright (C) 2022 Fern Lane, Webinar-hacker
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+import logging
+import os
+import secrets
+import subprocess
+import threading
+import time
+import wave
+from abc import ABC, abstractmethod
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+CAPTURE_BACKEND_WASAPI = 'wasapi'
+CAPTURE_BACKEND_PULSE = 'pulse'
+CAPTURE_BACKEND_FILE = 'file'
+CAPTURE_BACKEND_TAB = 'tab'
+
+# Browser tab audio is captured directly at Whisper sampling rate
+TAB_AUDIO_SAMPLING_RATE = 16000
+
+# Chunks are sent every few hundred milliseconds, so anything bigger than 30 seconds of PCM16 is not audio
+TAB_AUDIO_MAX_CHUNK_BYTES = 30 * TAB_AUDIO_SAMPLING_RATE * 2
+
+
+class RingBuffer:
+    def __init__(self, size: int):
+        """
+        Single-producer / single-consumer ring buffer of float32 samples
+        Producer only moves write_index and consumer only moves read_index, so no locks are needed
+        :param size: capacity in samples
+        """
+        self.size = max(int(size), 1)
+        self.buffer = np.zeros(self.size, dtype=np.float32)
+        self.write_index = 0
+        self.read_index = 0
+        self.overruns = 0
+        self.samples_dropped = 0
+
+    def available(self):
+        """
+        :return: number of samples ready to read
+        """
+        return self.write_index - self.read_index
+
+    def write(self, samples):
+        """
+        Writes samples (called from producer thread only)
+        :param samples: numpy 1D array
+        :return: True if written, False if buffer is full (samples are dropped and overrun is counted)
+        """
+        samples_len = len(samples)
+        if samples_len > self.size - self.available():
+            self.overruns += 1
+            self.samples_dropped += samples_len
+            return False
+
+        start = self.write_index % self.size
+        first_part = min(samples_len, self.size - start)
+        self.buffer[start: start + first_part] = samples[: first_part]
+        self.buffer[: samples_len - first_part] = samples[first_part:]
+
+        # Publish written samples only after copying them
+        self.write_index += samples_len
+        return True
+
+    def read(self, samples_len: int):
+        """
+        Reads exactly samples_len samples (called from consumer thread only)
+        :param samples_len: number of samples to read
+        :return: numpy 1D array or None if not enough samples available
+        """
+        if self.available() < samples_len:
+            return None
+
+        start = self.read_index % self.size
+        first_part = min(samples_len, self.size - start)
+        samples = np.concatenate((self.buffer[start: start + first_part], self.buffer[: samples_len - first_part]))
+
+        # Free space only after copying samples
+        self.read_index += samples_len
+        return samples
+
+
+class CaptureBackend(ABC):
+    def __init__(self, settings, on_data):
+        """
+        Base class for audio capture sources
+        :param settings: settings dictionary
+        :param on_data: function(interleaved float32 samples) called from capture thread
+        """
+        self.settings = settings
+        self.on_data = on_data
+        self.sampling_rate = 0
+        self.channels = 0
+
+    @abstractmethod
+    def open(self):
+        """
+        Opens capture source and sets self.sampling_rate and self.channels
+        :return:
+        """
+
+    @abstractmethod
+    def close(self):
+        """
+        Closes capture source
+        :return:
+        """
+
+
+class WASAPILoopbackBackend(CaptureBackend):
+    def __init__(self, settings, on_data):
+        """
+        Records default speakers using WASAPI loopback (Windows only)
+        """
+        super().__init__(settings, on_data)
+        self.py_audio = None
+        self.pyaudio = None
+        self.recording_stream = None
+
+    def open(self):
+        import pyaudiowpatch as pyaudio
+        self.pyaudio = pyaudio
+
+        # Initialize PyAudio
+        if self.py_audio is None:
+            self.py_audio = pyaudio.PyAudio()
+
+        # Get default WASAPI info
+        wasapi_info = self.py_audio.get_host_api_info_by_type(pyaudio.paWASAPI)
+
+        # Get default WASAPI speakers
+        default_speakers = self.py_audio.get_device_info_by_index(wasapi_info['defaultOutputDevice'])
+        if not default_speakers['isLoopbackDevice']:
+            for loopback in self.py_audio.get_loopback_device_info_generator():
+                if default_speakers['name'] in loopback['name']:
+                    default_speakers = loopback
+                    break
+
+        # Open recording stream
+        logging.info('Opening audio loopback...')
+        logging.info(str(default_speakers))
+        self.channels = default_speakers['maxInputChannels']
+        self.sampling_rate = int(default_speakers['defaultSampleRate'])
+        self.recording_stream = self.py_audio.open(input_device_index=default_speakers['index'],
+                                                   format=pyaudio.paFloat32,
+                                                   channels=self.channels,
+                                                   frames_per_buffer=int(self.settings['audio_chunk_size']),
+                                                   rate=self.sampling_rate,
+                                                   input=True,
+                                                   stream_callback=self.callback)
+
+    def close(self):
+        if self.recording_stream is not None:
+            try:
+                self.recording_stream.stop_stream()
+                self.recording_stream.close()
+            except Exception as e:
+                logging.warning(e)
+            self.recording_stream = None
+
+    def callback(self, in_data, frame_count, time_info, status):
+        self.on_data(np.frombuffer(in_data, dtype=np.float32))
+
+        # Continue capturing audio
+        return in_data, self.pyaudio.paContinue
+
+
+class PulseMonitorBackend(CaptureBackend):
+    def __init__(self, settings, on_data):
+        """
+        Records monitor source of default PulseAudio / PipeWire (pipewire-pulse) sink using parec
+        """
+        super().__init__(settings, on_data)
+        self.process = None
+        self.thread = None
+        self.thread_running = False
+
+    def open(self):
+        # Find monitor of default sink
+        device = str(self.settings['audio_capture_device']).strip()
+        if len(device) == 0:
+            default_sink = subprocess.run(['pactl', 'get-default-sink'], capture_output=True, text=True).stdout.strip()
+            device = default_sink + '.monitor'
+
+        self.sampling_rate = int(self.settings['audio_capture_sampling_rate'])
+        self.channels = int(self.settings['audio_capture_channels'])
+        logging.info('Opening audio monitor ' + device + '...')
+        self.process = subprocess.Popen(['parec',
+                                         '--device=' + device,
+                                         '--format=float32le',
+                                         '--rate=' + str(self.sampling_rate),
+                                         '--channels=' + str(self.channels),
+                                         '--raw'],
+                                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+        # Start reading thread
+        self.thread_running = True
+        self.thread = threading.Thread(target=self.reading_thread)
+        self.thread.start()
+        logging.info('PulseAudio reading thread: ' + self.thread.name)
+
+    def close(self):
+        self.thread_running = False
+        if self.process is not None:
+            try:
+                self.process.terminate()
+                self.process.wait(timeout=5)
+            except Exception as e:
+                logging.warning(e)
+            self.process = None
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def reading_thread(self):
+        """
+        Reads chunks from parec stdout
+        :return:
+        """
+        chunk_bytes = int(self.settings['audio_chunk_size']) * self.channels * 4
+        while self.thread_running:
+            data = self.process.stdout.read(chunk_bytes)
+            if not data:
+                logging.warning('parec stream ended')
+                break
+            self.on_data(np.frombuffer(data[: len(data) - len(data) % (self.channels * 4)], dtype=np.float32))
+
+
+class FileReplayBackend(CaptureBackend):
+    def __init__(self, settings, on_data):
+        """
+        Replays WAV file (or raw float32 file) as if it was captured from device
+        audio_capture_file_speed: 1.0 - real time, 2.0 - twice as fast, 0 - as fast as possible
+        """
+        super().__init__(settings, on_data)
+        self.samples = np.empty(0, dtype=np.float32)
+        self.thread = None
+        self.thread_running = False
+
+    def open(self):
+        file = str(self.settings['audio_capture_file'])
+        logging.info('Replaying audio file ' + file + '...')
+
+        # WAV file
+        if file.lower().endswith('.wav'):
+            with wave.open(file, 'rb') as wave_file:
+                self.sampling_rate = wave_file.getframerate()
+                self.channels = wave_file.getnchannels()
+                sample_width = wave_file.getsampwidth()
+                frames = wave_file.readframes(wave_file.getnframes())
+            if sample_width == 1:
+                self.samples = (np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128.) / 128.
+            elif sample_width == 2:
+                self.samples = np.frombuffer(frames, dtype=np.int16).astype(np.float32) / 32768.
+            elif sample_width == 4:
+                self.samples = np.frombuffer(frames, dtype=np.int32).astype(np.float32) / 2147483648.
+            else:
+                raise Exception('Unsupported sample width: ' + str(sample_width))
+
+        # Raw float32 file
+        else:
+            self.sampling_rate = int(self.settings['audio_capture_sampling_rate'])
+            self.channels = int(self.settings['audio_capture_channels'])
+            self.samples = np.fromfile(file, dtype=np.float32)
+
+        # Start replay thread
+        self.thread_running = True
+        self.thread = threading.Thread(target=self.replay_thread)
+        self.thread.start()
+        logging.info('File replay thread: ' + self.thread.name)
+
+    def close(self):
+        self.thread_running = False
+        if self.thread is not None and self.thread != threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def replay_thread(self):
+        """
+        Feeds chunks of file with real time pacing
+        :return:
+        """
+        speed = float(self.settings['audio_capture_file_speed'])
+        chunk_frames = int(self.settings['audio_chunk_size'])
+        chunk_samples = chunk_frames * self.channels
+        chunk_duration = chunk_frames / self.sampling_rate
+        time_next = time.time()
+        for position in range(0, len(self.samples) - chunk_samples + 1, chunk_samples):
+            if not self.thread_running:
+                break
+            self.on_data(self.samples[position: position + chunk_samples])
+
+            # Wait as real device would
+            if speed > 0:
+                time_next += chunk_duration / speed
+                time.sleep(max(time_next - time.time(), 0))
+        logging.info('File replay finished')
+
+
+class TabAudioRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, format_, *args):
+        # Don't spam log with every chunk
+        pass
+
+    def send_cors_headers(self):
+        # Chunks are accepted only with session token, so any origin may send preflight
+        self.send_header('Access-Control-Allow-Origin', self.headers.get('Origin', 'null'))
+        self.send_header('Vary', 'Origin')
+        self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Access-Control-Allow-Private-Network', 'true')
+
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self.send_cors_headers()
+        self.end_headers()
+
+    def do_POST(self):
+        # Reject pages that don't know token of this session (before reading body)
+        token = parse_qs(urlparse(self.path).query).get('token', [''])[0]
+        if not secrets.compare_digest(token, self.server.backend.token):
+            self.send_response(403)
+            self.send_cors_headers()
+            self.end_headers()
+            return
+
+        # Limit size of chunk
+        try:
+            length = int(self.headers.get('Content-Length', -1))
+        except ValueError:
+            length = -1
+        if length < 0 or length > TAB_AUDIO_MAX_CHUNK_BYTES:
+            self.send_response(413 if length > 0 else 411)
+            self.send_cors_headers()
+            self.end_headers()
+            return
+        data = self.rfile.read(length)
+
+        self.send_response(204)
+        self.send_cors_headers()
+        self.end_headers()
+        self.server.backend.push_pcm16(data)
+
+
+class TabAudioBackend(CaptureBackend):
+    def __init__(self, settings, on_data):
+        """
+        Receives 16kHz mono PCM16 chunks captured inside browser tab (see BrowserHandler.TAB_AUDIO_CAPTURE_SCRIPT)
+        by local HTTP server. Only sound of the meeting is recorded and each session has its own server
+        """
+        super().__init__(settings, on_data)
+        self.server = None
+        self.thread = None
+        self.url = ''
+        self.token = secrets.token_urlsafe(16)
+
+        # Ring buffer has single producer, but chunks come from two threads
+        self.push_lock = threading.Lock()
+
+    def push_pcm16(self, data: bytes):
+        """
+        Passes PCM16 chunk from the tab to audio handler
+        (from HTTP server thread or from handler thread if page blocks requests to the server)
+        :param data: PCM16 mono samples
+        :return:
+        """
+        if len(data) >= 2:
+            samples = np.frombuffer(data[: len(data) - len(data) % 2], dtype=np.int16)
+            with self.push_lock:
+                self.on_data(samples.astype(np.float32) / 32768.)
+
+    def open(self):
+        self.sampling_rate = TAB_AUDIO_SAMPLING_RATE
+        self.channels = 1
+
+        # Start local server (port 0 -> any free port). Chunks drained from blocked pages are pushed by handler thread,
+        # so both producers go through push_pcm16() lock
+        self.server = HTTPServer(('127.0.0.1', int(self.settings['audio_tab_capture_port'])),
+                                  TabAudioRequestHandler)
+        self.server.backend = self
+        self.url = 'http://127.0.0.1:' + str(self.server.server_address[1]) + '/audio?token=' + self.token
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        logging.info('Waiting for tab audio on port ' + str(self.server.server_address[1]))
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+def create_capture_backend(settings, on_data):
+    """
+    Creates capture backend selected by audio_capture_backend setting
+    :param settings: settings dictionary
+    :param on_data: function(interleaved float32 samples)
+    :return: CaptureBackend
+    """
+    backend_name = str(settings['audio_capture_backend']).strip().lower()
+    if backend_name == CAPTURE_BACKEND_PULSE:
+        return PulseMonitorBackend(settings, on_data)
+    elif backend_name == CAPTURE_BACKEND_FILE:
+        return FileReplayBackend(settings, on_data)
+    elif backend_name == CAPTURE_BACKEND_TAB:
+        return TabAudioBackend(settings, on_data)
+    elif backend_name == CAPTURE_BACKEND_WASAPI:
+        return WASAPILoopbackBackend(settings, on_data)
+
+    # Auto select by OS
+    logging.warning('Unknown audio capture backend ' + backend_name + '! Selecting by OS')
+    return WASAPILoopbackBackend(settings, on_data) if os.name == 'nt' else PulseMonitorBackend(settings, on_data)
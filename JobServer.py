@@ -0,0 +1,418 @@
+"""
+ Copyright (C) 2022 Fern Lane, Webinar-hacker
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+import itertools
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from CallbackSignal import CallbackSignal
+from LectureBuilder import LectureBuilder
+from ModelManager import ModelManager
+from lecturehacker import ConsoleProgress, decode_file, get_recording_dir
+
+JOB_TYPE_DECODE = 'decode'
+JOB_TYPE_BUILD = 'build'
+JOB_TYPE_DECODE_BUILD = 'decode_build'
+
+JOB_STATE_QUEUED = 'queued'
+JOB_STATE_RUNNING = 'running'
+JOB_STATE_DONE = 'done'
+JOB_STATE_FAILED = 'failed'
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+DOCX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+
+
+class ServerJob:
+    def __init__(self, job_id: int, job_type: str, argument: str, priority: int, preset=None):
+        """
+        Decode / build request
+        :param job_id: unique id
+        :param job_type: JOB_TYPE_DECODE, JOB_TYPE_BUILD or JOB_TYPE_DECODE_BUILD
+        :param argument: media file (decode) or recording name (build)
+        :param priority: lower value runs first
+        :param preset: transcription preset or None to use whisper_preset
+        """
+        self.job_id = job_id
+        self.job_type = job_type
+        self.argument = argument
+        self.priority = priority
+        self.preset = preset
+        self.state = JOB_STATE_QUEUED
+        self.recording = None
+        self.lecture = None
+        self.events = []
+        self.condition = threading.Condition()
+
+    def add_event(self, event: dict):
+        """
+        Stores event and wakes up progress streams
+        :param event: dictionary with event data
+        :return:
+        """
+        with self.condition:
+            self.events.append(event)
+            self.condition.notify_all()
+
+    def set_state(self, state: str):
+        """
+        Changes state and adds state event
+        :param state: JOB_STATE_...
+        :return:
+        """
+        self.state = state
+        self.add_event({'event': 'state', 'state': state, 'time': int(time.time())})
+
+    def is_finished(self):
+        """
+        :return: True if job is done or failed
+        """
+        return self.state in (JOB_STATE_DONE, JOB_STATE_FAILED)
+
+    def to_dict(self):
+        """
+        :return: job info for API responses
+        """
+        return {'id': self.job_id, 'type': self.job_type, 'argument': self.argument, 'priority': self.priority,
+                'preset': self.preset, 'state': self.state, 'recording': self.recording, 'lecture': self.lecture}
+
+
+class JobProgress(ConsoleProgress):
+    def __init__(self, job: ServerJob):
+        """
+        Progress of decode / build stored as job events instead of printing
+        :param job: ServerJob
+        """
+        super().__init__(str(job.job_id))
+        self.job = job
+
+    def print(self, event: dict):
+        event['elapsed'] = round(time.time() - self.time_started, 1)
+        self.job.add_event(event)
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, format_, *args):
+        logging.info('Job server: ' + (format_ % args))
+
+    def send_json(self, data, code=200):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_job(self, path_parts: list):
+        job = None
+        try:
+            job = self.server.job_server.jobs.get(int(path_parts[1]))
+        except (IndexError, ValueError):
+            pass
+        if job is None:
+            self.send_json({'error': 'job not found'}, 404)
+        return job
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path_parts = [part for part in url.path.split('/') if len(part) > 0]
+
+        # List of jobs
+        if path_parts == ['jobs']:
+            self.send_json([job.to_dict() for job in self.server.job_server.jobs.values()])
+
+        # Job info
+        elif len(path_parts) == 2 and path_parts[0] == 'jobs':
+            job = self.get_job(path_parts)
+            if job is not None:
+                self.send_json(job.to_dict())
+
+        # Progress events
+        elif len(path_parts) == 3 and path_parts[0] == 'jobs' and path_parts[2] == 'events':
+            job = self.get_job(path_parts)
+            if job is not None:
+                self.stream_events(job)
+
+        # Finished lecture
+        elif len(path_parts) == 3 and path_parts[0] == 'jobs' and path_parts[2] == 'lecture':
+            job = self.get_job(path_parts)
+            if job is not None:
+                if job.lecture is None or not os.path.exists(job.lecture):
+                    self.send_json({'error': 'lecture is not ready'}, 404)
+                else:
+                    self.send_file(job.lecture)
+        else:
+            self.send_json({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        try:
+            priority = int(query.get('priority', [self.server.job_server.settings['server_default_priority']])[0])
+        except ValueError:
+            self.send_json({'error': 'priority must be an integer'}, 400)
+            return
+        preset = query.get('preset', [None])[0]
+
+        # New job from path: {"type": "decode_build", "path": "file.mp4", "priority": 0, "preset": "draft"}
+        if url.path == '/jobs':
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                job = self.server.job_server.add_job(str(request.get('type', JOB_TYPE_DECODE_BUILD)),
+                                                     str(request['path']),
+                                                     int(request.get('priority', priority)),
+                                                     request.get('preset', preset))
+            except Exception as e:
+                self.send_json({'error': str(e)}, 400)
+                return
+            self.send_json(job.to_dict(), 201)
+
+        # Upload media file: /upload?name=file.mp4&priority=0&build=1&preset=draft
+        elif url.path == '/upload':
+            name = os.path.basename(query.get('name', [''])[0])
+            if len(name) == 0:
+                self.send_json({'error': 'name is required'}, 400)
+                return
+            if preset is not None and preset not in self.server.job_server.settings['whisper_presets']:
+                self.send_json({'error': 'unknown preset ' + preset}, 400)
+                return
+
+            # Chunked uploads are not supported, body length must be known
+            if self.headers.get('Content-Length') is None or 'chunked' in self.headers.get('Transfer-Encoding', ''):
+                self.send_json({'error': 'Content-Length is required'}, 411)
+                return
+            try:
+                file = self.server.job_server.receive_upload(name, self.rfile, int(self.headers['Content-Length']))
+            except ValueError as e:
+                self.send_json({'error': str(e)}, 400)
+                return
+            build = query.get('build', ['1'])[0] != '0'
+            job = self.server.job_server.add_job(JOB_TYPE_DECODE_BUILD if build else JOB_TYPE_DECODE, file, priority,
+                                                 preset)
+            self.send_json(job.to_dict(), 201)
+        else:
+            self.send_json({'error': 'not found'}, 404)
+
+    def stream_events(self, job: ServerJob):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        sent = 0
+        try:
+            while True:
+                with job.condition:
+                    if sent >= len(job.events) and not job.is_finished():
+                        job.condition.wait(timeout=15)
+                    events = job.events[sent:]
+                    finished = job.is_finished()
+
+                # Keep connection alive
+                if len(events) == 0 and not finished:
+                    self.wfile.write(b': ping\n\n')
+                for event in events:
+                    self.wfile.write(('data: ' + json.dumps(event, ensure_ascii=False) + '\n\n').encode('utf-8'))
+                self.wfile.flush()
+                sent += len(events)
+                if finished and sent >= len(job.events):
+                    break
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def send_file(self, file: str):
+        self.send_response(200)
+        self.send_header('Content-Type', DOCX_CONTENT_TYPE)
+        self.send_header('Content-Length', str(os.path.getsize(file)))
+        self.send_header('Content-Disposition', 'attachment; filename="' + os.path.basename(file) + '"')
+        self.end_headers()
+        with open(file, 'rb') as file_:
+            while True:
+                chunk = file_.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+
+
+class JobServer:
+    def __init__(self, settings, host: str, port: int):
+        """
+        Local HTTP API for decode / build jobs. Jobs run one after another in one long-lived process,
+        so transcription models are kept loaded by ModelManager between jobs
+        :param settings: settings dictionary
+        :param host: address to listen on
+        :param port: port to listen on
+        """
+        self.settings = settings
+        self.host = host
+        self.port = port
+
+        self.jobs = {}
+        self.job_queue = queue.PriorityQueue()
+        self.job_counter = itertools.count(1)
+        self.lock = threading.Lock()
+        self.model_manager = ModelManager(settings)
+        self.server = None
+        self.worker_thread = None
+        self.worker_running = False
+
+    def add_job(self, job_type: str, argument: str, priority: int, preset=None):
+        """
+        Queues new job
+        :param job_type: JOB_TYPE_DECODE, JOB_TYPE_BUILD or JOB_TYPE_DECODE_BUILD
+        :param argument: media file (decode) or recording name / directory (build)
+        :param priority: lower value runs first
+        :param preset: transcription preset or None to use whisper_preset
+        :return: ServerJob
+        """
+        if job_type not in (JOB_TYPE_DECODE, JOB_TYPE_BUILD, JOB_TYPE_DECODE_BUILD):
+            raise ValueError('Unknown job type ' + job_type)
+        if preset is not None and preset not in self.settings['whisper_presets']:
+            raise ValueError('Unknown whisper preset ' + str(preset))
+        with self.lock:
+            job = ServerJob(next(self.job_counter), job_type, argument, priority, preset)
+            self.jobs[job.job_id] = job
+        job.set_state(JOB_STATE_QUEUED)
+        self.job_queue.put((priority, job.job_id, job))
+        logging.info('Job ' + str(job.job_id) + ' queued: ' + job_type + ' ' + argument)
+        return job
+
+    def receive_upload(self, name: str, stream, length: int):
+        """
+        Saves uploaded media file into uploads directory
+        :param name: file name
+        :param stream: request body stream
+        :param length: body length in bytes
+        :return: path to saved file
+        :raises ValueError: if body is shorter than length
+        """
+        if length < 0:
+            raise ValueError('Invalid Content-Length')
+        upload_dir = str(self.settings['server_upload_directory'])
+        if not os.path.exists(upload_dir):
+            os.makedirs(upload_dir)
+
+        # Don't overwrite previous uploads
+        file_name, file_extension = os.path.splitext(name)
+        file = os.path.join(upload_dir, name)
+        index = 1
+        while os.path.exists(file):
+            file = os.path.join(upload_dir, file_name + '_' + str(index) + file_extension)
+            index += 1
+
+        with open(file, 'wb') as file_:
+            while length > 0:
+                chunk = stream.read(min(UPLOAD_CHUNK_SIZE, length))
+                if not chunk:
+                    break
+                file_.write(chunk)
+                length -= len(chunk)
+
+        # Connection closed before whole file was received
+        if length > 0:
+            os.remove(file)
+            logging.warning('Upload of ' + file + ' ended early, ' + str(length) + ' bytes missing')
+            raise ValueError('Upload ended early')
+        logging.info('Uploaded: ' + file)
+        return file
+
+    def build(self, job: ServerJob, progress: JobProgress):
+        """
+        Builds lecture using models of model manager
+        :param job: ServerJob
+        :param progress: JobProgress of the job
+        :return: path to lecture file or None in case of error
+        """
+        recording_dir = get_recording_dir(self.settings, job.recording)
+        if recording_dir is None:
+            return None
+        # Job preset overrides default one
+        settings = self.settings
+        if job.preset is not None:
+            settings = dict(self.settings)
+            settings['whisper_preset'] = job.preset
+
+        results = []
+        lecture_builder = LectureBuilder(settings, progress.ignore_signal, progress.progress_signal,
+                                         progress.maximum_signal, CallbackSignal(results.append),
+                                         progress.status_signal, progress.status_signal)
+        lecture_builder.model_manager = self.model_manager
+        lecture_builder.start_building_lecture(recording_dir, os.path.basename(os.path.normpath(recording_dir)))
+        if lecture_builder.thread is not None:
+            lecture_builder.thread.join()
+        return results[0] if len(results) > 0 else None
+
+    def worker_loop(self):
+        """
+        Runs queued jobs by priority
+        :return:
+        """
+        while self.worker_running:
+            try:
+                _, _, job = self.job_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            job.set_state(JOB_STATE_RUNNING)
+            progress = JobProgress(job)
+            try:
+                # Decode
+                if job.job_type in (JOB_TYPE_DECODE, JOB_TYPE_DECODE_BUILD):
+                    job.recording = decode_file(self.settings, job.argument, progress=progress)
+                else:
+                    job.recording = job.argument
+
+                # Build
+                if job.recording is not None and job.job_type in (JOB_TYPE_BUILD, JOB_TYPE_DECODE_BUILD):
+                    job.lecture = self.build(job, progress)
+                    success = job.lecture is not None
+                else:
+                    success = job.recording is not None
+            except Exception as e:
+                logging.error(e, exc_info=True)
+                success = False
+
+            job.set_state(JOB_STATE_DONE if success else JOB_STATE_FAILED)
+            logging.info('Job ' + str(job.job_id) + ': ' + job.state)
+
+    def serve(self):
+        """
+        Starts worker and serves API until interrupted
+        :return:
+        """
+        self.model_manager.start()
+        self.worker_running = True
+        self.worker_thread = threading.Thread(target=self.worker_loop)
+        self.worker_thread.start()
+
+        self.server = ThreadingHTTPServer((self.host, self.port), JobRequestHandler)
+        self.server.daemon_threads = True
+        self.server.job_server = self
+        logging.info('Job server listening on http://' + self.host + ':' + str(self.server.server_address[1]))
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            logging.warning('Stopping job server...')
+        self.server.server_close()
+        self.worker_running = False
+        self.worker_thread.join()
+        self.model_manager.stop()
@@ -15,18 +15,163 @@
  OTHER DEALINGS IN THE SOFTWARE.
 """
 
+import hashlib
+import json
 import logging
 import os
+import subprocess
 import threading
 import time
+import wave
 
+import numpy as np
 from docx import Document
 from docx.shared import Inches, RGBColor, Pt
 
-from BrowserHandler import SCREENSHOT_EXTENSION
+from AudioHandler import SCREENSHOT_EXTENSION, PCM_MAX
+from RecordingManifest import load_manifest, MANIFEST_ENTRY_AUDIO, MANIFEST_ENTRY_SCREENSHOT
+from SlideContainer import read_slide_frames
+from TranscriptionEngines import create_transcription_engine, get_whisper_preset, CONFIDENCE_UNKNOWN_PERCENTS
 
 WAVE_FILE_SIZE_MIN_BYTES = 100
 
+# Whisper models work only with 16kHz mono audio
+WHISPER_SAMPLING_RATE = 16000
+
+# Whisper transcribes 30 seconds windows
+WHISPER_WINDOW_SAMPLES = 30 * WHISPER_SAMPLING_RATE
+
+
+def read_container_fragment(container_file: str, offset: int, samples: int):
+    """
+    Reads fragment from raw PCM16 mono audio container without loading the whole container
+    :param container_file: path to audio container
+    :param offset: offset of the fragment in samples
+    :param samples: number of samples in the fragment
+    :return: numpy 1D array of float32 in range -1...1
+    """
+    container = np.memmap(container_file, dtype=np.int16, mode='r', offset=offset * 2, shape=(samples,))
+    return np.divide(container, PCM_MAX + 1, dtype=np.float32)
+
+
+def read_wave_file(wave_file: str):
+    """
+    Reads 16kHz mono PCM16 WAV file (as written by AudioHandler) without spawning ffmpeg
+    :param wave_file: path to WAV file
+    :return: numpy 1D array of float32 in range -1...1 or None if file has any other format
+    """
+    try:
+        with wave.open(wave_file, 'rb') as wave_file_:
+            # Not our format or header was not finalized
+            if wave_file_.getnchannels() != 1 \
+                    or wave_file_.getsampwidth() != 2 \
+                    or wave_file_.getframerate() != WHISPER_SAMPLING_RATE \
+                    or wave_file_.getcomptype() != 'NONE' \
+                    or wave_file_.getnframes() <= 0:
+                return None
+            frames = wave_file_.readframes(wave_file_.getnframes())
+    except (wave.Error, EOFError):
+        return None
+    return np.divide(np.frombuffer(frames, dtype=np.int16), PCM_MAX + 1, dtype=np.float32)
+
+
+def decode_audio_file(audio_file: str):
+    """
+    Decodes any audio / video file into 16kHz mono audio using ffmpeg
+    :param audio_file: path to file
+    :return: numpy 1D array of float32 in range -1...1
+    """
+    result = subprocess.run(['ffmpeg', '-nostdin', '-threads', '0', '-i', audio_file,
+                             '-f', 's16le', '-ac', '1', '-acodec', 'pcm_s16le', '-ar', str(WHISPER_SAMPLING_RATE), '-'],
+                            capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError('Error decoding ' + audio_file + ': ' + result.stderr.decode('utf-8', errors='ignore'))
+    return np.divide(np.frombuffer(result.stdout, dtype=np.int16), PCM_MAX + 1, dtype=np.float32)
+
+
+def pad_or_trim(audio):
+    """
+    Pads audio with silence or trims it to whisper window
+    :param audio: numpy 1D array of float32
+    :return: numpy 1D array of float32 with WHISPER_WINDOW_SAMPLES samples
+    """
+    if len(audio) > WHISPER_WINDOW_SAMPLES:
+        return audio[: WHISPER_WINDOW_SAMPLES]
+    return np.pad(audio, (0, WHISPER_WINDOW_SAMPLES - len(audio)))
+
+
+def transcript_cache_file(settings, lecture_directory: str, audio_file_: list):
+    """
+    Generates path of cached transcript of the fragment (depends on model, preset parameters and language)
+    :param settings: settings dictionary
+    :param lecture_directory: example recordings/DD_MM_YYYY__HH_MM_SS
+    :param audio_file_: [time, path, size, offset, samples]
+    :return: path to json file inside transcripts directory of the recording
+    """
+    fragment_name = os.path.basename(str(audio_file_[1]))
+    if audio_file_[3] >= 0:
+        fragment_name += '_' + str(audio_file_[3])
+    model_name = str(settings['whisper_model_name'])
+    if settings['two_pass_enabled']:
+        model_name = str(settings['two_pass_draft_model_name']) + '+' + model_name
+
+    # Preset parameters may be edited without renaming it
+    preset_name = str(settings['whisper_preset'])
+    preset_hash = hashlib.md5(json.dumps(settings['whisper_presets'].get(preset_name), sort_keys=True)
+                              .encode('utf-8')).hexdigest()[: 8]
+    return os.path.join(lecture_directory, str(settings['transcripts_directory_name']),
+                        fragment_name + '_' + model_name + '_' + preset_name + '_' + preset_hash + '_'
+                        + str(settings['transcription_engine']) + '_' + str(settings['whisper_model_language'])
+                        + '.json')
+
+
+def load_cached_transcript(cache_file: str):
+    """
+    Loads cached transcript of the fragment
+    :param cache_file: path from transcript_cache_file()
+    :return: list of [word, end time in milliseconds, confidence in percents] or None if not cached
+    """
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as file:
+            return json.load(file)['words']
+    except Exception as e:
+        logging.warning('Error reading cached transcript ' + cache_file + '! ' + str(e))
+        return None
+
+
+def save_cached_transcript(cache_file: str, words: list):
+    """
+    Saves transcript of the fragment
+    :param cache_file: path from transcript_cache_file()
+    :param words: result of LectureBuilder.transcribe_fragment()
+    :return:
+    """
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(cache_file + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump({'words': words}, file, ensure_ascii=False)
+        os.replace(cache_file + '.tmp', cache_file)
+    except Exception as e:
+        logging.warning('Error saving transcript ' + cache_file + '! ' + str(e))
+
+
+def needs_retranscription(settings, words: list):
+    """
+    Checks if draft transcription of the fragment is too uncertain
+    :param settings: settings dictionary
+    :param words: result of LectureBuilder.transcribe_fragment() using draft model
+    :return: True if fragment must be transcribed again using main model
+    """
+    if len(words) == 0:
+        return False
+
+    # Words with unknown confidence (CONFIDENCE_UNKNOWN_PERCENTS) are below any threshold, so they are checked again
+    threshold_percents = int(settings['two_pass_confidence_threshold_percents'])
+    low_confidence_words = sum(1 for word in words if word[2] < threshold_percents)
+    return low_confidence_words * 100. / len(words) > float(settings['two_pass_low_confidence_words_percents'])
+
 
 class LectureBuilder:
     def __init__(self, settings, elements_set_enabled_signal, progress_bar_set_value_signal,
@@ -44,7 +189,12 @@ class LectureBuilder:
         self.screenshots = []
         self.audio_bytes_total = 0
         self.lecture_name = ''
+        self.lecture_directory = ''
         self.model = None
+        self.draft_model = None
+        self.model_manager = None
+        self.thread = None
+        self.two_pass_warning_shown = False
 
     def start_building_lecture(self, lecture_directory: str, lecture_name: str):
         """
@@ -55,10 +205,51 @@ class LectureBuilder:
         """
         logging.info('Building lecture ' + lecture_name)
         self.lecture_name = lecture_name
+        self.find_files(lecture_directory)
+
+        # Check for audio file
+        if len(self.audio_files) > 0:
+            # Start thread
+            self.thread = threading.Thread(target=self.lecture_builder_thread)
+            self.thread.start()
+            logging.info('Lecture builder thread: ' + self.thread.name)
+
+        # No audio file
+        else:
+            logging.warning('No audio file!')
+            # Enable gui elements
+            self.elements_set_enabled_signal.emit(True)
+
+    def find_files(self, lecture_directory: str):
+        """
+        Finds and sorts audio files and screenshots of recording
+        :param lecture_directory: example recordings/DD_MM_YYYY__HH_MM_SS
+        :return:
+        """
+        self.lecture_directory = lecture_directory
         self.audio_files = []
         self.screenshots = []
         self.audio_bytes_total = 0
 
+        # Read recording manifest or scan directories for older recordings
+        manifest_entries = load_manifest(os.path.join(lecture_directory, str(self.settings['manifest_file_name'])))
+        if manifest_entries is not None:
+            self.find_files_from_manifest(lecture_directory, manifest_entries)
+        else:
+            self.find_files_in_directory(lecture_directory)
+
+        # Sort audio files and screenshots
+        if len(self.audio_files) > 0:
+            self.audio_files.sort(key=lambda x: x[0])
+        if len(self.screenshots) > 0:
+            self.screenshots.sort(key=lambda x: x[0], reverse=True)
+
+    def find_files_in_directory(self, lecture_directory: str):
+        """
+        Finds audio files and screenshots by parsing time from their names
+        :param lecture_directory: example recordings/DD_MM_YYYY__HH_MM_SS
+        :return:
+        """
         # Find audio files
         for audio_or_screenshot_dir in os.listdir(lecture_directory):
             audio_or_screenshot_dir = os.path.join(lecture_directory, audio_or_screenshot_dir)
@@ -81,7 +272,7 @@ class LectureBuilder:
                             if file_size < WAVE_FILE_SIZE_MIN_BYTES:
                                 logging.warning('Size of file ' + str(file_) + ' too small! Ignoring it')
                             else:
-                                self.audio_files.append([time_diff_int, str(file_), file_size])
+                                self.audio_files.append([time_diff_int, str(file_), file_size, -1, -1])
                                 self.audio_bytes_total += file_size
 
         # Find screenshots
@@ -100,24 +291,51 @@ class LectureBuilder:
                         logging.info('Found screenshot: ' + str(dir_or_file) + ' with time: ' + str(time_diff_int))
                         self.screenshots.append([time_diff_int, str(dir_or_file)])
 
-        # Sort audio files and screenshots
-        if len(self.audio_files) > 0:
-            self.audio_files.sort(key=lambda x: x[0])
-        if len(self.screenshots) > 0:
-            self.screenshots.sort(key=lambda x: x[0], reverse=True)
+    def find_files_from_manifest(self, lecture_directory: str, manifest_entries: list):
+        """
+        Finds audio files and screenshots using recording manifest (without opening audio files)
+        :param lecture_directory: example recordings/DD_MM_YYYY__HH_MM_SS
+        :param manifest_entries: list of entries from load_manifest()
+        :return:
+        """
+        logging.info('Reading ' + str(len(manifest_entries)) + ' manifest entries')
+        silence_threshold_dbfs = float(self.settings['manifest_silence_threshold_dbfs'])
+
+        # Use dictionaries in case the same fragment was recorded twice
+        audio_files = {}
+        screenshots = {}
+        for entry in manifest_entries:
+            entry_type = entry.get('type')
+            if entry_type == MANIFEST_ENTRY_AUDIO:
+                file_ = os.path.join(lecture_directory, str(entry['file']))
+                if int(entry['samples']) <= 0:
+                    logging.warning('Audio file ' + file_ + ' is empty! Ignoring it')
+                elif float(entry['rms_dbfs']) < silence_threshold_dbfs:
+                    logging.warning('Audio file ' + file_ + ' is silent! Ignoring it')
+                elif not os.path.exists(file_):
+                    logging.warning('Audio file ' + file_ + ' not exists! Ignoring it')
+                else:
+                    # PCM16 -> 2 bytes per sample. Offset is -1 for standalone WAV files
+                    offset = int(entry.get('offset', -1))
+                    audio_files[file_ + ':' + str(offset)] = [int(entry['time']), file_, int(entry['samples']) * 2,
+                                                              offset, int(entry['samples'])]
+
+            elif entry_type == MANIFEST_ENTRY_SCREENSHOT:
+                file_ = os.path.join(lecture_directory, str(entry['file']))
+                if os.path.exists(file_):
+                    # Frame of slides container
+                    if 'frame' in entry:
+                        screenshots[file_ + ':' + str(entry['time'])] = [int(entry['time']), file_,
+                                                                         int(entry['frame'])]
+                    else:
+                        screenshots[file_] = [int(entry['time']), file_]
 
-        # Check for audio file
-        if len(self.audio_files) > 0:
-            # Start thread
-            thread = threading.Thread(target=self.lecture_builder_thread)
-            thread.start()
-            logging.info('Lecture builder thread: ' + thread.name)
-
-        # No audio file
-        else:
-            logging.warning('No audio file!')
-            # Enable gui elements
-            self.elements_set_enabled_signal.emit(True)
+        self.audio_files = list(audio_files.values())
+        self.screenshots = list(screenshots.values())
+        for audio_file_ in self.audio_files:
+            self.audio_bytes_total += audio_file_[2]
+        logging.info('Found ' + str(len(self.audio_files)) + ' audio files and '
+                     + str(len(self.screenshots)) + ' screenshots')
 
     def lecture_builder_thread(self):
         """
@@ -125,24 +343,6 @@ class LectureBuilder:
         :return:
         """
         try:
-            # Load packages
-            logging.info('Importing packages...')
-            import whisper_timestamped as whisper
-
-            # Load model
-            if self.model is None:
-                # Select cpu or gpu
-                import torch
-                device = 'cuda' if torch.cuda.is_available() else 'cpu'
-                logging.info('Device: ' + device)
-                self.label_device_signal.emit('Device: ' + device)
-
-                # Load model
-                model_dir = os.getcwd()
-                logging.info('Loading model into: ' + model_dir)
-                self.model = whisper.load_model(str(self.settings['whisper_model_name']), device=device,
-                                                download_root=model_dir)
-
             # Result lists
             words = []
             timestamps_end = []
@@ -157,19 +357,26 @@ class LectureBuilder:
                 # Set progress
                 self.progress_bar_set_value_signal.emit(audio_file_n + 1)
 
-                transcription = None
                 audio_file_ = self.audio_files[audio_file_n]
                 try:
                     # Record start time
                     transcription_time_started = time.time()
 
-                    # Load audio file
-                    audio = whisper.load_audio(audio_file_[1])
-                    audio = whisper.pad_or_trim(audio)
+                    # Use transcript from background transcriber or previous build
+                    cache_file = transcript_cache_file(self.settings, self.lecture_directory, audio_file_)
+                    fragment_words = load_cached_transcript(cache_file)
 
-                    # Transcribe audio
-                    transcription = whisper.transcribe(self.model, audio,
-                                                       language=str(self.settings['whisper_model_language']))
+                    # Transcribe audio (model is loaded only if some fragment is not cached)
+                    if fragment_words is None:
+                        fragment_words = self.transcribe(audio_file_)
+                        save_cached_transcript(cache_file, fragment_words)
+                    else:
+                        logging.info('Using cached transcript ' + cache_file)
+
+                    for word, timestamp_end, confidence_percents in fragment_words:
+                        words.append(word)
+                        timestamps_end.append(timestamp_end)
+                        confidences_percents.append(confidence_percents)
 
                     # Calculate seconds per byte
                     seconds_per_byte = (time.time() - transcription_time_started) / audio_file_[2]
@@ -198,23 +405,6 @@ class LectureBuilder:
                 except Exception as e:
                     logging.warning(e)
 
-                # Parse result
-                if transcription is not None and transcription['segments'] is not None \
-                        and len(transcription['segments']) > 0:
-                    for segment in transcription['segments']:
-                        if segment is not None and segment['words'] is not None and len(segment['words']) > 0:
-                            for segment_word in segment['words']:
-                                if segment_word is not None:
-                                    if segment_word['text'] is not None and segment_word['end'] is not None \
-                                            and segment_word['confidence'] is not None:
-                                        text_ = str(segment_word['text']).strip()
-                                        if len(text_) > 0:
-                                            # Finally, append data
-                                            words.append(text_)
-                                            timestamps_end.append(int(1000. * float(segment_word['end']))
-                                                                  + audio_file_[0])
-                                            confidences_percents.append(int(100. * float(segment_word['confidence'])))
-
             # Log length of words
             logging.info('Transcription result words: ' + str(len(words)))
 
@@ -240,9 +430,156 @@ class LectureBuilder:
         self.progress_bar_set_value_signal.emit(0)
         self.label_time_left_signal.emit('Time left: 00:00:00')
 
+        # Let model manager unload models
+        self.release_models()
+
         # Enable gui elements
         self.elements_set_enabled_signal.emit(True)
 
+    def load_model(self):
+        """
+        Loads model if it is not loaded yet (or gets it from model manager)
+        :return:
+        """
+        if self.model_manager is not None:
+            self.model = self.model_manager.get(str(self.settings['whisper_model_name']), self)
+        elif self.model is None:
+            self.model = self.load_whisper_model(str(self.settings['whisper_model_name']))
+
+    def load_draft_model(self):
+        """
+        Loads small model for the first pass if it is not loaded yet (or gets it from model manager)
+        :return:
+        """
+        if self.model_manager is not None:
+            self.draft_model = self.model_manager.get(str(self.settings['two_pass_draft_model_name']), self)
+        elif self.draft_model is None:
+            self.draft_model = self.load_whisper_model(str(self.settings['two_pass_draft_model_name']))
+
+    def release_models(self):
+        """
+        Drops references to models owned by model manager, so they can be unloaded
+        :return:
+        """
+        if self.model_manager is not None:
+            self.model_manager.release(self)
+            self.model = None
+            self.draft_model = None
+
+    def drop_model(self, model_name: str):
+        """
+        Drops reference to model unloaded by model manager (it will be requested again if needed)
+        :param model_name: model name
+        :return:
+        """
+        if self.model is not None and self.model.model_name == model_name:
+            self.model = None
+        if self.draft_model is not None and self.draft_model.model_name == model_name:
+            self.draft_model = None
+
+    def load_whisper_model(self, model_name: str):
+        """
+        Loads model using engine selected by transcription_engine setting
+        :param model_name: tiny, base, small, medium, large
+        :return: loaded TranscriptionEngine
+        """
+        engine = create_transcription_engine(self.settings, self.label_device_signal)
+        engine.load(model_name)
+        return engine
+
+    def transcribe(self, audio_file_: list):
+        """
+        Transcribes one audio fragment using main model or draft model first (if two_pass_enabled)
+        Loads models if needed
+        :param audio_file_: [time, path, size, offset, samples]
+        :return: list of (word, end time from the start of recording in milliseconds, confidence in percents)
+        """
+        if self.settings['two_pass_enabled']:
+            # Draft without word confidence is always uncertain
+            if not get_whisper_preset(self.settings)['word_timestamps'] and not self.two_pass_warning_shown:
+                logging.warning('Preset ' + str(self.settings['whisper_preset']) + ' has no word confidence, '
+                                + 'so two-pass transcribes every fragment twice! Use preset with word_timestamps')
+                self.two_pass_warning_shown = True
+
+            # Fast draft pass
+            self.load_draft_model()
+            words = self.transcribe_fragment(audio_file_, self.draft_model)
+            if not needs_retranscription(self.settings, words):
+                return words
+
+            # Replace uncertain draft with main model result
+            logging.info('Draft of ' + str(audio_file_[1]) + ' at ' + str(audio_file_[0])
+                         + 'ms is uncertain. Transcribing it again')
+
+        self.load_model()
+        return self.transcribe_fragment(audio_file_)
+
+    def transcribe_fragment(self, audio_file_: list, model=None):
+        """
+        Transcribes one audio fragment
+        :param audio_file_: [time, path, size, offset, samples]
+        :param model: loaded TranscriptionEngine or None to use main model
+        :return: list of (word, end time from the start of recording in milliseconds, confidence in percents)
+        """
+        if model is None:
+            model = self.model
+
+        # Load audio fragment
+        audio = pad_or_trim(self.load_fragment(audio_file_))
+
+        # Transcribe audio (model from model manager may be shared with other builders)
+        with model.lock:
+            return model.transcribe(audio, audio_file_[0])
+
+    def load_fragment(self, audio_file_: list):
+        """
+        Loads audio fragment from container or from file (ffmpeg is used only for foreign files)
+        :param audio_file_: [time, path, size, offset, samples]
+        :return: numpy 1D array of float32
+        """
+        if audio_file_[3] >= 0:
+            return read_container_fragment(audio_file_[1], audio_file_[3], audio_file_[4])
+
+        audio = read_wave_file(audio_file_[1])
+        if audio is None:
+            logging.info('Decoding ' + str(audio_file_[1]) + ' using ffmpeg')
+            audio = decode_audio_file(audio_file_[1])
+        return audio
+
+    def read_slide_frames(self):
+        """
+        Extracts frames of screenshots stored in slides containers
+        :return: dictionary {(container file, frame time): PNG image as io.BytesIO}
+        """
+        frames_times = {}
+        for screenshot in self.screenshots:
+            if len(screenshot) > 2:
+                frames_times.setdefault(screenshot[1], []).append(screenshot[0])
+
+        slide_frames = {}
+        for container_file, container_frames_times in frames_times.items():
+            logging.info('Extracting ' + str(len(container_frames_times)) + ' frames from ' + container_file)
+            for frame_time, frame in read_slide_frames(container_file, container_frames_times).items():
+                slide_frames[(container_file, frame_time)] = frame
+        return slide_frames
+
+    def add_screenshot(self, document, screenshot: list, slide_frames: dict):
+        """
+        Appends screenshot picture to the document
+        :param document: docx Document
+        :param screenshot: [time, file] or [time, slides container file, frame index]
+        :param slide_frames: frames from read_slide_frames()
+        :return:
+        """
+        if len(screenshot) > 2:
+            picture = slide_frames.get((screenshot[1], screenshot[0]))
+            if picture is None:
+                logging.warning('No frame ' + str(screenshot[0]) + ' in ' + str(screenshot[1]) + '! Skipping it')
+                return
+        else:
+            picture = os.path.normpath(str(screenshot[1]))
+        document.add_picture(picture, width=Inches(float(self.settings['lecture_picture_width_inches'])))
+
     def write_to_docx(self, words: list, timestamps_end: list, confidences_percents: list):
         """
         Finally writes words and screenshots to docx document
@@ -256,6 +593,9 @@ class LectureBuilder:
         document = Document()
         document.add_heading(self.lecture_name, 0)
 
+        # Extract only frames that will be embedded
+        slide_frames = self.read_slide_frames()
+
         # First screenshot
         current_screenshot = None
         if len(self.screenshots) > 0:
@@ -292,8 +632,7 @@ class LectureBuilder:
                 document.add_paragraph('')
 
                 # Append screenshot
-                document.add_picture(os.path.normpath(str(current_screenshot[1])), width=Inches(
-                    float(self.settings['lecture_picture_width_inches'])))
+                self.add_screenshot(document, current_screenshot, slide_frames)
 
                 # Get next screenshot
                 if len(self.screenshots) > 0:
@@ -310,8 +649,9 @@ class LectureBuilder:
             # Set font size
             run_.font.size = Pt(int(self.settings['lecture_font_size_pt']))
 
-            # Show low probability words
-            if confidence_percents <= int(self.settings['word_low_confidence_threshold_percents']):
+            # Show low probability words (unknown confidence is not shown)
+            if CONFIDENCE_UNKNOWN_PERCENTS < confidence_percents \
+                    <= int(self.settings['word_low_confidence_threshold_percents']):
                 text_colors = self.settings['lecture_low_confidence_text_color']
                 run_.font.color.rgb = RGBColor(int(text_colors[0]),
                                                int(text_colors[1]),
@@ -331,8 +671,7 @@ class LectureBuilder:
             document.add_paragraph('')
 
             # Append screenshot
-            document.add_picture(os.path.normpath(str(current_screenshot[1])), width=Inches(
-                float(self.settings['lecture_picture_width_inches'])))
+            self.add_screenshot(document, current_screenshot, slide_frames)
 
         # Create lectures directory
         lectures_dir = str(self.settings['lectures_directory_name'])
@@ -0,0 +1,121 @@
+"""
+ Copyright (C) 2022 Fern Lane, Webinar-hacker
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+import datetime
+import logging
+import re
+import threading
+import time
+
+# Optional start time before link: "2022-11-01 18:30 https://..." or "18:30 https://..."
+SCHEDULED_LINK_PATTERN = re.compile(r'^\s*(?:(\d{4}-\d{2}-\d{2})[ T])?(\d{1,2}):(\d{2})\s+(\S+)\s*$')
+
+
+def parse_scheduled_link(link_entry: str):
+    """
+    Splits link entry into start time and link
+    :param link_entry: link with optional start time prefix (YYYY-MM-DD HH:MM or HH:MM of today)
+    :return: (start timestamp in seconds or None, link)
+    """
+    link_entry = str(link_entry).strip()
+    match = SCHEDULED_LINK_PATTERN.match(link_entry)
+    if match is None:
+        return None, link_entry
+
+    date_str, hours, minutes, link = match.groups()
+    try:
+        if date_str is not None:
+            date = datetime.datetime.strptime(date_str, '%Y-%m-%d').date()
+        else:
+            date = datetime.date.today()
+        start_time = datetime.datetime.combine(date, datetime.time(int(hours), int(minutes)))
+        return start_time.timestamp(), link
+    except Exception as e:
+        logging.warning('Wrong start time of link ' + link_entry + '! ' + str(e))
+        return None, link
+
+
+class LinkScheduler:
+    def __init__(self, settings):
+        """
+        Starts links shortly before their start time instead of waiting on "before event" pages
+        :param settings: settings dictionary
+        """
+        self.settings = settings
+        self.timers = []
+        self.lock = threading.Lock()
+
+    def delay_seconds(self, start_time):
+        """
+        Calculates how long to wait before starting link
+        :param start_time: start timestamp in seconds or None
+        :return: delay in seconds (0 to start now)
+        """
+        if start_time is None or not self.settings['scheduler_enabled']:
+            return 0.
+        return max(start_time - float(self.settings['scheduler_lead_seconds']) - time.time(), 0.)
+
+    def schedule(self, start_time, callback, *args):
+        """
+        Calls callback shortly before start_time (immediately if start time is not set or already passed)
+        :param start_time: start timestamp in seconds or None
+        :param callback: function to call (from timer thread)
+        :param args: callback arguments
+        :return: True if callback was delayed
+        """
+        delay = self.delay_seconds(start_time)
+        if delay <= 0:
+            callback(*args)
+            return False
+
+        logging.info('Link scheduled at ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time() + delay)))
+        timer = threading.Timer(delay, self.timer_callback, args=(callback, args))
+        timer.daemon = True
+        with self.lock:
+            self.timers.append(timer)
+        timer.start()
+        return True
+
+    def timer_callback(self, callback, args):
+        """
+        Removes finished timer and calls scheduled callback
+        :param callback: scheduled function
+        :param args: callback arguments
+        :return:
+        """
+        with self.lock:
+            self.timers = [timer for timer in self.timers if timer.is_alive() and timer != threading.current_thread()]
+        callback(*args)
+
+    def get_scheduled(self):
+        """
+        :return: number of links waiting for their start time
+        """
+        with self.lock:
+            return len(self.timers)
+
+    def cancel(self):
+        """
+        Cancels all scheduled links
+        :return:
+        """
+        with self.lock:
+            timers = self.timers
+            self.timers = []
+        for timer in timers:
+            timer.cancel()
+        if len(timers) > 0:
+            logging.info('Canceled ' + str(len(timers)) + ' scheduled links')
@@ -0,0 +1,295 @@
+"""
+ Copyright (C) 2022 Fern Lane, Webinar-hacker
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+import collections
+import datetime
+import gc
+import logging
+import os
+import sys
+import threading
+import time
+
+import psutil
+
+from CallbackSignal import CallbackSignal
+from TranscriptionEngines import create_transcription_engine
+
+
+def parse_preload_time(preload_time: str):
+    """
+    Parses time of scheduled preload
+    :param preload_time: YYYY-MM-DD HH:MM or HH:MM of today (next day if already passed)
+    :return: timestamp in seconds or None if time is empty or wrong
+    """
+    preload_time = str(preload_time).strip()
+    if len(preload_time) == 0:
+        return None
+    try:
+        return datetime.datetime.strptime(preload_time, '%Y-%m-%d %H:%M').timestamp()
+    except ValueError:
+        pass
+    try:
+        time_ = datetime.datetime.strptime(preload_time, '%H:%M').time()
+        start_time = datetime.datetime.combine(datetime.date.today(), time_)
+        if start_time.timestamp() < time.time():
+            start_time += datetime.timedelta(days=1)
+        return start_time.timestamp()
+    except ValueError as e:
+        logging.warning('Wrong model preload time ' + preload_time + '! ' + str(e))
+        return None
+
+
+class ModelManager:
+    def __init__(self, settings, label_device_signal=None):
+        """
+        Keeps loaded transcription models between builds
+        Models are evicted by LRU to fit model_manager_memory_budget_mb and unloaded after idle time.
+        Models used by builds in progress (from get() until release()) are never evicted
+        :param settings: settings dictionary
+        :param label_device_signal: emits device name on model loading
+        """
+        self.settings = settings
+        self.label_device_signal = label_device_signal or CallbackSignal()
+
+        # Model name -> loaded TranscriptionEngine (least recently used first)
+        self.models = collections.OrderedDict()
+        self.models_size = {}
+        self.models_last_used = {}
+
+        # Model name -> builders using it, model name -> event set when loading is finished
+        self.models_users = {}
+        self.models_loading = {}
+
+        self.lock = threading.RLock()
+        self.process = psutil.Process(os.getpid())
+        self.idle_thread = None
+        self.idle_thread_running = False
+        self.preload_timer = None
+
+    def start(self):
+        """
+        Starts idle eviction thread and preloads models if enabled
+        :return:
+        """
+        if self.idle_thread is None:
+            self.idle_thread_running = True
+            self.idle_thread = threading.Thread(target=self.idle_loop, daemon=True)
+            self.idle_thread.start()
+            logging.info('Model manager thread: ' + self.idle_thread.name)
+
+        if self.settings['model_manager_preload_on_start']:
+            self.preload()
+
+        preload_time = parse_preload_time(str(self.settings['model_manager_preload_time']))
+        if preload_time is not None:
+            self.schedule_preload(preload_time)
+
+    def stop(self):
+        """
+        Cancels scheduled preload, stops idle thread and unloads models (doesn't wait for model that is being loaded)
+        Builders using models are asked to drop their references
+        :return:
+        """
+        if self.preload_timer is not None:
+            self.preload_timer.cancel()
+            self.preload_timer = None
+        self.idle_thread_running = False
+        self.idle_thread = None
+        with self.lock:
+            for model_name in list(self.models.keys()):
+                self.unload(model_name)
+
+    def get_default_models(self):
+        """
+        :return: names of models used by LectureBuilder with current settings
+        """
+        model_names = [str(self.settings['whisper_model_name'])]
+        if self.settings['two_pass_enabled']:
+            model_names.insert(0, str(self.settings['two_pass_draft_model_name']))
+        return model_names
+
+    def preload(self, model_names=None):
+        """
+        Loads models in background thread
+        :param model_names: list of model names or None to load models used by LectureBuilder
+        :return:
+        """
+        if model_names is None:
+            model_names = self.get_default_models()
+        thread = threading.Thread(target=self.preload_thread, args=(model_names,), daemon=True)
+        thread.start()
+        logging.info('Model preload thread: ' + thread.name)
+
+    def preload_thread(self, model_names: list):
+        """
+        Loads models one by one
+        :param model_names: list of model names
+        :return:
+        """
+        for model_name in model_names:
+            try:
+                self.get(model_name)
+            except Exception as e:
+                logging.error('Error preloading model ' + model_name + '! ' + str(e))
+
+    def schedule_preload(self, start_time: float):
+        """
+        Preloads models at start_time
+        :param start_time: timestamp in seconds
+        :return:
+        """
+        if self.preload_timer is not None:
+            self.preload_timer.cancel()
+        delay = max(start_time - time.time(), 0.)
+        logging.info('Model preload scheduled at ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start_time)))
+        self.preload_timer = threading.Timer(delay, self.preload)
+        self.preload_timer.daemon = True
+        self.preload_timer.start()
+
+    def get(self, model_name: str, user=None):
+        """
+        Returns loaded model (loads it if needed). Model is loaded without holding lock, so other models stay available
+        :param model_name: tiny, base, small, medium, large
+        :param user: builder that uses model until release(user) (must have drop_model(model_name) method) or None
+        :return: loaded TranscriptionEngine
+        """
+        while True:
+            with self.lock:
+                if model_name in self.models:
+                    self.models.move_to_end(model_name)
+                    self.models_last_used[model_name] = time.time()
+                    if user is not None:
+                        self.models_users.setdefault(model_name, set()).add(user)
+                    return self.models[model_name]
+
+                # Other thread is loading the same model
+                loading_event = self.models_loading.get(model_name)
+                if loading_event is None:
+                    loading_event = threading.Event()
+                    self.models_loading[model_name] = loading_event
+
+                    # Free memory for the model (size is known only if it was loaded before)
+                    self.evict(model_name, self.models_size.get(model_name, 0), user)
+                    break
+            loading_event.wait()
+
+        try:
+            # Load model
+            rss_before = self.process.memory_info().rss
+            engine = create_transcription_engine(self.settings, self.label_device_signal)
+            engine.load(model_name)
+
+            # Size of weights (RSS also includes allocator caches and imported packages, so it's only a fallback)
+            size_bytes = engine.get_size_bytes()
+            if size_bytes is None:
+                size_bytes = max(self.process.memory_info().rss - rss_before, 0)
+            logging.info('Model ' + model_name + ' loaded. Size: ' + str(int(size_bytes / 1024 / 1024)) + ' MB')
+
+            with self.lock:
+                self.models_size[model_name] = size_bytes
+                self.models[model_name] = engine
+                self.models_last_used[model_name] = time.time()
+                if user is not None:
+                    self.models_users.setdefault(model_name, set()).add(user)
+                self.evict(model_name, 0, user)
+            return engine
+        finally:
+            with self.lock:
+                del self.models_loading[model_name]
+            loading_event.set()
+
+    def release(self, user):
+        """
+        Marks models of the builder as not used, so they can be evicted or unloaded
+        :param user: builder passed to get()
+        :return:
+        """
+        with self.lock:
+            for users in self.models_users.values():
+                users.discard(user)
+
+    def is_used(self, model_name: str):
+        """
+        :param model_name: model name
+        :return: True if model is used by some build in progress
+        """
+        return len(self.models_users.get(model_name, ())) > 0
+
+    def evict(self, keep_model_name: str, extra_bytes: int, user=None):
+        """
+        Unloads least recently used models while memory budget is exceeded (except models in use)
+        :param keep_model_name: model that must not be unloaded
+        :param extra_bytes: memory that will be needed for the next model
+        :param user: builder that requests the model
+        :return:
+        """
+        budget_bytes = int(self.settings['model_manager_memory_budget_mb']) * 1024 * 1024
+        if budget_bytes <= 0:
+            return
+        with self.lock:
+            for model_name in list(self.models.keys()):
+                used_bytes = sum(self.models_size.get(name, 0) for name in self.models.keys())
+                if used_bytes + extra_bytes <= budget_bytes:
+                    return
+                if model_name != keep_model_name and not self.is_used(model_name):
+                    logging.info('Memory budget exceeded. Unloading model ' + model_name)
+                    self.unload(model_name)
+
+            # Reloading models for each fragment would be even slower
+            used_bytes = sum(self.models_size.get(name, 0) for name in self.models.keys())
+            if used_bytes + extra_bytes > budget_bytes:
+                logging.warning('Memory budget is too small for models in use! Keeping them loaded')
+
+    def unload(self, model_name: str):
+        """
+        Unloads model and asks builders to drop their references, so memory is actually freed
+        :param model_name: model name
+        :return:
+        """
+        with self.lock:
+            if model_name not in self.models:
+                return
+            logging.info('Unloading model ' + model_name)
+            del self.models[model_name]
+            del self.models_last_used[model_name]
+            for user in self.models_users.pop(model_name, ()):
+                user.drop_model(model_name)
+        gc.collect()
+
+        # Free GPU memory only if torch was already imported
+        if 'torch' in sys.modules:
+            try:
+                torch = sys.modules['torch']
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+            except Exception as e:
+                logging.warning('Error freeing GPU memory! ' + str(e))
+
+    def idle_loop(self):
+        """
+        Unloads models that were not used for model_manager_idle_unload_seconds
+        :return:
+        """
+        while self.idle_thread_running:
+            idle_seconds = float(self.settings['model_manager_idle_unload_seconds'])
+            if idle_seconds > 0:
+                with self.lock:
+                    for model_name, last_used in list(self.models_last_used.items()):
+                        if time.time() - last_used > idle_seconds and not self.is_used(model_name):
+                            logging.info('Model ' + model_name + ' is idle')
+                            self.unload(model_name)
+            time.sleep(float(self.settings['model_manager_check_interval_seconds']))
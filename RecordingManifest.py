@@ -0,0 +1,124 @@
+"""
+ Copyright (C) 2022 Fern Lane, Webinar-hacker
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+MANIFEST_ENTRY_START = 'start'
+MANIFEST_ENTRY_AUDIO = 'audio'
+MANIFEST_ENTRY_SCREENSHOT = 'screenshot'
+
+
+def load_manifest(manifest_file: str):
+    """
+    Loads all entries from manifest file
+    :param manifest_file: path to manifest.jsonl
+    :return: list of entries (dicts) or None if file not exists
+    """
+    if not os.path.exists(manifest_file):
+        return None
+
+    entries = []
+    with open(manifest_file, 'r', encoding='utf-8') as file:
+        for line in file:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            try:
+                entries.append(json.loads(line))
+
+            # Last line can be broken if app was killed during writing
+            except Exception as e:
+                logging.warning('Skipping broken manifest line! ' + str(e))
+    return entries
+
+
+class RecordingManifest:
+    def __init__(self, manifest_file: str):
+        """
+        Append-only manifest of recording (one json entry per line)
+        :param manifest_file: path to manifest.jsonl inside recording directory
+        """
+        self.manifest_file = manifest_file
+        self.lock = threading.Lock()
+
+    def append(self, entry: dict):
+        """
+        Appends entry to the end of manifest file
+        :param entry: dictionary with at least 'type' key
+        :return:
+        """
+        with self.lock:
+            try:
+                with open(self.manifest_file, 'a', encoding='utf-8') as file:
+                    file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            except Exception as e:
+                logging.warning('Error writing to manifest ' + self.manifest_file + '! ' + str(e))
+
+    def add_start(self, recording_name: str, record_from: int):
+        """
+        Appends recording start entry
+        :param recording_name: name of recording directory
+        :param record_from: RECORD_FROM_DEVICE or RECORD_FROM_FRAMES
+        :return:
+        """
+        self.append({'type': MANIFEST_ENTRY_START,
+                     'name': recording_name,
+                     'record_from': record_from,
+                     'timestamp': int(time.time() * 1000)})
+
+    def add_audio(self, time_ms: int, file: str, sampling_rate: int, samples: int, peak_dbfs: float, rms_dbfs: float,
+                  offset=-1):
+        """
+        Appends audio fragment entry
+        :param time_ms: fragment offset from the start of recording
+        :param file: path to the fragment relative to recording directory
+        :param sampling_rate: sampling rate of the fragment
+        :param samples: number of samples written
+        :param peak_dbfs: peak level of the fragment
+        :param rms_dbfs: RMS level of the fragment
+        :param offset: offset of the fragment in samples inside audio container or -1 for standalone file
+        :return:
+        """
+        entry = {'type': MANIFEST_ENTRY_AUDIO,
+                 'time': int(time_ms),
+                 'duration': int(samples * 1000 / sampling_rate) if sampling_rate > 0 else 0,
+                 'sampling_rate': int(sampling_rate),
+                 'samples': int(samples),
+                 'peak_dbfs': round(float(peak_dbfs), 2),
+                 'rms_dbfs': round(float(rms_dbfs), 2),
+                 'file': file}
+        if offset >= 0:
+            entry['offset'] = int(offset)
+        self.append(entry)
+
+    def add_screenshot(self, time_ms: int, file: str, frame=-1):
+        """
+        Appends screenshot entry
+        :param time_ms: screenshot offset from the start of recording
+        :param file: path to the screenshot relative to recording directory
+        :param frame: index of the frame inside slides container or -1 for standalone image
+        :return:
+        """
+        entry = {'type': MANIFEST_ENTRY_SCREENSHOT,
+                 'time': int(time_ms),
+                 'file': file}
+        if frame >= 0:
+            entry['frame'] = int(frame)
+        self.append(entry)
@@ -0,0 +1,424 @@
+"""
+ Copyright (C) 2022 Fern Lane, Webinar-hacker
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+import logging
+import time
+
+import cv2
+import numpy as np
+
+SAVING_TEXT_COLOR = (85, 85, 217)
+
+SETTLE_STATE_IDLE = 0
+SETTLE_STATE_CHANGING = 1
+
+
+def resize_keep_ratio(source_image, target_width, target_height, interpolation=cv2.INTER_AREA):
+    """
+    Resize image and keeps aspect ratio (background fills with black)
+    """
+    border_v = 0
+    border_h = 0
+    if (target_height / target_width) >= (source_image.shape[0] / source_image.shape[1]):
+        border_v = int((((target_height / target_width) * source_image.shape[1]) - source_image.shape[0]) / 2)
+    else:
+        border_h = int((((target_width / target_height) * source_image.shape[0]) - source_image.shape[1]) / 2)
+    output_image = cv2.copyMakeBorder(source_image, border_v, border_v, border_h, border_h, cv2.BORDER_CONSTANT, 0)
+    return cv2.resize(output_image, (target_width, target_height), interpolation)
+
+
+def show_preview(preview_label, opencv_image, saving=False):
+    """
+    Shows image in preview label from any thread (does nothing without GUI)
+    :param preview_label: QLabel or None
+    :param opencv_image: BGR image or None to clear preview
+    :param saving: True to put Saving... text on top of the image
+    :return:
+    """
+    if preview_label is None:
+        return
+
+    # Import Qt only if there is GUI
+    from PyQt5.QtGui import QPixmap, QImage
+    from qt_thread_updater import get_updater
+
+    # Clear preview image
+    if opencv_image is None:
+        get_updater().call_latest(preview_label.clear)
+        get_updater().call_latest(preview_label.setText, 'No image')
+        return
+
+    # Resize preview
+    preview_resized = resize_keep_ratio(opencv_image, preview_label.size().width(), preview_label.size().height())
+
+    # Put Saving... text on top of the image
+    if saving:
+        cv2.putText(preview_resized, 'Saving...', (10, preview_resized.shape[0] // 2),
+                    cv2.FONT_HERSHEY_SIMPLEX, 2, SAVING_TEXT_COLOR, 2, cv2.LINE_AA)
+
+    # Convert to pixmap
+    pixmap = QPixmap.fromImage(
+        QImage(preview_resized.data, preview_resized.shape[1], preview_resized.shape[0],
+               3 * preview_resized.shape[1], QImage.Format_BGR888))
+
+    # Push to preview
+    get_updater().call_latest(preview_label.setPixmap, pixmap)
+
+
+def frame_difference_map(opencv_image, opencv_image_prev, opencv_threshold: int):
+    """
+    Finds changed pixels between two images
+    :param opencv_image: current BGR image
+    :param opencv_image_prev: previous BGR image (any size) or None
+    :param opencv_threshold: minimum difference of gray pixel to count it as changed (0-255)
+    :return: binary image (255 - changed pixel)
+    """
+    # First start -> compare with black image
+    if opencv_image_prev is None:
+        opencv_image_prev = np.zeros(opencv_image.shape, dtype=opencv_image.dtype)
+
+    # Resize prev image
+    if opencv_image_prev.shape != opencv_image.shape:
+        opencv_image_prev = cv2.resize(opencv_image_prev, (opencv_image.shape[1], opencv_image.shape[0]))
+
+    # Find difference
+    diff = cv2.absdiff(opencv_image, opencv_image_prev).astype('uint8')
+
+    # Convert to grayscale
+    diff = cv2.cvtColor(diff, cv2.COLOR_BGR2GRAY)
+
+    # Apply threshold
+    _, thresh = cv2.threshold(diff, opencv_threshold, 255, cv2.THRESH_BINARY)
+    return thresh
+
+
+def changed_percents(thresh, mask=None):
+    """
+    Calculates how many pixels changed inside mask
+    :param thresh: binary image from frame_difference_map()
+    :param mask: binary image of the same size (255 - pixel is checked) or None to check whole image
+    :return: changed pixels in percents
+    """
+    if mask is None:
+        area = thresh.shape[1] * thresh.shape[0]
+    else:
+        thresh = cv2.bitwise_and(thresh, mask)
+        area = cv2.countNonZero(mask)
+    if area <= 0:
+        return 0.
+    return (cv2.countNonZero(thresh) / area) * 100
+
+
+def frame_difference_percents(opencv_image, opencv_image_prev, opencv_threshold: int, mask=None):
+    """
+    Calculates how many pixels changed between two images
+    :param opencv_image: current BGR image
+    :param opencv_image_prev: previous BGR image (any size) or None
+    :param opencv_threshold: minimum difference of gray pixel to count it as changed (0-255)
+    :param mask: binary image (255 - pixel is checked) or None to check whole image
+    :return: changed pixels in percents
+    """
+    return changed_percents(frame_difference_map(opencv_image, opencv_image_prev, opencv_threshold), mask)
+
+
+def regions_to_mask(mask, regions: list, value: int):
+    """
+    Fills rectangles on mask
+    :param mask: binary image
+    :param regions: list of [x, y, width, height] in normalized (0-1) coordinates
+    :param value: 0 or 255
+    :return:
+    """
+    height, width = mask.shape[: 2]
+    for region in regions:
+        x, y, region_width, region_height = [float(value_) for value_ in region]
+        mask[int(y * height): int(round((y + region_height) * height)),
+             int(x * width): int(round((x + region_width) * width))] = value
+
+
+class AdaptiveSampler:
+    def __init__(self, settings):
+        """
+        Samples frames faster after a change and slower during static periods
+        :param settings: settings dictionary
+        """
+        self.settings = settings
+        self.interval = 0.
+        self.samples = 0
+        self.time_report = -1.
+        self.reset()
+
+    def reset(self):
+        """
+        Resets interval and rate counters
+        :return:
+        """
+        self.interval = float(self.settings['screenshot_interval_min_seconds'])
+        self.samples = 0
+        self.time_report = -1.
+
+    def get_interval(self):
+        """
+        :return: time to wait before next sample in seconds
+        """
+        if not self.settings['screenshot_adaptive_enabled']:
+            return float(self.settings['loop_interval_seconds'])
+        return self.interval
+
+    def on_sample(self, changed: bool, sample_time=None):
+        """
+        Updates interval after sample was compared with previous one
+        :param changed: True if difference was above threshold
+        :param sample_time: time of the sample in seconds (wall time if None)
+        :return:
+        """
+        if sample_time is None:
+            sample_time = time.time()
+
+        # Change -> sample as fast as allowed, static -> decay rate
+        if changed:
+            self.interval = float(self.settings['screenshot_interval_min_seconds'])
+        else:
+            self.interval = min(self.interval * float(self.settings['screenshot_interval_decay']),
+                                float(self.settings['screenshot_interval_max_seconds']))
+
+        # Report effective rate
+        self.samples += 1
+        if self.time_report < 0:
+            self.time_report = sample_time
+        elif sample_time - self.time_report >= float(self.settings['screenshot_rate_report_seconds']):
+            logging.info('Effective capture rate: '
+                         + str(round(self.samples * 60 / (sample_time - self.time_report), 1)) + ' frames/min')
+            self.samples = 0
+            self.time_report = sample_time
+
+
+class SettledFrameDetector:
+    def __init__(self, settings):
+        """
+        Waits until frame stops changing after a transition, so only the settled frame is saved
+        :param settings: settings dictionary
+        """
+        self.settings = settings
+        self.state = SETTLE_STATE_IDLE
+        self.stable_samples = 0
+        self.changing_samples = 0
+
+    def reset(self):
+        """
+        Resets state machine
+        :return:
+        """
+        self.state = SETTLE_STATE_IDLE
+        self.stable_samples = 0
+        self.changing_samples = 0
+
+    def is_settling(self):
+        """
+        :return: True if change was detected and frame is not settled yet
+        """
+        return self.state == SETTLE_STATE_CHANGING
+
+    def on_sample(self, diff_percents: float):
+        """
+        Updates state with difference between current and previous sample
+        :param diff_percents: changed pixels in percents
+        :return: True if current frame is settled and must be saved
+        """
+        settle_samples = int(self.settings['screenshot_settle_samples'])
+
+        # Idle -> wait for change
+        if self.state == SETTLE_STATE_IDLE:
+            if diff_percents < int(self.settings['screenshot_diff_threshold_percents']):
+                return False
+
+            # Settling disabled
+            if settle_samples <= 0:
+                return True
+
+            self.state = SETTLE_STATE_CHANGING
+            self.stable_samples = 0
+            self.changing_samples = 0
+            return False
+
+        # Changing -> count stable samples
+        if diff_percents < float(self.settings['screenshot_settle_threshold_percents']):
+            self.stable_samples += 1
+        else:
+            self.stable_samples = 0
+        self.changing_samples += 1
+
+        # Settled or changing for too long (video, scrolling)
+        if self.stable_samples >= settle_samples \
+                or self.changing_samples >= int(self.settings['screenshot_settle_max_samples']):
+            if self.stable_samples < settle_samples:
+                logging.info('Frame did not settle, saving anyway')
+            self.state = SETTLE_STATE_IDLE
+            return True
+        return False
+
+
+class RegionMask:
+    def __init__(self, settings):
+        """
+        Excludes regions of the frame from change detection (webcam overlays, pointers, clocks)
+        Regions from settings are combined with automatically detected persistently changing regions
+        :param settings: settings dictionary
+        """
+        self.settings = settings
+        self.activity = None
+        self.samples = 0
+        self.auto_cells = None
+        self.mask = None
+
+    def reset(self):
+        """
+        Clears auto-detected regions (call before new recording)
+        :return:
+        """
+        self.activity = None
+        self.samples = 0
+        self.auto_cells = None
+        self.mask = None
+
+    def update(self, thresh):
+        """
+        Updates activity of grid cells with changed pixels
+        :param thresh: binary image from frame_difference_map()
+        :return:
+        """
+        if not self.settings['screenshot_auto_mask_enabled']:
+            return
+
+        grid_width, grid_height = [int(value) for value in self.settings['screenshot_auto_mask_grid']]
+        cells_changed = cv2.resize(thresh, (grid_width, grid_height), interpolation=cv2.INTER_AREA) > 0
+
+        # Exponential moving average of changes in each cell
+        alpha = 1. / max(int(self.settings['screenshot_auto_mask_window']), 1)
+        if self.activity is None or self.activity.shape != cells_changed.shape:
+            self.activity = np.zeros(cells_changed.shape, dtype=np.float32)
+            self.samples = 0
+        self.activity = self.activity * (1. - alpha) + cells_changed * alpha
+        self.samples += 1
+        if self.samples < int(self.settings['screenshot_auto_mask_window']):
+            return
+
+        # Cells that change almost every sample
+        auto_cells = self.activity >= float(self.settings['screenshot_auto_mask_ratio'])
+
+        # Too big area changes (video is shown) -> don't mask anything
+        auto_percents = np.count_nonzero(auto_cells) * 100 / auto_cells.size
+        if auto_percents > int(self.settings['screenshot_auto_mask_max_percents']):
+            auto_cells[:] = False
+
+        if self.auto_cells is None or not np.array_equal(auto_cells, self.auto_cells):
+            logging.info('Auto mask: ' + str(np.count_nonzero(auto_cells)) + ' of ' + str(auto_cells.size) + ' cells')
+            self.auto_cells = auto_cells
+            self.mask = None
+
+    def get_mask(self, shape):
+        """
+        Builds mask for frame of specified size
+        :param shape: shape of the binary image from frame_difference_map()
+        :return: binary image (255 - pixel is checked) or None if whole frame is checked
+        """
+        include_regions = self.settings['screenshot_include_regions']
+        ignore_regions = self.settings['screenshot_ignore_regions']
+        auto_masked = self.auto_cells is not None and np.count_nonzero(self.auto_cells) > 0
+        if len(include_regions) == 0 and len(ignore_regions) == 0 and not auto_masked:
+            return None
+
+        # Use cached mask
+        if self.mask is not None and self.mask.shape == shape[: 2]:
+            return self.mask
+
+        # Include regions (whole frame if not specified)
+        if len(include_regions) > 0:
+            mask = np.zeros(shape[: 2], dtype=np.uint8)
+            regions_to_mask(mask, include_regions, 255)
+        else:
+            mask = np.full(shape[: 2], 255, dtype=np.uint8)
+
+        # Ignore regions
+        regions_to_mask(mask, ignore_regions, 0)
+
+        # Auto-detected regions
+        if auto_masked:
+            auto_mask = cv2.resize(self.auto_cells.astype(np.uint8), (shape[1], shape[0]),
+                                   interpolation=cv2.INTER_NEAREST)
+            mask[auto_mask > 0] = 0
+
+        self.mask = mask
+        return self.mask
+
+
+class ScreenshotProcessor:
+    def __init__(self, settings):
+        """
+        Decides which captured frames must be saved
+        :param settings: settings dictionary
+        """
+        self.settings = settings
+        self.sampler = AdaptiveSampler(settings)
+        self.settled_frame_detector = SettledFrameDetector(settings)
+        self.region_mask = RegionMask(settings)
+        self.opencv_image_prev = None
+        self.opencv_image_saved = None
+
+    def reset(self):
+        """
+        Clears previous frame and sampler state (call before new recording)
+        :return:
+        """
+        self.opencv_image_prev = None
+        self.opencv_image_saved = None
+        self.sampler.reset()
+        self.settled_frame_detector.reset()
+        self.region_mask.reset()
+
+    def process(self, opencv_image, sample_time=None):
+        """
+        Compares frame with previous one and waits until it settles after a change
+        :param opencv_image: BGR image
+        :param sample_time: time of the frame in seconds (wall time if None)
+        :return: True if frame must be saved
+        """
+        thresh = frame_difference_map(opencv_image, self.opencv_image_prev, int(self.settings['opencv_threshold']))
+
+        # Apply regions of interest before threshold
+        self.region_mask.update(thresh)
+        mask = self.region_mask.get_mask(thresh.shape)
+        diff_percents = changed_percents(thresh, mask)
+        logging.info('Difference: ' + str(int(diff_percents)) + '%')
+
+        # Store current image for next cycle
+        self.opencv_image_prev = opencv_image
+
+        save = self.settled_frame_detector.on_sample(diff_percents)
+
+        # Transition may end on the same frame (for example, popup was shown and hidden)
+        if save and self.opencv_image_saved is not None and int(self.settings['screenshot_settle_samples']) > 0:
+            diff_saved_percents = frame_difference_percents(opencv_image, self.opencv_image_saved,
+                                                            int(self.settings['opencv_threshold']), mask)
+            if diff_saved_percents < int(self.settings['screenshot_diff_threshold_percents']):
+                logging.info('Settled frame is the same as saved one')
+                save = False
+        if save:
+            self.opencv_image_saved = opencv_image
+
+        # Sample fast while frame is changing
+        self.sampler.on_sample(save or self.settled_frame_detector.is_settling(), sample_time)
+        return save
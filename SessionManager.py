@@ -0,0 +1,310 @@
+"""
+ Copyright (C) 2022 Fern Lane, Webinar-hacker
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psutil
+
+from AudioHandler import AudioHandler
+from BrowserHandler import BrowserHandler, LINK_TYPE_ZOOM
+from CallbackSignal import CallbackSignal
+from CaptureBackends import CAPTURE_BACKEND_TAB
+from LinkScheduler import LinkScheduler, parse_scheduled_link
+
+
+class RecordingSession:
+    def __init__(self, manager, session_index: int, link: str, user_name: str, preview_label=None,
+                 progress_bar_audio_signal=None, label_rec_set_stylesheet_signal=None,
+                 label_current_link_time_signal=None):
+        """
+        One meeting with its own browser, capture source, recording directory and handler thread
+        :param manager: SessionManager
+        :param session_index: index of session (used in recording name)
+        :param link: webinar / zoom link
+        :param user_name: connect with this name
+        :param preview_label: label for preview or None
+        """
+        self.manager = manager
+        self.settings = manager.settings
+        self.session_index = session_index
+
+        # Other backends record the same system audio mix into every session
+        if str(self.settings['audio_capture_backend']).strip().lower() != CAPTURE_BACKEND_TAB:
+            logging.warning('Concurrent sessions record audio of their own tabs only. Using '
+                            + CAPTURE_BACKEND_TAB + ' capture backend instead of '
+                            + str(self.settings['audio_capture_backend']))
+            self.settings = dict(self.settings)
+            self.settings['audio_capture_backend'] = CAPTURE_BACKEND_TAB
+
+        self.link = link
+        self.user_name = user_name
+        self.reconnects = 0
+        self.processes = {}
+
+        # Audio handler with shared pools
+        self.audio_handler = AudioHandler(self.settings,
+                                          progress_bar_audio_signal or CallbackSignal(),
+                                          label_rec_set_stylesheet_signal or CallbackSignal())
+        self.audio_handler.recording_name_suffix = '_' + str(session_index + 1)
+        self.audio_handler.screenshot_pool = manager.screenshot_pool
+        self.audio_handler.writer_pool = manager.writer_pool
+        self.audio_handler.background_transcriber = manager.background_transcriber
+
+        # Browser handler that reports to this session instead of main window
+        self.browser_handler = BrowserHandler(self.audio_handler, self.settings, CallbackSignal(self.on_finished),
+                                              preview_label, label_current_link_time_signal or CallbackSignal())
+
+    def start(self):
+        """
+        Opens audio stream and browser and starts handler
+        :return:
+        """
+        logging.info('Starting session ' + str(self.session_index + 1) + ' with link ' + self.link)
+
+        # Audio stream must be opened before browser (tab capture needs its url)
+        if self.settings['gui_recording_enabled']:
+            self.audio_handler.open_stream()
+
+        self.browser_handler.start_browser(self.link)
+        if self.browser_handler.browser is not None:
+            self.browser_handler.start_handler(self.user_name)
+
+    def stop(self, keep_warm=False):
+        """
+        Stops recording and closes browser
+        :param keep_warm: True to keep browser running for reconnect
+        :return:
+        """
+        logging.info('Stopping session ' + str(self.session_index + 1))
+        self.audio_handler.close_stream()
+        self.browser_handler.stop_handler()
+        self.browser_handler.stop_browser(keep_warm=keep_warm)
+
+    def on_finished(self, from_zoom: bool):
+        """
+        Called from handler thread when meeting is finished, timed out or browser was closed
+        :param from_zoom: True if link is zoom link (may be reconnected)
+        :return:
+        """
+        # Handler thread must exit first, so stop session from another thread
+        threading.Thread(target=self.manager.session_finished, args=(self, from_zoom)).start()
+
+    def get_stats(self, python_cpu_percents: float, python_rss: int, sessions_count: int):
+        """
+        Calculates CPU and RAM usage of this session
+        Chrome processes are counted fully and python process is shared equally between sessions
+        :return: dictionary with session, link, cpu_percents and ram_mb keys
+        """
+        cpu_percents = python_cpu_percents / sessions_count
+        rss = python_rss / sessions_count
+        try:
+            browser = self.browser_handler.browser
+            if browser is not None:
+                driver_process = psutil.Process(browser.service.process.pid)
+                for process in [driver_process] + driver_process.children(recursive=True):
+                    # Reuse process objects to get CPU usage since previous call
+                    if process.pid not in self.processes:
+                        self.processes[process.pid] = process
+                    process = self.processes[process.pid]
+                    cpu_percents += process.cpu_percent(None)
+                    rss += process.memory_info().rss
+        except Exception as e:
+            logging.warning('Error reading browser processes! ' + str(e))
+        return {'session': self.session_index + 1,
+                'link': self.link,
+                'cpu_percents': round(cpu_percents, 1),
+                'ram_mb': int(rss / 1024 / 1024)}
+
+
+class SessionManager:
+    def __init__(self, settings, sessions_finished_signal, preview_label=None, progress_bar_audio_signal=None,
+                 label_rec_set_stylesheet_signal=None, label_current_link_time_signal=None):
+        """
+        Runs several recording sessions at once (up to concurrent_sessions_max, other links are queued)
+        :param settings: settings dictionary
+        :param sessions_finished_signal: emitted when all sessions are finished
+        :param preview_label: preview label for the first session
+        """
+        self.settings = settings
+        self.sessions_finished_signal = sessions_finished_signal
+        self.preview_label = preview_label
+        self.progress_bar_audio_signal = progress_bar_audio_signal
+        self.label_rec_set_stylesheet_signal = label_rec_set_stylesheet_signal
+        self.label_current_link_time_signal = label_current_link_time_signal
+
+        # Pools shared between all sessions
+        self.screenshot_pool = ThreadPoolExecutor(max_workers=int(settings['sessions_screenshot_pool_workers']),
+                                                  thread_name_prefix='screenshot')
+        self.writer_pool = ThreadPoolExecutor(max_workers=int(settings['sessions_writer_pool_workers']),
+                                              thread_name_prefix='writer')
+
+        self.link_scheduler = LinkScheduler(settings)
+        self.background_transcriber = None
+        self.sessions = []
+        self.pending_links = []
+        self.user_name = ''
+        self.sessions_started = 0
+        self.lock = threading.Lock()
+        self.process = psutil.Process(os.getpid())
+        self.stats_thread = None
+
+    def start_sessions(self, links: list, user_name: str):
+        """
+        Starts sessions for all non-empty links
+        :param links: list of links
+        :param user_name: connect with this name
+        :return:
+        """
+        with self.lock:
+            self.user_name = user_name
+            self.sessions_started = 0
+            self.pending_links = []
+        links = [str(link).strip() for link in links if len(str(link).strip()) > 0]
+        logging.info('Starting ' + str(len(links)) + ' links with up to '
+                     + str(int(self.settings['concurrent_sessions_max'])) + ' concurrent sessions')
+
+        # Queue links now or shortly before their start time
+        for link in links:
+            start_time, link = parse_scheduled_link(link)
+            self.link_scheduler.schedule(start_time, self.add_pending, link)
+
+    def start_stats(self):
+        """
+        Starts stats thread if it's not running (it exits when there are no sessions)
+        :return:
+        """
+        with self.lock:
+            if self.stats_thread is None:
+                self.stats_thread = threading.Thread(target=self.stats_loop)
+                self.stats_thread.start()
+                logging.info('Sessions stats thread: ' + self.stats_thread.name)
+
+    def add_pending(self, link: str):
+        """
+        Queues link and starts it if there is free session slot
+        :param link: link without start time
+        :return:
+        """
+        with self.lock:
+            self.pending_links.append(link)
+        self.start_pending()
+
+    def start_pending(self):
+        """
+        Starts queued links while there are free session slots
+        :return:
+        """
+        while True:
+            with self.lock:
+                if len(self.pending_links) == 0 \
+                        or len(self.sessions) >= int(self.settings['concurrent_sessions_max']):
+                    break
+                link = self.pending_links.pop(0)
+
+                # Only the first session is shown in GUI
+                first = len(self.sessions) == 0
+                session = RecordingSession(self, self.sessions_started, link, self.user_name,
+                                           self.preview_label if first else None,
+                                           self.progress_bar_audio_signal if first else None,
+                                           self.label_rec_set_stylesheet_signal if first else None,
+                                           self.label_current_link_time_signal if first else None)
+                self.sessions_started += 1
+                self.sessions.append(session)
+            try:
+                session.start()
+                self.start_stats()
+            except Exception as e:
+                logging.error(e, exc_info=True)
+                self.session_finished(session, False)
+
+    def stop_sessions(self):
+        """
+        Stops all sessions and clears queue
+        :return:
+        """
+        self.link_scheduler.cancel()
+        with self.lock:
+            sessions = self.sessions
+            self.sessions = []
+            self.pending_links = []
+        for session in sessions:
+            session.stop()
+
+    def session_finished(self, session: RecordingSession, from_zoom: bool):
+        """
+        Stops finished session, reconnects zoom links and starts next queued link
+        :param session: finished RecordingSession
+        :param from_zoom: True if link is zoom link
+        :return:
+        """
+        # Reconnect for zoom
+        reconnect = from_zoom and session.browser_handler.link_type == LINK_TYPE_ZOOM \
+            and self.settings['gui_zoom_reconnects_enabled'] \
+            and session.reconnects < int(self.settings['gui_zoom_reconnects_max'])
+
+        session.stop(keep_warm=reconnect and self.settings['browser_keep_warm'])
+
+        if reconnect:
+            session.reconnects += 1
+            logging.info('Reconnecting session ' + str(session.session_index + 1) + '...')
+            session.start()
+            return
+
+        with self.lock:
+            if session in self.sessions:
+                self.sessions.remove(session)
+        self.start_pending()
+
+        # All done
+        with self.lock:
+            all_finished = len(self.sessions) == 0 and len(self.pending_links) == 0 \
+                           and self.link_scheduler.get_scheduled() == 0
+        if all_finished:
+            logging.info('All sessions finished')
+            self.sessions_finished_signal.emit()
+
+    def get_stats(self):
+        """
+        Calculates CPU and RAM usage per running session
+        :return: list of dictionaries from RecordingSession.get_stats()
+        """
+        with self.lock:
+            sessions = list(self.sessions)
+        python_cpu_percents = self.process.cpu_percent(None)
+        python_rss = self.process.memory_info().rss
+        return [session.get_stats(python_cpu_percents, python_rss, len(sessions)) for session in sessions]
+
+    def stats_loop(self):
+        """
+        Logs sessions stats while sessions are running
+        :return:
+        """
+        interval = float(self.settings['sessions_stats_interval_seconds'])
+        while True:
+            time.sleep(interval)
+
+            # Cleared under lock, so start_stats() of the next session starts new thread
+            with self.lock:
+                if len(self.sessions) == 0:
+                    self.stats_thread = None
+                    break
+            for stats in self.get_stats():
+                logging.info('Session ' + str(stats['session']) + ': CPU ' + str(stats['cpu_percents']) + '%, RAM '
+                             + str(stats['ram_mb']) + ' MB')
@@ -0,0 +1,136 @@
+"""
+ Copyright (C) 2022 Fern Lane, Webinar-hacker
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+import io
+import logging
+import threading
+from fractions import Fraction
+
+import av
+import cv2
+
+from ScreenshotProcessor import resize_keep_ratio
+
+# Frame timestamps are milliseconds from the start of recording
+SLIDE_CONTAINER_TIME_BASE = Fraction(1, 1000)
+
+
+class SlideContainerWriter:
+    def __init__(self, settings, container_file: str):
+        """
+        Appends slide frames into single low-fps video file (frame pts = time of screenshot)
+        :param settings: settings dictionary
+        :param container_file: path to video file (opened on the first frame)
+        """
+        self.settings = settings
+        self.container_file = container_file
+        self.container = None
+        self.stream = None
+        self.frames = 0
+        self.pts_last = -1
+        self.lock = threading.Lock()
+
+    def open(self, width: int, height: int):
+        """
+        Opens container and adds video stream
+        :param width: frame width (rounded down to even)
+        :param height: frame height (rounded down to even)
+        :return:
+        """
+        codec = str(self.settings['screenshot_container_codec'])
+        logging.info('Storing slides into: ' + self.container_file + ' (' + codec + ')')
+        self.container = av.open(self.container_file, 'w')
+        self.stream = self.container.add_stream(codec, options={str(key): str(value) for key, value
+                                                                in self.settings['screenshot_container_options']
+                                                                .items()})
+        self.stream.width = width - width % 2
+        self.stream.height = height - height % 2
+        self.stream.pix_fmt = 'yuvj420p' if codec == 'mjpeg' else 'yuv420p'
+        self.stream.codec_context.time_base = SLIDE_CONTAINER_TIME_BASE
+
+    def write(self, opencv_image, frame_time: int):
+        """
+        Encodes frame into container
+        :param opencv_image: BGR image (resized to the size of the first frame)
+        :param frame_time: milliseconds from the start of recording
+        :return: index of the frame or -1 in case of error
+        """
+        with self.lock:
+            # Timestamps must increase
+            if frame_time <= self.pts_last:
+                logging.warning('Slide frame ' + str(frame_time) + ' is older than previous one! Skipping it')
+                return -1
+
+            if self.container is None:
+                self.open(opencv_image.shape[1], opencv_image.shape[0])
+
+            if opencv_image.shape[1] != self.stream.width or opencv_image.shape[0] != self.stream.height:
+                opencv_image = resize_keep_ratio(opencv_image, self.stream.width, self.stream.height)
+
+            frame = av.VideoFrame.from_ndarray(opencv_image, format='bgr24')
+            frame.pts = frame_time
+            frame.time_base = SLIDE_CONTAINER_TIME_BASE
+            for packet in self.stream.encode(frame):
+                self.container.mux(packet)
+            self.pts_last = frame_time
+            self.frames += 1
+            return self.frames - 1
+
+    def close(self):
+        """
+        Flushes encoder and closes container
+        :return:
+        """
+        with self.lock:
+            if self.container is None:
+                return
+            try:
+                for packet in self.stream.encode(None):
+                    self.container.mux(packet)
+                self.container.close()
+                logging.info('Slides container closed with ' + str(self.frames) + ' frames')
+            except Exception as e:
+                logging.error('Error closing slides container ' + self.container_file + '! ' + str(e))
+            self.container = None
+            self.stream = None
+
+
+def read_slide_frames(container_file: str, frames_times: list):
+    """
+    Decodes only requested frames from slides container
+    :param container_file: path to video file written by SlideContainerWriter
+    :param frames_times: list of frame times in milliseconds
+    :return: dictionary {frame_time: PNG image as io.BytesIO}
+    """
+    frames_times = set(frames_times)
+    frames = {}
+    try:
+        with av.open(container_file, 'r') as container:
+            stream = container.streams.video[0]
+            for frame in container.decode(stream):
+                if frame.pts is None:
+                    continue
+                frame_time = int(round(frame.pts * stream.time_base * 1000))
+                if frame_time in frames_times:
+                    _, png_data = cv2.imencode('.png', frame.to_ndarray(format='bgr24'))
+                    frames[frame_time] = io.BytesIO(png_data.tobytes())
+                    if len(frames) == len(frames_times):
+                        break
+
+    # Container can be unfinished if app was killed
+    except Exception as e:
+        logging.warning('Error reading slides container ' + container_file + '! ' + str(e))
+    return frames
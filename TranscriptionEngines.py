@@ -0,0 +1,291 @@
+"""
+ Copyright (C) 2022 Fern Lane, Webinar-hacker
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+import logging
+import os
+import threading
+from abc import ABC, abstractmethod
+
+ENGINE_WHISPER_TIMESTAMPED = 'whisper_timestamped'
+ENGINE_QUANTIZED = 'quantized'
+ENGINE_CTRANSLATE2 = 'ctranslate2'
+
+# Confidence of words without their own probability. Segment probability (exp(avg_logprob)) is on a different scale
+# than word confidence, so such words are not colored, but two-pass treats them as uncertain
+CONFIDENCE_UNKNOWN_PERCENTS = -1
+
+# Temperatures of whisper fallback (decoding is repeated with higher temperature if result looks broken)
+TEMPERATURE_FALLBACK = (0.0, 0.2, 0.4, 0.6, 0.8, 1.0)
+
+
+def get_whisper_preset(settings):
+    """
+    Finds current transcription preset
+    :param settings: settings dictionary
+    :return: dictionary with beam_size, best_of, temperature_fallback, vad and word_timestamps keys
+    """
+    preset_name = str(settings['whisper_preset'])
+    if preset_name not in settings['whisper_presets']:
+        raise ValueError('Unknown whisper preset ' + preset_name)
+    return settings['whisper_presets'][preset_name]
+
+
+def interpolate_segment_words(segments: list, time_offset: int):
+    """
+    Splits segments into words with interpolated end times (proportional to length of words)
+    :param segments: list of dictionaries with text, start, end keys
+    :param time_offset: time of the fragment from the start of recording in milliseconds
+    :return: list of (word, end time from the start of recording in milliseconds, CONFIDENCE_UNKNOWN_PERCENTS)
+    """
+    words = []
+    for segment in segments:
+        if segment is None or segment['text'] is None:
+            continue
+        segment_words = str(segment['text']).split()
+        if len(segment_words) == 0:
+            continue
+
+        segment_start = float(segment['start'])
+        segment_duration = float(segment['end']) - segment_start
+        characters_total = sum(len(segment_word) for segment_word in segment_words)
+        characters = 0
+        for segment_word in segment_words:
+            characters += len(segment_word)
+            words.append((segment_word,
+                          int(1000. * (segment_start + segment_duration * characters / characters_total)) + time_offset,
+                          CONFIDENCE_UNKNOWN_PERCENTS))
+    return words
+
+
+class TranscriptionEngine(ABC):
+    def __init__(self, settings, label_device_signal):
+        """
+        Base class for speech recognition backends
+        :param settings: settings dictionary
+        :param label_device_signal: emits device name
+        """
+        self.settings = settings
+        self.label_device_signal = label_device_signal
+        self.model = None
+        self.model_name = ''
+
+        # Serializes transcription of engines shared between threads
+        self.lock = threading.Lock()
+
+    @abstractmethod
+    def load(self, model_name: str):
+        """
+        Loads model (downloads it into working directory if needed)
+        :param model_name: tiny, base, small, medium, large
+        :return:
+        """
+
+    @abstractmethod
+    def transcribe(self, audio, time_offset: int):
+        """
+        Transcribes audio fragment using current preset
+        :param audio: 16kHz mono audio as numpy 1D array of float32
+        :param time_offset: time of the fragment from the start of recording in milliseconds
+        :return: list of (word, end time from the start of recording in milliseconds, confidence in percents)
+        """
+
+    def get_size_bytes(self):
+        """
+        Calculates size of model weights
+        :return: size in bytes or None if it is unknown
+        """
+        return None
+
+    def set_device(self, device: str):
+        """
+        Shows device name
+        :param device: cpu, cuda, etc.
+        :return:
+        """
+        logging.info('Device: ' + device)
+        self.label_device_signal.emit('Device: ' + device)
+
+
+class WhisperTimestampedEngine(TranscriptionEngine):
+    def __init__(self, settings, label_device_signal):
+        """
+        Float PyTorch whisper with whisper_timestamped word alignment
+        """
+        super().__init__(settings, label_device_signal)
+        self.whisper = None
+
+    def load(self, model_name: str):
+        import torch
+        import whisper_timestamped as whisper
+        self.whisper = whisper
+
+        # Select cpu or gpu
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.set_device(device)
+
+        # Load model
+        model_dir = os.getcwd()
+        logging.info('Loading model ' + model_name + ' into: ' + model_dir)
+        self.model = whisper.load_model(model_name, device=device, download_root=model_dir)
+        self.model_name = model_name
+
+    def get_size_bytes(self):
+        if self.model is None:
+            return None
+        import torch
+
+        # Quantized linear layers keep weights in packed params (tuple of tensors) instead of parameters
+        size_bytes = 0
+        for value in self.model.state_dict().values():
+            for tensor in value if isinstance(value, tuple) else (value,):
+                if isinstance(tensor, torch.Tensor):
+                    size_bytes += tensor.numel() * tensor.element_size()
+        return size_bytes
+
+    def transcribe(self, audio, time_offset: int):
+        # Decoding options
+        preset = get_whisper_preset(self.settings)
+        temperature = TEMPERATURE_FALLBACK if preset['temperature_fallback'] else 0.0
+        language = str(self.settings['whisper_model_language'])
+
+        # Transcribe audio without word alignment and interpolate words inside segments
+        if not preset['word_timestamps']:
+            transcription = self.model.transcribe(audio, language=language, temperature=temperature,
+                                                  beam_size=preset['beam_size'], best_of=preset['best_of'])
+            if transcription is None or transcription['segments'] is None:
+                return []
+            return interpolate_segment_words(transcription['segments'], time_offset)
+
+        # Transcribe audio
+        transcription = self.whisper.transcribe(self.model, audio, language=language, temperature=temperature,
+                                                beam_size=preset['beam_size'], best_of=preset['best_of'],
+                                                vad=preset['vad'])
+
+        # Parse result
+        words = []
+        if transcription is not None and transcription['segments'] is not None \
+                and len(transcription['segments']) > 0:
+            for segment in transcription['segments']:
+                if segment is not None and segment['words'] is not None and len(segment['words']) > 0:
+                    for segment_word in segment['words']:
+                        if segment_word is not None:
+                            if segment_word['text'] is not None and segment_word['end'] is not None \
+                                    and segment_word['confidence'] is not None:
+                                text_ = str(segment_word['text']).strip()
+                                if len(text_) > 0:
+                                    words.append((text_, int(1000. * float(segment_word['end'])) + time_offset,
+                                                  int(100. * float(segment_word['confidence']))))
+        return words
+
+
+class QuantizedWhisperEngine(WhisperTimestampedEngine):
+    def __init__(self, settings, label_device_signal):
+        """
+        Same as WhisperTimestampedEngine, but linear layers are dynamically quantized to int8 (CPU only)
+        """
+        super().__init__(settings, label_device_signal)
+
+    def load(self, model_name: str):
+        import torch
+        import whisper_timestamped as whisper
+        self.whisper = whisper
+        self.set_device('cpu (int8)')
+
+        # Load float model
+        model_dir = os.getcwd()
+        logging.info('Loading model ' + model_name + ' into: ' + model_dir)
+        model = whisper.load_model(model_name, device='cpu', download_root=model_dir)
+
+        # Whisper uses subclass of Linear (it only casts weights dtype), which quantize_dynamic doesn't know
+        for module in model.modules():
+            if isinstance(module, torch.nn.Linear):
+                module.__class__ = torch.nn.Linear
+
+        # Quantize weights of linear layers (activations are quantized on the fly)
+        logging.info('Quantizing model ' + model_name + '...')
+        self.model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model_name = model_name
+
+
+class CTranslate2Engine(TranscriptionEngine):
+    def __init__(self, settings, label_device_signal):
+        """
+        CTranslate2 whisper (faster_whisper package) with int8 / float16 weights
+        """
+        super().__init__(settings, label_device_signal)
+
+    def load(self, model_name: str):
+        import ctranslate2
+        from faster_whisper import WhisperModel
+
+        # Select cpu or gpu
+        device = 'cuda' if ctranslate2.get_cuda_device_count() > 0 else 'cpu'
+        self.set_device(device + ' (' + str(self.settings['ctranslate2_compute_type']) + ')')
+
+        # Load converted model
+        model_dir = os.getcwd()
+        logging.info('Loading model ' + model_name + ' into: ' + model_dir)
+        self.model = WhisperModel(model_name, device=device,
+                                  compute_type=str(self.settings['ctranslate2_compute_type']),
+                                  cpu_threads=int(self.settings['ctranslate2_cpu_threads']),
+                                  download_root=model_dir)
+        self.model_name = model_name
+
+    def transcribe(self, audio, time_offset: int):
+        # Decoding options
+        preset = get_whisper_preset(self.settings)
+        segments, _ = self.model.transcribe(audio, language=str(self.settings['whisper_model_language']),
+                                            beam_size=preset['beam_size'] or 1, best_of=preset['best_of'] or 1,
+                                            temperature=list(TEMPERATURE_FALLBACK)
+                                            if preset['temperature_fallback'] else 0.0,
+                                            vad_filter=preset['vad'], word_timestamps=preset['word_timestamps'])
+
+        # Segments are generated during iteration
+        segments = list(segments)
+
+        # Interpolate words inside segments
+        if not preset['word_timestamps']:
+            return interpolate_segment_words([{'text': segment.text,
+                                               'start': segment.start,
+                                               'end': segment.end} for segment in segments], time_offset)
+
+        # Parse result
+        words = []
+        for segment in segments:
+            if segment.words is not None:
+                for segment_word in segment.words:
+                    text_ = str(segment_word.word).strip()
+                    if len(text_) > 0:
+                        words.append((text_, int(1000. * float(segment_word.end)) + time_offset,
+                                      int(100. * float(segment_word.probability))))
+        return words
+
+
+def create_transcription_engine(settings, label_device_signal):
+    """
+    Creates engine selected by transcription_engine setting
+    :param settings: settings dictionary
+    :param label_device_signal: emits device name
+    :return: TranscriptionEngine (not loaded)
+    """
+    engine_name = str(settings['transcription_engine']).strip().lower()
+    if engine_name == ENGINE_QUANTIZED:
+        return QuantizedWhisperEngine(settings, label_device_signal)
+    elif engine_name == ENGINE_CTRANSLATE2:
+        return CTranslate2Engine(settings, label_device_signal)
+    elif engine_name != ENGINE_WHISPER_TIMESTAMPED:
+        logging.warning('Unknown transcription engine ' + engine_name + '! Using ' + ENGINE_WHISPER_TIMESTAMPED)
+    return WhisperTimestampedEngine(settings, label_device_signal)
@@ -0,0 +1,425 @@
+"""
+ Copyright (C) 2022 Fern Lane, Webinar-hacker
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import shutil
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from AudioHandler import PCM_MAX
+from CallbackSignal import CallbackSignal
+from LectureBuilder import LectureBuilder
+from lecturehacker import logging_setup
+
+# Layout of each job inside queue directory
+QUEUE_DIR_PENDING = 'pending'
+QUEUE_DIR_CLAIMED = 'claimed'
+QUEUE_DIR_RESULTS = 'results'
+QUEUE_DIR_AUDIO = 'audio'
+QUEUE_UNIT_EXTENSION = '.json'
+QUEUE_AUDIO_EXTENSION = '.pcm'
+
+
+def write_json_atomic(file: str, data):
+    """
+    Writes json through temp file, so other nodes never read half-written file
+    :param file: path to json file
+    :param data: data to write
+    :return:
+    """
+    with open(file + '.tmp', 'w', encoding='utf-8') as file_:
+        json.dump(data, file_, ensure_ascii=False)
+    os.replace(file + '.tmp', file)
+
+
+class TranscriptionCoordinator:
+    def __init__(self, settings, progress_bar_set_value_signal=None, progress_bar_set_maximum_signal=None):
+        """
+        Splits recording into work units inside shared queue directory, waits for workers and assembles lecture
+        :param settings: settings dictionary
+        :param progress_bar_set_value_signal: emits number of finished units
+        :param progress_bar_set_maximum_signal: emits number of units
+        """
+        self.settings = settings
+        self.progress_bar_set_value_signal = progress_bar_set_value_signal or CallbackSignal()
+        self.progress_bar_set_maximum_signal = progress_bar_set_maximum_signal or CallbackSignal()
+        self.queue_dir = str(settings['distributed_queue_directory'])
+
+    def create_units(self, lecture_builder: LectureBuilder, job_dir: str):
+        """
+        Writes one unit (fragment audio + description) per audio file of recording
+        :param lecture_builder: LectureBuilder with found files
+        :param job_dir: directory of the job inside queue directory
+        :return: list of unit ids in fragments order
+        """
+        for directory in (QUEUE_DIR_PENDING, QUEUE_DIR_CLAIMED, QUEUE_DIR_RESULTS, QUEUE_DIR_AUDIO):
+            os.makedirs(os.path.join(job_dir, directory), exist_ok=True)
+
+        unit_ids = []
+        for audio_file_n, audio_file_ in enumerate(lecture_builder.audio_files):
+            unit_id = '{:06d}'.format(audio_file_n)
+            try:
+                # Copy fragment as 16kHz PCM16, so workers don't need access to recording directory
+                audio = lecture_builder.load_fragment(audio_file_)
+                np.multiply(audio, PCM_MAX).astype(np.int16).tofile(os.path.join(job_dir, QUEUE_DIR_AUDIO, unit_id
+                                                                                 + QUEUE_AUDIO_EXTENSION))
+                write_json_atomic(os.path.join(job_dir, QUEUE_DIR_PENDING, unit_id + QUEUE_UNIT_EXTENSION),
+                                  {'unit': unit_id, 'time': audio_file_[0], 'samples': len(audio), 'attempts': 0})
+                unit_ids.append(unit_id)
+            except Exception as e:
+                logging.warning('Error creating unit for ' + str(audio_file_[1]) + '! ' + str(e))
+        return unit_ids
+
+    def requeue_expired(self, job_dir: str, leases: dict):
+        """
+        Returns units of dead workers (no heartbeat during lease time) into pending directory.
+        Clocks of workers may differ from this one, so only changes of modification time are compared,
+        and time since the last change is measured by local clock
+        :param job_dir: directory of the job inside queue directory
+        :param leases: unit file name -> (last seen modification time, local time when it was seen)
+        :return:
+        """
+        lease_seconds = float(self.settings['distributed_lease_seconds'])
+        claimed_dir = os.path.join(job_dir, QUEUE_DIR_CLAIMED)
+        claimed_files = os.listdir(claimed_dir)
+
+        # Forget finished or requeued units
+        for file_name in list(leases.keys()):
+            if file_name not in claimed_files:
+                del leases[file_name]
+
+        for file_name in claimed_files:
+            if not file_name.endswith(QUEUE_UNIT_EXTENSION):
+                continue
+            file = os.path.join(claimed_dir, file_name)
+            try:
+                modification_time = os.path.getmtime(file)
+
+                # New claim or heartbeat
+                if file_name not in leases or leases[file_name][0] != modification_time:
+                    leases[file_name] = (modification_time, time.monotonic())
+
+                elif time.monotonic() - leases[file_name][1] > lease_seconds:
+                    logging.warning('Lease of unit ' + file_name + ' expired. Returning it into queue')
+                    os.rename(file, os.path.join(job_dir, QUEUE_DIR_PENDING, file_name))
+                    del leases[file_name]
+            except OSError:
+                pass
+
+    def check_results(self, job_dir: str, finished_units: set):
+        """
+        Reads new results. Failed units are returned into queue until distributed_max_attempts is reached
+        :param job_dir: directory of the job inside queue directory
+        :param finished_units: file names of successful results, new ones are added into it
+        :return: False if some unit failed too many times
+        """
+        max_attempts = int(self.settings['distributed_max_attempts'])
+        results_dir = os.path.join(job_dir, QUEUE_DIR_RESULTS)
+        for file_name in os.listdir(results_dir):
+            if not file_name.endswith(QUEUE_UNIT_EXTENSION) or file_name in finished_units:
+                continue
+            file = os.path.join(results_dir, file_name)
+            with open(file, 'r', encoding='utf-8') as file_:
+                result = json.load(file_)
+            if 'error' not in result:
+                finished_units.add(file_name)
+                continue
+
+            unit = result['unit']
+            unit['attempts'] = int(unit.get('attempts', 0)) + 1
+            if unit['attempts'] >= max_attempts:
+                logging.error('Unit ' + file_name + ' failed ' + str(unit['attempts']) + ' times! Last error: '
+                              + str(result['error']))
+                return False
+            logging.warning('Unit ' + file_name + ' failed on worker ' + str(result['worker']) + ': '
+                            + str(result['error']) + '. Returning it into queue')
+            write_json_atomic(os.path.join(job_dir, QUEUE_DIR_PENDING, file_name), unit)
+            os.remove(file)
+        return True
+
+    def cancel(self, job_dir: str, processes: list):
+        """
+        Removes job from queue and stops local workers
+        :param job_dir: directory of the job inside queue directory
+        :param processes: local worker processes
+        :return:
+        """
+        shutil.rmtree(job_dir, ignore_errors=True)
+        for process in processes:
+            process.terminate()
+            process.join()
+
+    def build(self, lecture_directory: str, lecture_name: str, local_workers=0):
+        """
+        Builds lecture using workers
+        :param lecture_directory: example recordings/DD_MM_YYYY__HH_MM_SS
+        :param lecture_name: example DD_MM_YYYY__HH_MM_SS
+        :param local_workers: number of worker processes to start on this machine
+        :return: path to lecture file or None in case of error
+        """
+        lecture_builder = LectureBuilder(self.settings, CallbackSignal(), self.progress_bar_set_value_signal,
+                                         self.progress_bar_set_maximum_signal, CallbackSignal(), CallbackSignal(),
+                                         CallbackSignal())
+        lecture_builder.lecture_name = lecture_name
+        lecture_builder.find_files(lecture_directory)
+        if len(lecture_builder.audio_files) == 0:
+            logging.warning('No audio file!')
+            return None
+
+        job_dir = os.path.join(self.queue_dir, lecture_name + '_' + uuid.uuid4().hex[: 8])
+        unit_ids = self.create_units(lecture_builder, job_dir)
+        logging.info('Created ' + str(len(unit_ids)) + ' units in ' + job_dir)
+
+        # Workers on this machine
+        processes = []
+        for _ in range(local_workers):
+            process = multiprocessing.Process(target=run_worker, args=(self.settings, True))
+            process.start()
+            processes.append(process)
+
+        # Wait for results
+        self.progress_bar_set_maximum_signal.emit(len(unit_ids))
+        results_dir = os.path.join(job_dir, QUEUE_DIR_RESULTS)
+        finished = 0
+        finished_units = set()
+        leases = {}
+        while finished < len(unit_ids):
+            time.sleep(float(self.settings['distributed_poll_interval_seconds']))
+            self.requeue_expired(job_dir, leases)
+            if not self.check_results(job_dir, finished_units):
+                self.cancel(job_dir, processes)
+                return None
+
+            # Local workers exited while units of dead worker were returned into queue
+            if len(processes) > 0 and not any(process.is_alive() for process in processes) \
+                    and len(os.listdir(os.path.join(job_dir, QUEUE_DIR_PENDING))) > 0:
+                process = multiprocessing.Process(target=run_worker, args=(self.settings, True))
+                process.start()
+                processes.append(process)
+            if len(finished_units) != finished:
+                finished = len(finished_units)
+                logging.info('Finished units: ' + str(finished) + '/' + str(len(unit_ids)))
+                self.progress_bar_set_value_signal.emit(finished)
+
+        for process in processes:
+            process.join()
+
+        # Assemble results in fragments order
+        words = []
+        timestamps_end = []
+        confidences_percents = []
+        for unit_id in unit_ids:
+            with open(os.path.join(results_dir, unit_id + QUEUE_UNIT_EXTENSION), 'r', encoding='utf-8') as file:
+                for word, timestamp_end, confidence_percents in json.load(file)['words']:
+                    words.append(word)
+                    timestamps_end.append(timestamp_end)
+                    confidences_percents.append(confidence_percents)
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+        logging.info('Transcription result words: ' + str(len(words)))
+        if len(words) == 0:
+            logging.warning('No words to write!')
+            return None
+        lecture_builder.write_to_docx(words, timestamps_end, confidences_percents)
+        return os.path.join(self.settings['lectures_directory_name'], lecture_name + '.docx')
+
+
+class TranscriptionWorker:
+    def __init__(self, settings):
+        """
+        Claims units from shared queue directory, transcribes them and writes results back
+        :param settings: settings dictionary
+        """
+        self.settings = settings
+        self.queue_dir = str(settings['distributed_queue_directory'])
+        self.worker_id = platform.node() + '_' + str(os.getpid())
+        self.lecture_builder = LectureBuilder(settings, CallbackSignal(), CallbackSignal(), CallbackSignal(),
+                                              CallbackSignal(), CallbackSignal(), CallbackSignal())
+        self.heartbeat_file = None
+        self.heartbeat_lock = threading.Lock()
+        self.heartbeat_thread_running = False
+
+    def claim(self):
+        """
+        Claims first pending unit (rename is atomic, so only one worker gets it) and writes worker id into it
+        :return: (job directory, unit file name) or None if there are no pending units
+        """
+        if not os.path.exists(self.queue_dir):
+            return None
+        for job_name in sorted(os.listdir(self.queue_dir)):
+            pending_dir = os.path.join(self.queue_dir, job_name, QUEUE_DIR_PENDING)
+            if not os.path.isdir(pending_dir):
+                continue
+            for file_name in sorted(os.listdir(pending_dir)):
+                if not file_name.endswith(QUEUE_UNIT_EXTENSION):
+                    continue
+                job_dir = os.path.join(self.queue_dir, job_name)
+                claimed_file = os.path.join(job_dir, QUEUE_DIR_CLAIMED, file_name)
+                try:
+                    os.rename(os.path.join(pending_dir, file_name), claimed_file)
+                except OSError:
+                    continue
+
+                # Unit may be returned into queue and claimed by another worker while this one is still working on it
+                try:
+                    with open(claimed_file, 'r', encoding='utf-8') as file:
+                        unit = json.load(file)
+                    unit['owner'] = self.worker_id
+                    write_json_atomic(claimed_file, unit)
+                except Exception as e:
+                    logging.warning('Error claiming unit ' + file_name + '! ' + str(e))
+                    continue
+                return job_dir, file_name
+        return None
+
+    def release_claim(self, job_dir: str, file_name: str):
+        """
+        Moves claimed unit out of claimed directory if this worker still owns it
+        :param job_dir: directory of the job inside queue directory
+        :param file_name: unit file name
+        :return: path to moved unit file or None if unit was returned into queue or claimed by another worker
+        """
+        claimed_file = os.path.join(job_dir, QUEUE_DIR_CLAIMED, file_name)
+        released_file = os.path.join(job_dir, file_name + '.' + self.worker_id)
+
+        # Rename is atomic, so claim of another worker can't be removed between check and removal
+        try:
+            os.rename(claimed_file, released_file)
+        except OSError:
+            return None
+        try:
+            with open(released_file, 'r', encoding='utf-8') as file:
+                owner = json.load(file).get('owner')
+        except Exception as e:
+            logging.warning('Error reading unit ' + file_name + '! ' + str(e))
+            owner = None
+        if owner != self.worker_id:
+            os.rename(released_file, claimed_file)
+            return None
+        return released_file
+
+    def heartbeat_loop(self):
+        """
+        Renews lease of claimed unit by updating modification time of its file
+        :return:
+        """
+        while self.heartbeat_thread_running:
+            with self.heartbeat_lock:
+                if self.heartbeat_file is not None:
+                    try:
+                        os.utime(self.heartbeat_file)
+                    except OSError:
+                        pass
+            time.sleep(float(self.settings['distributed_heartbeat_seconds']))
+
+    def process(self, job_dir: str, file_name: str):
+        """
+        Transcribes claimed unit and writes result
+        :param job_dir: directory of the job inside queue directory
+        :param file_name: unit file name
+        :return:
+        """
+        claimed_file = os.path.join(job_dir, QUEUE_DIR_CLAIMED, file_name)
+        try:
+            with open(claimed_file, 'r', encoding='utf-8') as file:
+                unit = json.load(file)
+
+        # Unit was returned into queue
+        except Exception as e:
+            logging.warning('Error reading unit ' + file_name + '! ' + str(e))
+            return
+
+        with self.heartbeat_lock:
+            self.heartbeat_file = claimed_file
+        try:
+            logging.info('Worker ' + self.worker_id + ' transcribing unit ' + unit['unit'] + ' of ' + job_dir)
+
+            # Unit audio is stored as PCM16 container with single fragment
+            audio_file = os.path.join(job_dir, QUEUE_DIR_AUDIO, unit['unit'] + QUEUE_AUDIO_EXTENSION)
+            words = self.lecture_builder.transcribe([int(unit['time']), audio_file, int(unit['samples']) * 2,
+                                                    0, int(unit['samples'])])
+
+            result = {'worker': self.worker_id, 'words': words}
+
+        # Coordinator decides whether to retry unit
+        except Exception as e:
+            logging.error('Error processing unit ' + file_name + '! ' + str(e))
+            result = {'worker': self.worker_id, 'error': str(e), 'unit': unit}
+        with self.heartbeat_lock:
+            self.heartbeat_file = None
+
+        # Lease expired and unit was returned into queue
+        released_file = self.release_claim(job_dir, file_name)
+        if released_file is None:
+            logging.warning('Lease of unit ' + file_name + ' was lost. Dropping result of worker ' + self.worker_id)
+            return
+        try:
+            write_json_atomic(os.path.join(job_dir, QUEUE_DIR_RESULTS, file_name), result)
+            os.remove(released_file)
+
+        # Return claim, so unit is requeued when its lease expires
+        except Exception as e:
+            logging.error('Error writing result of unit ' + file_name + '! ' + str(e))
+            try:
+                os.rename(released_file, claimed_file)
+            except OSError:
+                pass
+
+    def run(self, exit_when_idle=False):
+        """
+        Processes units until interrupted
+        :param exit_when_idle: True to exit when queue is empty
+        :return:
+        """
+        if self.settings['two_pass_enabled']:
+            self.lecture_builder.load_draft_model()
+        else:
+            self.lecture_builder.load_model()
+
+        self.heartbeat_thread_running = True
+        heartbeat_thread = threading.Thread(target=self.heartbeat_loop, daemon=True)
+        heartbeat_thread.start()
+        logging.info('Worker ' + self.worker_id + ' started on ' + self.queue_dir)
+        try:
+            while True:
+                claimed = self.claim()
+                if claimed is not None:
+                    self.process(claimed[0], claimed[1])
+                elif exit_when_idle:
+                    break
+                else:
+                    time.sleep(float(self.settings['distributed_poll_interval_seconds']))
+        except KeyboardInterrupt:
+            logging.warning('Stopping worker...')
+        self.heartbeat_thread_running = False
+
+
+def run_worker(settings, exit_when_idle=False):
+    """
+    Worker process entry point
+    :param settings: settings dictionary
+    :param exit_when_idle: True to exit when queue is empty
+    :return:
+    """
+    logging_setup()
+    TranscriptionWorker(settings).run(exit_when_idle)
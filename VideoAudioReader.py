@@ -22,11 +22,9 @@ import threading
 import av
 import cv2
 import numpy as np
-from PyQt5.QtGui import QPixmap, QImage
-from qt_thread_updater import get_updater
 
 from AudioHandler import WAVE_FILE_EXTENSION
-from BrowserHandler import SAVING_TEXT_COLOR, resize_keep_ratio, SCREENSHOT_EXTENSION
+from ScreenshotProcessor import ScreenshotProcessor, show_preview
 
 
 class VideoAudioReader:
@@ -46,7 +44,7 @@ class VideoAudioReader:
         self.thread_running = False
         self.thread = None
         self.video_audio_file = ''
-        self.opencv_image_prev = None
+        self.screenshot_processor = ScreenshotProcessor(settings)
 
     def start_processing_file(self, file: str):
         """
@@ -76,6 +74,15 @@ class VideoAudioReader:
             except Exception as e:
                 logging.warning('Error joining processing thread ' + str(e))
 
+    def show_preview(self, opencv_image, saving=False):
+        """
+        Shows image in preview label (does nothing without GUI)
+        :param opencv_image: BGR image or None to clear preview
+        :param saving: True to put Saving... text on top of the image
+        :return:
+        """
+        show_preview(self.preview_label, opencv_image, saving)
+
     def processing_thread(self):
         """
         Decodes video/audio file into wav files and screenshots
@@ -107,6 +114,9 @@ class VideoAudioReader:
             # Resampler
             resampler = None
 
+            # Clear previous image
+            self.screenshot_processor.reset()
+
             frame_millis_last = 0
             for packet in container.demux():
                 for frame in packet.decode():
@@ -161,60 +171,20 @@ class VideoAudioReader:
 
                     # Video frame
                     elif type(frame) == av.video.frame.VideoFrame:
+                        # Adaptive sampling interval (in file time)
                         if frame_millis - frame_millis_last \
-                                >= int(float(self.settings['loop_interval_seconds']) * 1000.):
+                                >= int(self.screenshot_processor.sampler.get_interval() * 1000.):
                             frame_millis_last = frame_millis
                             # Convert to opencv image
                             opencv_image = cv2.cvtColor(frame.to_rgb().to_ndarray(), cv2.COLOR_RGB2BGR)
 
-                            # First start -> initialize self.opencv_image_prev
-                            if self.opencv_image_prev is None:
-                                self.opencv_image_prev = np.zeros(opencv_image.shape, dtype=opencv_image.dtype)
-
-                            # Resize prev image
-                            self.opencv_image_prev = cv2.resize(self.opencv_image_prev,
-                                                                (opencv_image.shape[1], opencv_image.shape[0]))
-
-                            # Find difference
-                            diff = cv2.absdiff(opencv_image, self.opencv_image_prev).astype('uint8')
-
-                            # Convert to grayscale
-                            diff = cv2.cvtColor(diff, cv2.COLOR_BGR2GRAY)
-
-                            # Store current image for next cycle
-                            self.opencv_image_prev = opencv_image
-
-                            # Apply threshold
-                            _, thresh = cv2.threshold(diff, int(self.settings['opencv_threshold']),
-                                                      255, cv2.THRESH_BINARY)
-
-                            # Calculate difference in percents
-                            diff_percents = (cv2.countNonZero(thresh) /
-                                             (opencv_image.shape[1] * opencv_image.shape[0])) * 100
-                            logging.info('Difference: ' + str(int(diff_percents)) + '%')
-
-                            # Save screenshot
-                            if diff_percents >= int(self.settings['screenshot_diff_threshold_percents']):
-                                screenshot_name = str(frame_millis) + SCREENSHOT_EXTENSION
-                                logging.info('Saving current screenshot as ' + screenshot_name + '...')
-                                cv2.imwrite(self.audio_handler.screenshots_dir + screenshot_name, opencv_image)
-
-                            # Resize preview
-                            preview_resized = resize_keep_ratio(opencv_image, self.preview_label.size().width(),
-                                                                self.preview_label.size().height())
-
-                            # Put Saving... text on top of the image
-                            if diff_percents >= int(self.settings['screenshot_diff_threshold_percents']):
-                                cv2.putText(preview_resized, 'Saving...', (10, preview_resized.shape[0] // 2),
-                                            cv2.FONT_HERSHEY_SIMPLEX, 2, SAVING_TEXT_COLOR, 2, cv2.LINE_AA)
-
-                            # Convert to pixmap
-                            pixmap = QPixmap.fromImage(
-                                QImage(preview_resized.data, preview_resized.shape[1], preview_resized.shape[0],
-                                       3 * preview_resized.shape[1], QImage.Format_BGR888))
+                            # Compare with previous frame and save screenshot
+                            saving = self.screenshot_processor.process(opencv_image, frame_millis / 1000.)
+                            if saving:
+                                self.audio_handler.save_screenshot(opencv_image, frame_millis)
 
                             # Push to preview
-                            get_updater().call_latest(self.preview_label.setPixmap, pixmap)
+                            self.show_preview(opencv_image, saving)
                             video_frames_processed += 1
 
                 # Abort
@@ -231,8 +201,7 @@ class VideoAudioReader:
         self.progress_bar_video_audio_signal.emit(0)
 
         # Clear preview image
-        get_updater().call_latest(self.preview_label.clear)
-        get_updater().call_latest(self.preview_label.setText, 'No image')
+        self.show_preview(None)
 
         # Stop recording
         self.audio_handler.recording_stop()
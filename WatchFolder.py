@@ -0,0 +1,254 @@
+"""
+ Copyright (C) 2022 Fern Lane, Webinar-hacker
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from lecturehacker import decode_file, build_recording, logging_setup
+
+# Optional. Without it directory is polled
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+JOB_STAGE_DECODING = 'decoding'
+JOB_STAGE_DECODED = 'decoded'
+JOB_STAGE_BUILDING = 'building'
+JOB_STAGE_BUILT = 'built'
+JOB_STAGE_FAILED = 'failed'
+
+
+def watch_job(settings, stage: str, file_or_recording: str, json_output: bool):
+    """
+    Runs one stage of the job in worker process
+    :param settings: settings dictionary
+    :param stage: JOB_STAGE_DECODING or JOB_STAGE_BUILDING
+    :param file_or_recording: media file to decode or recording name to build
+    :param json_output: print progress as json lines
+    :return: recording name / lecture file or None in case of error
+    """
+    logging_setup()
+    try:
+        if stage == JOB_STAGE_DECODING:
+            return decode_file(settings, file_or_recording, json_output)
+        return build_recording(settings, file_or_recording, json_output)
+    except Exception as e:
+        logging.error(e, exc_info=True)
+        return None
+
+
+class WatchFolder:
+    def __init__(self, settings, watch_dir: str, jobs: int, build=True, json_output=False):
+        """
+        Decodes new media files from directory and builds lectures from them
+        :param settings: settings dictionary
+        :param watch_dir: directory to watch
+        :param jobs: maximum number of stages running at once
+        :param build: True to build lecture after decoding
+        :param json_output: print progress as json lines
+        """
+        self.settings = settings
+        self.watch_dir = watch_dir
+        self.jobs = max(jobs, 1)
+        self.build = build
+        self.json_output = json_output
+
+        self.state_file = os.path.join(watch_dir, str(settings['watch_state_file_name']))
+        self.state = {}
+        self.candidates = {}
+        self.running = {}
+        self.inotify = None
+
+    def load_state(self):
+        """
+        Loads job state file. Stages interrupted by restart are started again
+        :return:
+        """
+        self.state = {}
+        if os.path.exists(self.state_file):
+            try:
+                with open(self.state_file, 'r', encoding='utf-8') as file:
+                    self.state = json.load(file)
+            except Exception as e:
+                logging.error('Error loading job state ' + self.state_file + '! ' + str(e))
+        logging.info('Loaded ' + str(len(self.state)) + ' jobs')
+
+    def save_state(self):
+        """
+        Writes job state file (through temp file, so it is never half-written)
+        :return:
+        """
+        try:
+            with open(self.state_file + '.tmp', 'w', encoding='utf-8') as file:
+                json.dump(self.state, file, ensure_ascii=False, indent=4)
+            os.replace(self.state_file + '.tmp', self.state_file)
+        except Exception as e:
+            logging.error('Error saving job state ' + self.state_file + '! ' + str(e))
+
+    def scan(self):
+        """
+        Finds new or changed media files and tracks them until they stop growing
+        :return: list of file names which are stable and not processed yet
+        """
+        extensions = [str(extension).lower() for extension in self.settings['watch_file_extensions']]
+        stable_seconds = float(self.settings['watch_stable_seconds'])
+        time_now = time.time()
+        stable_files = []
+        try:
+            file_names = os.listdir(self.watch_dir)
+        except Exception as e:
+            logging.error('Error listing ' + self.watch_dir + '! ' + str(e))
+            return stable_files
+
+        for file_name in file_names:
+            file = os.path.join(self.watch_dir, file_name)
+            if os.path.splitext(file_name)[1].lower() not in extensions or not os.path.isfile(file):
+                continue
+            try:
+                file_stat = os.stat(file)
+            except OSError:
+                continue
+            signature = [file_stat.st_size, int(file_stat.st_mtime)]
+
+            # Already processed (file was not replaced)
+            job = self.state.get(file_name)
+            if job is not None and job['signature'] == signature:
+                continue
+
+            # Wait until size and modification time stop changing
+            candidate = self.candidates.get(file_name)
+            if candidate is None or candidate[0] != signature:
+                self.candidates[file_name] = [signature, time_now]
+            elif time_now - candidate[1] >= stable_seconds:
+                del self.candidates[file_name]
+                self.state[file_name] = {'signature': signature, 'stage': JOB_STAGE_DECODING, 'recording': None,
+                                         'lecture': None, 'updated': int(time_now)}
+                stable_files.append(file_name)
+        return stable_files
+
+    def submit(self, executor, file_name: str):
+        """
+        Submits next stage of the job if there is free worker
+        :param executor: ProcessPoolExecutor
+        :param file_name: name of media file inside watch directory
+        :return: True if submitted
+        """
+        if len(self.running) >= self.jobs or file_name in self.running.values():
+            return False
+        job = self.state[file_name]
+        if job['stage'] == JOB_STAGE_DECODING:
+            argument = os.path.join(self.watch_dir, file_name)
+        elif job['stage'] == JOB_STAGE_BUILDING:
+            argument = job['recording']
+        else:
+            return False
+        logging.info('Starting ' + job['stage'] + ' of ' + file_name)
+        future = executor.submit(watch_job, self.settings, job['stage'], argument, self.json_output)
+        self.running[future] = file_name
+        return True
+
+    def collect(self):
+        """
+        Updates job state with finished stages
+        :return:
+        """
+        for future in [future for future in self.running if future.done()]:
+            file_name = self.running.pop(future)
+            job = self.state[file_name]
+            try:
+                result = future.result()
+            except Exception as e:
+                logging.error(e)
+                result = None
+
+            if result is None:
+                logging.error('Error ' + job['stage'] + ' ' + file_name)
+                job['stage'] = JOB_STAGE_FAILED
+            elif job['stage'] == JOB_STAGE_DECODING:
+                job['recording'] = result
+                job['stage'] = JOB_STAGE_BUILDING if self.build else JOB_STAGE_DECODED
+            else:
+                job['lecture'] = result
+                job['stage'] = JOB_STAGE_BUILT
+            job['updated'] = int(time.time())
+            logging.info('Job ' + file_name + ': ' + job['stage'])
+            self.save_state()
+
+    def wait(self, timeout_seconds: float):
+        """
+        Waits for directory changes (inotify) or timeout
+        :param timeout_seconds: maximum time to wait
+        :return:
+        """
+        if self.inotify is not None:
+            try:
+                self.inotify.read(timeout=int(timeout_seconds * 1000))
+                return
+            except Exception as e:
+                logging.warning('Error reading inotify events! ' + str(e))
+                self.inotify = None
+        time.sleep(timeout_seconds)
+
+    def run(self):
+        """
+        Watches directory until interrupted
+        :return:
+        """
+        self.load_state()
+
+        # Finished decoding but not building
+        for job in self.state.values():
+            if self.build and job['stage'] == JOB_STAGE_DECODED:
+                job['stage'] = JOB_STAGE_BUILDING
+
+        # Wake up on new files if inotify is available
+        if inotify_simple is not None:
+            try:
+                self.inotify = inotify_simple.INotify()
+                self.inotify.add_watch(self.watch_dir, inotify_simple.flags.CLOSE_WRITE
+                                       | inotify_simple.flags.MOVED_TO | inotify_simple.flags.CREATE)
+                logging.info('Watching ' + self.watch_dir + ' using inotify')
+            except Exception as e:
+                logging.warning('Error initializing inotify! ' + str(e))
+                self.inotify = None
+        if self.inotify is None:
+            logging.info('Watching ' + self.watch_dir + ' by polling')
+
+        with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            try:
+                while True:
+                    self.collect()
+                    if len(self.scan()) > 0:
+                        self.save_state()
+
+                    # Start pending stages
+                    for file_name, job in self.state.items():
+                        if job['stage'] in (JOB_STAGE_DECODING, JOB_STAGE_BUILDING):
+                            self.submit(executor, file_name)
+
+                    # Check stable files and running jobs more often
+                    timeout_seconds = float(self.settings['watch_poll_interval_seconds'])
+                    if len(self.candidates) > 0 or len(self.running) > 0:
+                        timeout_seconds = min(timeout_seconds, 1.)
+                    self.wait(timeout_seconds)
+
+            except KeyboardInterrupt:
+                logging.warning('Stopping... Running stages will be restarted next time')
+                executor.shutdown(wait=False, cancel_futures=True)
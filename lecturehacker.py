@@ -0,0 +1,430 @@
+"""
+ Copyright (C) 2022 Fern Lane, Webinar-hacker
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from AudioHandler import AudioHandler, RECORD_FROM_FRAMES
+from CallbackSignal import CallbackSignal
+from LectureBuilder import LectureBuilder, WHISPER_SAMPLING_RATE, WHISPER_WINDOW_SAMPLES
+from TranscriptionEngines import ENGINE_WHISPER_TIMESTAMPED, ENGINE_QUANTIZED, ENGINE_CTRANSLATE2
+from VideoAudioReader import VideoAudioReader
+
+SETTINGS_FILE = 'settings.json'
+
+LOGGING_LEVEL = logging.INFO
+
+
+def logging_setup(level=LOGGING_LEVEL):
+    """
+    Sets up logging format and level (to stderr, so stdout contains only progress)
+    :param level: logging level
+    :return:
+    """
+    logging.basicConfig(encoding='utf-8', format='%(asctime)s %(levelname)-8s %(message)s',
+                        level=level,
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
+
+def load_settings(settings_file: str):
+    """
+    Loads settings without GUI
+    :param settings_file: path to settings.json
+    :return: settings dictionary
+    """
+    logging.info('Loading ' + settings_file + '...')
+    with open(settings_file, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+class ConsoleProgress:
+    def __init__(self, task: str, json_output=False):
+        """
+        Plain progress and telemetry output instead of GUI widgets
+        :param task: name of the task (file or recording)
+        :param json_output: True to print one json object per line instead of text
+        """
+        self.task = task
+        self.json_output = json_output
+        self.maximum = 100
+        self.value = -1
+        self.time_started = time.time()
+
+        # Signals expected by AudioHandler, VideoAudioReader and LectureBuilder
+        self.ignore_signal = CallbackSignal()
+        self.progress_signal = CallbackSignal(self.set_value)
+        self.maximum_signal = CallbackSignal(self.set_maximum)
+        self.status_signal = CallbackSignal(self.status)
+
+    def print(self, event: dict):
+        """
+        Prints event
+        :param event: dictionary with event data
+        :return:
+        """
+        event['task'] = self.task
+        event['elapsed'] = round(time.time() - self.time_started, 1)
+        if self.json_output:
+            print(json.dumps(event, ensure_ascii=False), flush=True)
+        else:
+            print(' '.join(str(key) + '=' + str(value) for key, value in event.items()), flush=True)
+
+    def set_maximum(self, maximum: int):
+        """
+        Sets maximum progress value
+        :param maximum: maximum value
+        :return:
+        """
+        self.maximum = max(int(maximum), 1)
+
+    def set_value(self, value: int):
+        """
+        Prints progress in percents (only if it changed)
+        :param value: progress value (0 - maximum)
+        :return:
+        """
+        percents = int(min(max(int(value), 0) * 100 / self.maximum, 100))
+        if percents != self.value:
+            self.value = percents
+            self.print({'event': 'progress', 'percents': percents})
+
+    def status(self, text: str):
+        """
+        Prints status text (time left, device, etc.)
+        :param text: status text
+        :return:
+        """
+        self.print({'event': 'status', 'text': str(text)})
+
+
+def get_recording_dir(settings, recording: str):
+    """
+    Finds recording directory
+    :param settings: settings dictionary
+    :param recording: recording name (inside recordings directory) or path to recording directory
+    :return: path to recording directory or None if not exists
+    """
+    if os.path.isdir(recording):
+        return recording
+    recording_dir = os.path.join(str(settings['recordings_directory_name']), recording)
+    if os.path.isdir(recording_dir):
+        return recording_dir
+    logging.error('Recording ' + recording + ' not exists!')
+    return None
+
+
+def decode_file(settings, file: str, json_output=False, progress=None):
+    """
+    Decodes video / audio file into recording directory
+    :param settings: settings dictionary
+    :param file: media file
+    :param json_output: print progress as json lines
+    :param progress: ConsoleProgress or None to print progress
+    :return: recording name or None if no frames were processed
+    """
+    if not os.path.exists(file):
+        logging.error('File ' + file + ' not exists!')
+        return None
+
+    if progress is None:
+        progress = ConsoleProgress(file, json_output)
+    results = []
+    audio_handler = AudioHandler(settings, progress.ignore_signal, progress.ignore_signal)
+    video_audio_reader = VideoAudioReader(settings, audio_handler, None, progress.ignore_signal,
+                                          progress.progress_signal, CallbackSignal(results.append))
+
+    # Decode in reader thread and wait for it
+    recording_name = os.path.splitext(os.path.basename(file))[0]
+    audio_handler.recording_start(RECORD_FROM_FRAMES, recording_name)
+    video_audio_reader.start_processing_file(file)
+    thread = video_audio_reader.thread
+    if thread is not None:
+        thread.join()
+
+    if len(results) == 0 or results[0] is None:
+        progress.print({'event': 'failed'})
+        return None
+    progress.print({'event': 'decoded', 'recording': recording_name})
+    return recording_name
+
+
+def build_recording(settings, recording: str, json_output=False):
+    """
+    Builds docx lecture from recording
+    :param settings: settings dictionary
+    :param recording: recording name (inside recordings directory) or path to recording directory
+    :param json_output: print progress as json lines
+    :return: path to lecture file or None in case of error
+    """
+    recording_dir = get_recording_dir(settings, recording)
+    if recording_dir is None:
+        return None
+    recording_name = os.path.basename(os.path.normpath(recording_dir))
+
+    progress = ConsoleProgress(recording_name, json_output)
+    results = []
+    lecture_builder = LectureBuilder(settings, progress.ignore_signal, progress.progress_signal,
+                                     progress.maximum_signal, CallbackSignal(results.append), progress.status_signal,
+                                     progress.status_signal)
+
+    # Build in builder thread and wait for it
+    lecture_builder.start_building_lecture(recording_dir, recording_name)
+    if lecture_builder.thread is not None:
+        lecture_builder.thread.join()
+
+    if len(results) == 0:
+        progress.print({'event': 'failed'})
+        return None
+    progress.print({'event': 'built', 'lecture': results[0]})
+    return results[0]
+
+
+def batch_job(settings, file_or_recording: str, build: bool, json_output: bool):
+    """
+    Processes one batch item in worker process
+    :param settings: settings dictionary
+    :param file_or_recording: media file to decode or recording directory to build
+    :param build: True to build lecture after decoding
+    :param json_output: print progress as json lines
+    :return: path to lecture file, recording name or None in case of error
+    """
+    logging_setup()
+    try:
+        # Recording directory
+        if os.path.isdir(file_or_recording):
+            return build_recording(settings, file_or_recording, json_output)
+
+        # Media file
+        recording_name = decode_file(settings, file_or_recording, json_output)
+        if recording_name is not None and build:
+            return build_recording(settings, recording_name, json_output)
+        return recording_name
+    except Exception as e:
+        logging.error(e, exc_info=True)
+        return None
+
+
+def batch(settings, files: list, build: bool, jobs: int, json_output=False):
+    """
+    Processes many files / recordings with process pool
+    :param settings: settings dictionary
+    :param files: media files or recording directories
+    :param build: True to build lectures after decoding
+    :param jobs: number of worker processes
+    :param json_output: print progress as json lines
+    :return: number of failed items
+    """
+    failed = 0
+    with ProcessPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = {executor.submit(batch_job, settings, file, build, json_output): file for file in files}
+        for future in as_completed(futures):
+            if future.result() is None:
+                logging.error('Error processing ' + futures[future])
+                failed += 1
+    logging.info('Batch finished. Processed: ' + str(len(files) - failed) + ', failed: ' + str(failed))
+    return failed
+
+
+def benchmark_engine(settings, recording_dir: str, engine_name: str, fragments: int):
+    """
+    Transcribes first fragments of recording using one engine (in separate process, so RSS of engines is not mixed)
+    :param settings: settings dictionary
+    :param recording_dir: path to recording directory
+    :param engine_name: transcription engine
+    :param fragments: number of fragments to transcribe
+    :return: dictionary with results or None in case of error
+    """
+    logging_setup()
+    import psutil
+
+    settings = dict(settings)
+    settings['transcription_engine'] = engine_name
+    lecture_builder = LectureBuilder(settings, CallbackSignal(), CallbackSignal(), CallbackSignal(), CallbackSignal(),
+                                     CallbackSignal(), CallbackSignal())
+    lecture_builder.find_files(recording_dir)
+    process = psutil.Process(os.getpid())
+    try:
+        # Load model
+        time_started = time.time()
+        lecture_builder.load_model()
+        load_seconds = time.time() - time_started
+        rss = process.memory_info().rss
+
+        audio_seconds = 0.
+        transcription_seconds = 0.
+        words = 0
+        for audio_file_ in lecture_builder.audio_files[: fragments]:
+            # Fragments are trimmed to whisper window before transcription
+            audio_samples = len(lecture_builder.load_fragment(audio_file_))
+            audio_seconds += min(audio_samples, WHISPER_WINDOW_SAMPLES) / WHISPER_SAMPLING_RATE
+
+            time_started = time.time()
+            words += len(lecture_builder.transcribe_fragment(audio_file_))
+            transcription_seconds += time.time() - time_started
+            rss = max(rss, process.memory_info().rss)
+    except Exception as e:
+        logging.error('Error benchmarking engine ' + engine_name + '! ' + str(e))
+        return None
+
+    return {'engine': engine_name,
+            'load_seconds': round(load_seconds, 1),
+            'audio_seconds': round(audio_seconds, 1),
+            'transcription_seconds': round(transcription_seconds, 1),
+            'rtf': round(transcription_seconds / audio_seconds, 3) if audio_seconds > 0 else 0,
+            'rss_mb': int(rss / 1024 / 1024),
+            'words': words}
+
+
+def benchmark(settings, recording: str, engines: list, fragments: int, json_output=False):
+    """
+    Compares real-time factor and memory usage of transcription engines on the same fragments
+    :param settings: settings dictionary
+    :param recording: recording name (inside recordings directory) or path to recording directory
+    :param engines: list of engine names
+    :param fragments: number of fragments to transcribe
+    :param json_output: print results as json lines
+    :return: number of failed engines
+    """
+    recording_dir = get_recording_dir(settings, recording)
+    if recording_dir is None:
+        return len(engines)
+    progress = ConsoleProgress(os.path.basename(os.path.normpath(recording_dir)), json_output)
+    failed = 0
+    for engine_name in engines:
+        # New process for each engine
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            result = executor.submit(benchmark_engine, settings, recording_dir, engine_name, fragments).result()
+        if result is None:
+            progress.print({'event': 'failed', 'engine': engine_name})
+            failed += 1
+        else:
+            progress.print(dict({'event': 'benchmark'}, **result))
+    return failed
+
+
+def main():
+    """
+    Command line entry point
+    :return: exit code
+    """
+    parser = argparse.ArgumentParser(prog='lecturehacker',
+                                     description='Decodes media files and builds lectures without GUI')
+    parser.add_argument('--settings', default=SETTINGS_FILE, help='path to settings.json')
+    parser.add_argument('--json', action='store_true', help='print progress as json lines')
+    parser.add_argument('--preset', default=None, help='transcription preset (draft, balanced, best)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_decode = subparsers.add_parser('decode', help='decode video / audio file into recording')
+    parser_decode.add_argument('file')
+    parser_decode.add_argument('--build', action='store_true', help='build lecture after decoding')
+
+    parser_build = subparsers.add_parser('build', help='build lecture from recording')
+    parser_build.add_argument('recording', help='recording name or path to recording directory')
+
+    parser_batch = subparsers.add_parser('batch', help='decode / build many files with process pool')
+    parser_batch.add_argument('files', nargs='+', help='media files or recording directories')
+    parser_batch.add_argument('--build', action='store_true', help='build lectures after decoding')
+    parser_batch.add_argument('--jobs', type=int, default=None, help='number of worker processes')
+
+    parser_watch = subparsers.add_parser('watch', help='decode and build new files from directory')
+    parser_watch.add_argument('directory')
+    parser_watch.add_argument('--no-build', action='store_true', help='only decode files')
+    parser_watch.add_argument('--jobs', type=int, default=None, help='number of worker processes')
+
+    parser_distribute = subparsers.add_parser('distribute', help='build lecture using workers on shared queue')
+    parser_distribute.add_argument('recording', help='recording name or path to recording directory')
+    parser_distribute.add_argument('--local-workers', type=int, default=0, help='worker processes on this machine')
+
+    parser_worker = subparsers.add_parser('worker', help='transcribe units from shared queue')
+    parser_worker.add_argument('--exit-when-idle', action='store_true', help='exit when queue is empty')
+
+    parser_benchmark = subparsers.add_parser('benchmark', help='compare speed and memory of transcription engines')
+    parser_benchmark.add_argument('recording', help='recording name or path to recording directory')
+    parser_benchmark.add_argument('--engines', nargs='+', default=[ENGINE_WHISPER_TIMESTAMPED, ENGINE_QUANTIZED,
+                                                                   ENGINE_CTRANSLATE2])
+    parser_benchmark.add_argument('--fragments', type=int, default=None, help='number of fragments to transcribe')
+
+    parser_serve = subparsers.add_parser('serve', help='run local HTTP API for decode / build jobs')
+    parser_serve.add_argument('--host', default=None)
+    parser_serve.add_argument('--port', type=int, default=None)
+
+    args = parser.parse_args()
+    logging_setup()
+    settings = load_settings(args.settings)
+    if args.preset is not None:
+        settings['whisper_preset'] = args.preset
+
+    if args.command == 'decode':
+        recording_name = decode_file(settings, args.file, args.json)
+        if recording_name is not None and args.build:
+            return 0 if build_recording(settings, recording_name, args.json) is not None else 1
+        return 0 if recording_name is not None else 1
+
+    elif args.command == 'build':
+        return 0 if build_recording(settings, args.recording, args.json) is not None else 1
+
+    elif args.command == 'batch':
+        jobs = args.jobs if args.jobs is not None else int(settings['cli_batch_jobs'])
+        return 0 if batch(settings, args.files, args.build, jobs, args.json) == 0 else 1
+
+    elif args.command == 'watch':
+        # Imported here because WatchFolder uses functions of this module
+        from WatchFolder import WatchFolder
+        jobs = args.jobs if args.jobs is not None else int(settings['cli_batch_jobs'])
+        WatchFolder(settings, args.directory, jobs, not args.no_build, args.json).run()
+        return 0
+
+    elif args.command == 'distribute':
+        # Imported here because TranscriptionQueue uses functions of this module
+        from TranscriptionQueue import TranscriptionCoordinator
+        recording_dir = get_recording_dir(settings, args.recording)
+        if recording_dir is None:
+            return 1
+        recording_name = os.path.basename(os.path.normpath(recording_dir))
+        progress = ConsoleProgress(recording_name, args.json)
+        lecture_file = TranscriptionCoordinator(settings, progress.progress_signal, progress.maximum_signal) \
+            .build(recording_dir, recording_name, args.local_workers)
+        if lecture_file is None:
+            progress.print({'event': 'failed'})
+            return 1
+        progress.print({'event': 'built', 'lecture': lecture_file})
+        return 0
+
+    elif args.command == 'benchmark':
+        fragments = args.fragments if args.fragments is not None else int(settings['benchmark_fragments'])
+        return 0 if benchmark(settings, args.recording, args.engines, fragments, args.json) == 0 else 1
+
+    elif args.command == 'worker':
+        from TranscriptionQueue import run_worker
+        run_worker(settings, args.exit_when_idle)
+        return 0
+
+    else:
+        # Imported here because JobServer uses functions of this module
+        from JobServer import JobServer
+        JobServer(settings,
+                  args.host if args.host is not None else str(settings['server_host']),
+                  args.port if args.port is not None else int(settings['server_port'])).serve()
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
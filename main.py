@@ -22,6 +22,7 @@ import os
 import shutil
 import signal
 import sys
+import time
 import webbrowser
 
 import psutil
@@ -31,8 +32,12 @@ from PyQt5.QtWidgets import QApplication, QMainWindow, QMessageBox, QLineEdit, Q
     QHBoxLayout, QFileDialog
 
 import AudioHandler
+import BackgroundTranscriber
 import BrowserHandler
 import LectureBuilder
+import LinkScheduler
+import ModelManager
+import SessionManager
 import VideoAudioReader
 
 WEBINAR_HACKER_VERSION = 'beta_4.0.4'
@@ -123,6 +128,8 @@ class Window(QMainWindow):
     label_current_video_audio_time_signal = QtCore.pyqtSignal(str)  # QtCore.Signal(str)
     progress_bar_video_audio_signal = QtCore.pyqtSignal(int)  # QtCore.Signal(int)
     video_audio_decoding_ended_signal = QtCore.pyqtSignal(str)  # QtCore.Signal(str)
+    sessions_finished_signal = QtCore.pyqtSignal()  # QtCore.Signal()
+    start_link_signal = QtCore.pyqtSignal(str, str)  # QtCore.Signal(str, str)
 
     def __init__(self, settings_):
         super(Window, self).__init__()
@@ -149,6 +156,8 @@ class Window(QMainWindow):
         self.label_current_video_audio_time_signal.connect(self.label_current_video_time.setText)
         self.progress_bar_video_audio_signal.connect(self.progressBar_videoaudio.setValue)
         self.video_audio_decoding_ended_signal.connect(self.video_audio_decoding_ended)
+        self.sessions_finished_signal.connect(self.sessions_finished)
+        self.start_link_signal.connect(self.start_link)
 
         # Initialize classes
         self.audio_handler = AudioHandler.AudioHandler(self.settings, self.progress_bar_audio_signal,
@@ -167,6 +176,27 @@ class Window(QMainWindow):
                                                              self.lecture_copy_signal,
                                                              self.label_device_signal,
                                                              self.label_time_left_signal)
+        self.link_scheduler = LinkScheduler.LinkScheduler(self.settings)
+        self.session_manager = SessionManager.SessionManager(self.settings, self.sessions_finished_signal,
+                                                             self.preview_label, self.progress_bar_audio_signal,
+                                                             self.label_rec_set_stylesheet_signal,
+                                                             self.label_current_link_time_signal)
+
+        # Keep models between builds and unload them while only recording
+        self.model_manager = None
+        if self.settings['model_manager_enabled']:
+            self.model_manager = ModelManager.ModelManager(self.settings, self.label_device_signal)
+            self.lecture_builder.model_manager = self.model_manager
+            self.model_manager.start()
+
+        # Transcribe fragments during recording
+        self.background_transcriber = None
+        if self.settings['background_transcription_enabled']:
+            self.background_transcriber = BackgroundTranscriber.BackgroundTranscriber(self.settings)
+            self.background_transcriber.lecture_builder.model_manager = self.model_manager
+            self.background_transcriber.start()
+            self.audio_handler.background_transcriber = self.background_transcriber
+            self.session_manager.background_transcriber = self.background_transcriber
 
         # Set window title
         self.setWindowTitle('Lecture hacker ' + WEBINAR_HACKER_VERSION)
@@ -319,6 +349,7 @@ class Window(QMainWindow):
         """
         # Stop file and webinar handlers
         self.stop_video_audio_decoding()
+        self.session_manager.stop_sessions()
         self.stop_browser(True)
 
         # Clear preview image
@@ -418,6 +449,12 @@ class Window(QMainWindow):
         logging.info('Refreshing list of lectures...')
         lectures = []
         recordings_dir = str(self.settings['recordings_directory_name']) + '/'
+
+        # Audio container has configurable name (use whole name if it has no extension)
+        container_file_name = str(self.settings['audio_container_file_name']).lower()
+        container_extension = os.path.splitext(container_file_name)[1]
+        if len(container_extension) == 0:
+            container_extension = container_file_name
         if os.path.exists(recordings_dir):
             # List all dirs in recordings directory
             for recording_dir in os.listdir(recordings_dir):
@@ -429,7 +466,8 @@ class Window(QMainWindow):
                         audio_or_screenshot_dir = os.path.join(recording_dir, audio_or_screenshot_dir)
                         if os.path.isdir(audio_or_screenshot_dir):
                             for file_ in os.listdir(audio_or_screenshot_dir):
-                                if str(file_).lower().endswith(AudioHandler.WAVE_FILE_EXTENSION):
+                                if str(file_).lower().endswith(AudioHandler.WAVE_FILE_EXTENSION) \
+                                        or str(file_).lower().endswith(container_extension):
                                     lectures.append(str(recording_dir_))
                                     break
 
@@ -477,6 +515,7 @@ class Window(QMainWindow):
             QMessageBox.warning(self, 'No frames!', 'No frames processed!')
         else:
             QMessageBox.information(self, 'Done!', 'File ' + name + ' decoded!\nNow you can build lecture from it')
+            self.preload_models()
         self.elements_set_enabled(True, ENABLE_DISABLE_GUI_FROM_VIDEOAUDIO)
         self.lectures_refresh()
 
@@ -569,6 +608,7 @@ class Window(QMainWindow):
             # Check link index
             if self.current_link_index >= len(self.settings['gui_links']):
                 logging.info('No more links')
+                self.close_warm_browser()
                 QMessageBox.information(self, 'No links!', 'No more available links provided')
                 self.elements_set_enabled(True, ENABLE_DISABLE_GUI_FROM_BROWSER)
                 return
@@ -581,6 +621,7 @@ class Window(QMainWindow):
 
             # Can not get new link
             if len(link) <= 0:
+                self.close_warm_browser()
                 QMessageBox.warning(self, 'No links!', 'No more available links provided')
                 self.elements_set_enabled(True, ENABLE_DISABLE_GUI_FROM_BROWSER)
                 return
@@ -604,7 +645,12 @@ class Window(QMainWindow):
                     if reply == QMessageBox.Yes:
                         start_allowed = True
 
-                if start_allowed:
+                # Run all links at once
+                if start_allowed and self.settings['concurrent_sessions_enabled']:
+                    self.elements_set_enabled(False, ENABLE_DISABLE_GUI_FROM_BROWSER)
+                    self.session_manager.start_sessions(self.settings['gui_links'], user_name)
+
+                elif start_allowed:
                     # Add reconnect timer if not exists
                     counter_exists = False
                     for reconnect_counter in self.reconnects_counters:
@@ -614,14 +660,13 @@ class Window(QMainWindow):
                     if not counter_exists:
                         self.reconnects_counters.append({str(self.current_link_index): 0})
 
-                    # Open audio stream
-                    if self.settings['gui_recording_enabled']:
-                        self.audio_handler.open_stream()
-
-                    # Disable form elements and start
+                    # Disable form elements and start now or shortly before start time
                     self.elements_set_enabled(False, ENABLE_DISABLE_GUI_FROM_BROWSER)
-                    self.webinar_handler.start_browser(link)
-                    self.webinar_handler.start_handler(user_name)
+                    start_time, link = LinkScheduler.parse_scheduled_link(link)
+                    if self.link_scheduler.delay_seconds(start_time) > 0:
+                        self.label_current_link_time_signal.emit('Waiting for start: ' + time.strftime(
+                            '%Y-%m-%d %H:%M', time.localtime(start_time)))
+                    self.link_scheduler.schedule(start_time, self.start_link_signal.emit, link, user_name)
             else:
                 QMessageBox.warning(self, 'No user name', 'Please type user name to connect with!')
 
@@ -631,6 +676,41 @@ class Window(QMainWindow):
             QMessageBox.critical(self, 'Error', 'Error starting browser and other staff\n' + str(e)
                                  + '\nTry turning off recording.')
 
+    def start_link(self, link: str, user_name: str):
+        """
+        Opens audio stream, browser and starts webinar handler
+        :param link: link without start time
+        :param user_name: connect with this name
+        :return:
+        """
+        try:
+            # Open audio stream
+            if self.settings['gui_recording_enabled']:
+                self.audio_handler.open_stream()
+
+            self.webinar_handler.start_browser(link)
+            self.webinar_handler.start_handler(user_name)
+
+        # Error
+        except Exception as e:
+            logging.error(e, exc_info=True)
+            QMessageBox.critical(self, 'Error', 'Error starting browser and other staff\n' + str(e)
+                                 + '\nTry turning off recording.')
+
+    def next_link_starts_soon(self):
+        """
+        Checks if the next link will be started soon enough to keep browser running while waiting for it
+        :return: True if there is next link and it's scheduled within scheduler_keep_warm_max_wait_seconds
+        """
+        # Empty links are skipped by start_browser()
+        next_links = [str(link).strip() for link in self.settings['gui_links'][self.current_link_index + 1:]
+                      if len(str(link).strip()) > 0]
+        if len(next_links) == 0:
+            return False
+        start_time, _ = LinkScheduler.parse_scheduled_link(next_links[0])
+        return self.link_scheduler.delay_seconds(start_time) \
+            <= float(self.settings['scheduler_keep_warm_max_wait_seconds'])
+
     def stop_browser(self, from_button: bool, from_zoom=False):
         """
         Stops recording and closes browser
@@ -638,16 +718,19 @@ class Window(QMainWindow):
         :param from_button: True if button clicked false if automation
         :param from_zoom: will reconnect to the same link if needed
         """
-        # Stop recording
-        self.audio_handler.recording_stop()
+        # Cancel scheduled link
+        if from_button:
+            self.link_scheduler.cancel()
+            self.label_current_link_time_signal.emit('Current link time: 00:00:00')
 
-        # Close audio stream
+        # Close audio stream and stop recording (after processing captured audio)
         self.audio_handler.close_stream()
 
-        # Close browser
+        # Close browser (or keep it running for the next link or zoom reconnect)
         if self.webinar_handler.browser is not None:
             self.webinar_handler.stop_handler()
-            self.webinar_handler.stop_browser()
+            self.webinar_handler.stop_browser(keep_warm=not from_button and self.settings['browser_keep_warm']
+                                              and (self.next_link_starts_soon() or from_zoom))
 
         # Refresh lectures
         self.lectures_refresh()
@@ -674,8 +757,36 @@ class Window(QMainWindow):
 
         # No more links
         else:
+            self.close_warm_browser()
+
             # Enable GUI elements
             self.elements_set_enabled(True, ENABLE_DISABLE_GUI_FROM_BROWSER)
+            self.preload_models()
+
+    def close_warm_browser(self):
+        """
+        Quits browser that was kept running for the next link
+        :return:
+        """
+        if self.webinar_handler.browser is not None:
+            self.webinar_handler.stop_browser()
+
+    def sessions_finished(self):
+        """
+        Enables gui elements after all concurrent sessions are finished
+        :return:
+        """
+        self.lectures_refresh()
+        self.elements_set_enabled(True, ENABLE_DISABLE_GUI_FROM_BROWSER)
+        self.preload_models()
+
+    def preload_models(self):
+        """
+        Loads models in background after recording (lecture will probably be built next)
+        :return:
+        """
+        if self.model_manager is not None and self.settings['model_manager_preload_after_recording']:
+            self.model_manager.preload()
 
     def elements_set_enabled(self, enabled: bool, enable_disable_from=ENABLE_DISABLE_GUI_FROM_LECTURE_BUILDER):
         """
@@ -741,14 +852,26 @@ class Window(QMainWindow):
         :param event:
         :return:
         """
-        # Stop recording
-        self.audio_handler.recording_stop()
+        # Stop capture and recording (consumer thread must not process audio after recording is stopped)
+        self.audio_handler.close_stream()
 
         # Close browser
         if self.webinar_handler.browser is not None:
             self.webinar_handler.stop_handler()
             self.webinar_handler.stop_browser()
 
+        # Close concurrent sessions
+        self.link_scheduler.cancel()
+        self.session_manager.stop_sessions()
+
+        # Stop background transcriber
+        if self.background_transcriber is not None:
+            self.background_transcriber.stop()
+
+        # Unload models
+        if self.model_manager is not None:
+            self.model_manager.stop()
+
         # Kill all threads
         exit_(None, None)
 
@@ -0,0 +1,41 @@
+"""
+ Copyright (C) 2022 Fern Lane, Webinar-hacker
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules are flat in the repository root
+sys.path.insert(0, ROOT_DIR)
+
+from lecturehacker import load_settings
+
+
+@pytest.fixture
+def settings(tmp_path):
+    """
+    Default settings with all directories inside temporary directory
+    :param tmp_path: pytest temporary directory
+    :return: settings dictionary
+    """
+    settings_ = load_settings(os.path.join(ROOT_DIR, 'settings.json'))
+    settings_['distributed_queue_directory'] = str(tmp_path / 'queue')
+    settings_['recordings_directory_name'] = str(tmp_path / 'recordings')
+    settings_['lectures_directory_name'] = str(tmp_path / 'lectures')
+    return settings_
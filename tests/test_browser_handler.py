@@ -0,0 +1,75 @@
+"""
+ Copyright (C) 2022 Fern Lane, Webinar-hacker
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+import pytest
+
+import BrowserHandler
+from BrowserHandler import get_chrome_driver_path, acquire_profile_dir, release_profile_dir, LINK_TYPE_ZOOM
+
+
+class CountingDriverManager:
+    """
+    Replaces ChromeDriverManager without network access
+    """
+    installs = 0
+
+    def install(self):
+        CountingDriverManager.installs += 1
+        return '/cache/chromedriver'
+
+
+@pytest.fixture
+def driver_manager(monkeypatch):
+    monkeypatch.setattr(BrowserHandler, 'chrome_driver_path', None)
+    monkeypatch.setattr(BrowserHandler, 'ChromeDriverManager', CountingDriverManager)
+    CountingDriverManager.installs = 0
+    return CountingDriverManager
+
+
+def test_driver_is_resolved_once(settings, driver_manager):
+    settings['chrome_driver_path'] = ''
+    assert get_chrome_driver_path(settings) == '/cache/chromedriver'
+    assert get_chrome_driver_path(settings) == '/cache/chromedriver'
+    assert driver_manager.installs == 1
+
+
+def test_pinned_driver_is_used_without_download(settings, driver_manager, tmp_path):
+    pinned_path = tmp_path / 'chromedriver'
+    pinned_path.write_bytes(b'')
+    settings['chrome_driver_path'] = str(pinned_path)
+    assert get_chrome_driver_path(settings) == str(pinned_path)
+    assert driver_manager.installs == 0
+
+
+def test_missing_pinned_driver_fails(settings, driver_manager, tmp_path):
+    settings['chrome_driver_path'] = str(tmp_path / 'missing')
+    with pytest.raises(FileNotFoundError):
+        get_chrome_driver_path(settings)
+    assert driver_manager.installs == 0
+    assert BrowserHandler.chrome_driver_path is None
+
+
+def test_profile_dir_is_not_shared(settings, tmp_path):
+    settings['browser_profiles_dir'] = str(tmp_path / 'profiles')
+    profile_dir = acquire_profile_dir(settings, LINK_TYPE_ZOOM)
+    profile_dir_ = acquire_profile_dir(settings, LINK_TYPE_ZOOM)
+    assert profile_dir_ == profile_dir + '_1'
+
+    # Released profile is reused by the next browser
+    release_profile_dir(profile_dir)
+    assert acquire_profile_dir(settings, LINK_TYPE_ZOOM) == profile_dir
+    release_profile_dir(profile_dir)
+    release_profile_dir(profile_dir_)
@@ -0,0 +1,108 @@
+"""
+ Copyright (C) 2022 Fern Lane, Webinar-hacker
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+import os
+import time
+import wave
+
+import numpy as np
+
+from AudioHandler import AudioHandler, AUDIO_STORAGE_MODE_CONTAINER
+from CallbackSignal import CallbackSignal
+from CaptureBackends import RingBuffer, CAPTURE_BACKEND_FILE
+from RecordingManifest import load_manifest, MANIFEST_ENTRY_AUDIO
+
+SAMPLING_RATE = 16000
+CHUNK_SIZE = 1024
+
+
+def test_ring_buffer_wraps_around():
+    ring_buffer = RingBuffer(10)
+    assert ring_buffer.write(np.arange(8, dtype=np.float32))
+    assert np.array_equal(ring_buffer.read(6), np.arange(6))
+
+    # Write crosses the end of the buffer
+    assert ring_buffer.write(np.arange(8, 14, dtype=np.float32))
+    assert ring_buffer.available() == 8
+    assert ring_buffer.read(9) is None
+    assert np.array_equal(ring_buffer.read(8), np.arange(6, 14))
+    assert ring_buffer.available() == 0
+
+
+def test_ring_buffer_overrun_drops_whole_write():
+    ring_buffer = RingBuffer(10)
+    assert ring_buffer.write(np.ones(7, dtype=np.float32))
+    assert not ring_buffer.write(np.full(4, 2., dtype=np.float32))
+    assert ring_buffer.overruns == 1
+    assert ring_buffer.samples_dropped == 4
+
+    # Buffered samples are not damaged by dropped write
+    assert ring_buffer.write(np.full(3, 3., dtype=np.float32))
+    assert np.array_equal(ring_buffer.read(10), np.array([1.] * 7 + [3.] * 3, dtype=np.float32))
+
+
+def write_test_wave(file: str):
+    """
+    Writes two tone bursts surrounded by silence (two fragments for AudioHandler)
+    :param file: path to WAV file
+    :return: number of samples in each burst
+    """
+    burst_samples = SAMPLING_RATE
+    tone = 0.5 * np.sin(2. * np.pi * 440. * np.arange(burst_samples) / SAMPLING_RATE)
+    silence = np.zeros(2 * SAMPLING_RATE)
+    samples = np.concatenate((silence, tone, silence, tone, silence))
+    with wave.open(file, 'wb') as wave_file:
+        wave_file.setnchannels(1)
+        wave_file.setsampwidth(2)
+        wave_file.setframerate(SAMPLING_RATE)
+        wave_file.writeframes((samples * 32767).astype(np.int16).tobytes())
+    return burst_samples
+
+
+def test_file_replay_backend_feeds_audio_handler(settings, tmp_path):
+    wave_file = str(tmp_path / 'replay.wav')
+    burst_samples = write_test_wave(wave_file)
+    settings['audio_capture_backend'] = CAPTURE_BACKEND_FILE
+    settings['audio_capture_file'] = wave_file
+    settings['audio_capture_file_speed'] = 20
+    settings['audio_chunk_size'] = CHUNK_SIZE
+    settings['audio_wav_sampling_rate'] = SAMPLING_RATE
+    settings['audio_storage_mode'] = AUDIO_STORAGE_MODE_CONTAINER
+
+    # Same order as in GUI: stream is opened first, recording starts later (during leading silence)
+    audio_handler = AudioHandler(settings, CallbackSignal(), CallbackSignal())
+    audio_handler.open_stream()
+    audio_handler.recording_start(recording_name='replay')
+    assert audio_handler.sampling_rate == SAMPLING_RATE
+
+    # Wait until file is replayed and consumer drains ring buffer
+    audio_handler.capture_backend.thread.join()
+    time_started = time.time()
+    while audio_handler.ring_buffer.available() >= CHUNK_SIZE and time.time() - time_started < 10:
+        time.sleep(0.01)
+    recording_dir = audio_handler.recording_dir
+    audio_handler.close_stream()
+
+    # Each burst is one fragment, stored one after another inside container
+    fragments = [entry for entry in load_manifest(os.path.join(recording_dir, settings['manifest_file_name']))
+                 if entry['type'] == MANIFEST_ENTRY_AUDIO]
+    assert len(fragments) == 2
+    assert fragments[0]['offset'] == 0
+    assert fragments[1]['offset'] == fragments[0]['samples']
+    assert all(fragment['samples'] >= burst_samples for fragment in fragments)
+    container_file = os.path.join(recording_dir, settings['audio_directory_name'],
+                                  settings['audio_container_file_name'])
+    assert os.path.getsize(container_file) == 2 * (fragments[0]['samples'] + fragments[1]['samples'])
@@ -0,0 +1,153 @@
+"""
+ Copyright (C) 2022 Fern Lane, Webinar-hacker
+ Licensed under the GNU Affero General Public License, Version 3.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+       https://www.gnu.org/licenses/agpl-3.0.en.html
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR
+ OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ OTHER DEALINGS IN THE SOFTWARE.
+"""
+import json
+import os
+
+from TranscriptionQueue import TranscriptionCoordinator, TranscriptionWorker, write_json_atomic, \
+    QUEUE_DIR_PENDING, QUEUE_DIR_CLAIMED, QUEUE_DIR_RESULTS, QUEUE_DIR_AUDIO
+
+UNIT_FILE = '000000.json'
+
+
+def create_job(settings):
+    """
+    Creates job directory with one pending unit
+    :param settings: settings dictionary
+    :return: job directory
+    """
+    job_dir = os.path.join(settings['distributed_queue_directory'], 'job')
+    for directory in (QUEUE_DIR_PENDING, QUEUE_DIR_CLAIMED, QUEUE_DIR_RESULTS, QUEUE_DIR_AUDIO):
+        os.makedirs(os.path.join(job_dir, directory))
+    write_json_atomic(os.path.join(job_dir, QUEUE_DIR_PENDING, UNIT_FILE),
+                      {'unit': '000000', 'time': 0, 'samples': 16000, 'attempts': 0})
+    return job_dir
+
+
+def create_worker(settings, worker_id: str, transcribe):
+    """
+    Creates worker with replaced transcription
+    :param settings: settings dictionary
+    :param worker_id: worker id
+    :param transcribe: function(audio_file_) used instead of LectureBuilder.transcribe
+    :return: TranscriptionWorker
+    """
+    worker = TranscriptionWorker(settings)
+    worker.worker_id = worker_id
+    worker.lecture_builder.transcribe = transcribe
+    return worker
+
+
+def read_json(file: str):
+    with open(file, 'r', encoding='utf-8') as file_:
+        return json.load(file_)
+
+
+def fail(audio_file_):
+    raise RuntimeError('broken unit')
+
+
+def test_claim_is_exclusive(settings):
+    job_dir = create_job(settings)
+    worker_1 = create_worker(settings, 'worker_1', fail)
+    worker_2 = create_worker(settings, 'worker_2', fail)
+
+    assert worker_1.claim() == (job_dir, UNIT_FILE)
+    assert worker_2.claim() is None
+    assert read_json(os.path.join(job_dir, QUEUE_DIR_CLAIMED, UNIT_FILE))['owner'] == 'worker_1'
+
+
+def test_expired_lease_is_requeued(settings):
+    job_dir = create_job(settings)
+    create_worker(settings, 'worker_1', fail).claim()
+    coordinator = TranscriptionCoordinator(settings)
+    leases = {}
+
+    # Lease is counted from the moment coordinator sees the claim (negative lease expires on the next check)
+    settings['distributed_lease_seconds'] = -1
+    coordinator.requeue_expired(job_dir, leases)
+    assert os.path.exists(os.path.join(job_dir, QUEUE_DIR_CLAIMED, UNIT_FILE))
+
+    coordinator.requeue_expired(job_dir, leases)
+    assert os.path.exists(os.path.join(job_dir, QUEUE_DIR_PENDING, UNIT_FILE))
+    assert len(leases) == 0
+
+
+def test_heartbeat_renews_lease(settings):
+    job_dir = create_job(settings)
+    create_worker(settings, 'worker_1', fail).claim()
+    coordinator = TranscriptionCoordinator(settings)
+    leases = {}
+    settings['distributed_lease_seconds'] = 0
+    coordinator.requeue_expired(job_dir, leases)
+
+    # Modification time from worker clock far in the past still counts as heartbeat
+    claimed_file = os.path.join(job_dir, QUEUE_DIR_CLAIMED, UNIT_FILE)
+    os.utime(claimed_file, (1000, 1000))
+    coordinator.requeue_expired(job_dir, leases)
+    assert os.path.exists(claimed_file)
+
+
+def test_failed_unit_is_retried_then_build_fails(settings):
+    job_dir = create_job(settings)
+    settings['distributed_max_attempts'] = 2
+    worker = create_worker(settings, 'worker_1', fail)
+    coordinator = TranscriptionCoordinator(settings)
+    finished_units = set()
+
+    # First failure returns unit into queue
+    worker.process(*worker.claim())
+    assert read_json(os.path.join(job_dir, QUEUE_DIR_RESULTS, UNIT_FILE))['error'] == 'broken unit'
+    assert coordinator.check_results(job_dir, finished_units)
+    assert read_json(os.path.join(job_dir, QUEUE_DIR_PENDING, UNIT_FILE))['attempts'] == 1
+    assert not os.path.exists(os.path.join(job_dir, QUEUE_DIR_RESULTS, UNIT_FILE))
+
+    # Second failure reaches distributed_max_attempts
+    worker.process(*worker.claim())
+    assert not coordinator.check_results(job_dir, finished_units)
+    assert len(finished_units) == 0
+
+
+def test_successful_result(settings):
+    job_dir = create_job(settings)
+    worker = create_worker(settings, 'worker_1', lambda audio_file_: [['word', 1000, 90]])
+    coordinator = TranscriptionCoordinator(settings)
+    finished_units = set()
+
+    worker.process(*worker.claim())
+    assert coordinator.check_results(job_dir, finished_units)
+    assert finished_units == {UNIT_FILE}
+    assert read_json(os.path.join(job_dir, QUEUE_DIR_RESULTS, UNIT_FILE))['words'] == [['word', 1000, 90]]
+    assert os.listdir(os.path.join(job_dir, QUEUE_DIR_CLAIMED)) == []
+
+
+def test_worker_with_lost_lease_keeps_claim_of_new_owner(settings):
+    job_dir = create_job(settings)
+    worker_1 = create_worker(settings, 'worker_1', lambda audio_file_: [['late', 1000, 90]])
+    worker_2 = create_worker(settings, 'worker_2', lambda audio_file_: [['word', 1000, 90]])
+    claimed = worker_1.claim()
+
+    # Coordinator returns unit into queue and another worker claims it
+    os.rename(os.path.join(job_dir, QUEUE_DIR_CLAIMED, UNIT_FILE), os.path.join(job_dir, QUEUE_DIR_PENDING, UNIT_FILE))
+    assert worker_2.claim() == claimed
+
+    worker_1.process(*claimed)
+    assert read_json(os.path.join(job_dir, QUEUE_DIR_CLAIMED, UNIT_FILE))['owner'] == 'worker_2'
+    assert not os.path.exists(os.path.join(job_dir, QUEUE_DIR_RESULTS, UNIT_FILE))
+
+    worker_2.process(*claimed)
+    assert read_json(os.path.join(job_dir, QUEUE_DIR_RESULTS, UNIT_FILE))['words'] == [['word', 1000, 90]]
+    assert os.listdir(os.path.join(job_dir, QUEUE_DIR_CLAIMED)) == []